@@ -0,0 +1,268 @@
+"""
+Stress test of the thread safe command channel: many producer threads drive a single hidden agent at once.
+
+Every producer sends bursts of animation and balloon commands, with a few stops and a few animations the agent does
+not have, then waits for all of its futures. The agent is never shown, so its timers only run for the animations
+whose futures are awaited. Checks that:
+
+- every future resolves before the timeout, without error except KeyError for the unknown animations;
+- animation futures resolve in the order the agent called their callbacks or dropped them, one future per callback;
+- every animation which started also stopped, and its callback was called right after it stopped;
+- the futures which failed with CommandCancelled are exactly the animations stop() discarded;
+- unknown animations sent to an agent still loading its resources fail with KeyError once it is loaded.
+
+Animations which played, and requests dropped from the full queue or coalesced, are counted separately. Also reports
+how many commands each event loop iteration applied. Exits with a non zero status if a check fails.
+
+Usage: python benchmarks/bench_commands.py [--threads 16] [--commands 500]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import wait
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from clippy_qt.commands import CommandCancelled, CommandChannel  # noqa: E402
+
+# Directional animations, which only look_at() and gesture_at() play
+DIRECTIONAL_PREFIXES = ('Look', 'Gesture')
+# An animation no agent has
+UNKNOWN_ANIMATION = 'NoSuchAnimation'
+
+
+class RecordingChannel(CommandChannel):
+    """ A command channel recording the order its animation futures resolve in, on the GUI thread. """
+
+    def __init__(self, agent, engine=None, parent=None):
+        super(RecordingChannel, self).__init__(agent, engine=engine, parent=parent)
+        self.resolved = []
+        self.cancelled = 0
+        self.unknown = 0
+        self.animation_futures = 0
+
+    def _play(self, future, animation, right_now, priority):
+        self._watch(future, animation)
+        return super(RecordingChannel, self)._play(future, animation, right_now, priority)
+
+    def _animate(self, future, method, position):
+        # Directional animations are told apart by their prefix, see expected_order()
+        self._watch(future, method.__name__)
+        return super(RecordingChannel, self)._animate(future, method, position)
+
+    def _watch(self, future, label):
+        # The future is running, so the callback is called later, by whichever thread resolves it
+        self.animation_futures += 1
+        future.add_done_callback(lambda future: self._done(future, label))
+
+    def _done(self, future, label):
+        if future.exception() is None:
+            self.resolved.append(label)
+        elif isinstance(future.exception(), CommandCancelled):
+            self.cancelled += 1
+        elif isinstance(future.exception(), KeyError):
+            self.unknown += 1
+
+
+def producer(channel, names, commands, seed, results):
+    """ Send a burst of commands, then wait for all of them. """
+    from PySide2 import QtCore, QtWidgets
+
+    rng = random.Random(seed)
+    futures = []
+    unknown = []
+    for i in range(commands):
+        roll = rng.random()
+        if roll < 0.6:
+            futures.append(channel.play(rng.choice(names), priority=rng.randint(0, 2)))
+        elif roll < 0.8:
+            futures.append(channel.look_at(QtCore.QPoint(rng.randint(-500, 500), rng.randint(-500, 500))))
+        elif roll < 0.9:
+            futures.append(channel.gesture_at(QtCore.QPoint(rng.randint(-500, 500), rng.randint(-500, 500))))
+        elif roll < 0.985:
+            key = rng.randint(0, 3)
+            futures.append(channel.set_widget(lambda key=key: QtWidgets.QLabel('Content {}'.format(key)), key=key))
+        elif roll < 0.99:
+            unknown.append(channel.play(UNKNOWN_ANIMATION))
+        else:
+            futures.append(channel.stop())
+        if rng.random() < 0.1:
+            # Bursts of commands, with short pauses in between
+            time.sleep(0.002)
+    # The queued animations play out, those of the other producers included
+    done, not_done = wait(futures + unknown, timeout=120)
+    outcome = {'done': len(done), 'not_done': len(not_done), 'resolved': 0, 'cancelled': 0, 'errors': 0,
+               'unknown': len(unknown), 'rejected': sum(1 for future in unknown
+                                                        if future.done() and isinstance(future.exception(), KeyError))}
+    done.difference_update(unknown)
+    for future in done:
+        error = future.exception()
+        if error is None:
+            outcome['resolved'] += 1
+        elif isinstance(error, CommandCancelled):
+            outcome['cancelled'] += 1
+        else:
+            outcome['errors'] += 1
+    results.append(outcome)
+
+
+def expected_order(trace):
+    """ Return the labels of the animation callbacks the agent called or dropped, in order, from its trace. """
+    labels = []
+    for event in trace:
+        if event[1] not in ('callback', 'dropped'):
+            continue
+        animation = event[2]
+        if animation.startswith('Look'):
+            labels.append('look_at')
+        elif animation.startswith('Gesture'):
+            labels.append('gesture_at')
+        else:
+            labels.append(animation)
+    return labels
+
+
+def check_trace(trace):
+    """ Return the problems of the started, stopped and callback events of a trace, and the number of plays. """
+    problems = []
+    playing = None
+    previous = None
+    played = 0
+    for event in trace:
+        kind = event[1]
+        if kind == 'started':
+            if playing is not None:
+                problems.append('{} started while {} played'.format(event[2], playing))
+            playing = event[2]
+            played += 1
+        elif kind == 'stopped':
+            if event[2] != playing:
+                problems.append('{} stopped while {} played'.format(event[2], playing))
+            playing = None
+        elif kind == 'callback' and (previous is None or previous[1] != 'stopped' or previous[2] != event[2]):
+            problems.append('callback of {} not right after it stopped'.format(event[2]))
+        if kind != 'frame':
+            previous = event
+    return problems, played
+
+
+def check_loading_agent(app):
+    """ Return the problems of an unknown animation sent to an agent loading its resources on a thread pool. """
+    from PySide2 import QtCore
+    from clippy_qt.agents import Clippy
+    from clippy_qt.registry import AssetRegistry
+
+    # A registry of its own, so the resources are not cached yet and the commands wait for them. Agents do not keep
+    # their registry alive, the check does.
+    registry = AssetRegistry()
+    agent = Clippy(asynchronous=True, registry=registry)
+    agent.play_sounds = False
+    channel = CommandChannel(agent)
+    futures = [channel.play(UNKNOWN_ANIMATION), channel.play('Wave')]
+    deadline = time.perf_counter() + 30
+    with warnings.catch_warnings():
+        # The agent warns about the unknown animation
+        warnings.simplefilter('ignore')
+        while not all(future.done() for future in futures) and time.perf_counter() < deadline:
+            app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+            agent.activate()
+    problems = []
+    if not futures[0].done() or not isinstance(futures[0].exception(), KeyError):
+        problems.append('unknown animation sent while loading did not fail with KeyError')
+    if not futures[1].done() or futures[1].exception() is not None:
+        problems.append('animation sent while loading did not play')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16, help='Number of producer threads')
+    parser.add_argument('--commands', type=int, default=500, help='Commands sent by each producer')
+    args = parser.parse_args()
+
+    from PySide2 import QtCore, QtWidgets
+    from clippy_qt.agents import Clippy
+    from clippy_qt.engine import ClippyEngine
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    loading_problems = check_loading_agent(app)
+    # Interrupting with a small latency budget keeps the agent moving through the queue quickly
+    engine = ClippyEngine(agent=Clippy(interrupt=True, max_stop_latency=100))
+    agent = engine.agent
+    agent.play_sounds = False
+    agent.playback.trace = []
+    discarded = []
+    agent.discarded.connect(discarded.append)
+    channel = RecordingChannel(agent, engine=engine, parent=engine)
+    names = [name for name in agent.animations()
+             if not name.startswith('Idle') and not name.startswith(DIRECTIONAL_PREFIXES)]
+
+    results = []
+    threads = [threading.Thread(target=producer, args=(channel, names, args.commands, seed, results))
+               for seed in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+        # Looping animations only end when asked to, ask every animation so the queue keeps moving
+        agent.activate()
+    elapsed = time.perf_counter() - start
+
+    totals = dict((key, sum(result[key] for result in results)) for key in results[0])
+    trace = agent.playback.trace
+    callbacks = sum(1 for event in trace if event[1] == 'callback')
+    drops = {}
+    for event in trace:
+        if event[1] == 'dropped':
+            drops[event[3]] = drops.get(event[3], 0) + 1
+    trace_problems, played = check_trace(trace)
+
+    print('{} threads x {} commands in {:.2f} s, agent hidden'.format(args.threads, args.commands, elapsed))
+    print('futures: {done} done ({resolved} resolved, {cancelled} cancelled, {errors} errors), '
+          '{not_done} never resolved'.format(**totals))
+    print('animation futures: {} ({} played and called back, {} dropped: {}, {} cancelled, {} unknown)'.format(
+        channel.animation_futures, callbacks, sum(drops.values()),
+        ', '.join('{} {}'.format(count, reason) for reason, count in sorted(drops.items())) or 'none',
+        channel.cancelled, channel.unknown))
+    print('{} commands applied in {} event loop iterations, {:.1f} per iteration'.format(
+        channel.applied, channel.batches, channel.applied / max(channel.batches, 1)))
+
+    failures = []
+    if totals['not_done']:
+        failures.append('{} futures never resolved'.format(totals['not_done']))
+    if totals['errors']:
+        failures.append('{} futures failed with an error'.format(totals['errors']))
+    if totals['rejected'] != totals['unknown'] or channel.unknown != totals['unknown']:
+        failures.append('{} of {} unknown animations failed with KeyError'.format(totals['rejected'],
+                                                                                totals['unknown']))
+    if channel.resolved != expected_order(trace):
+        failures.append('animation futures resolved out of order with the callbacks and drops')
+    if len(channel.resolved) != callbacks + sum(drops.values()):
+        failures.append('{} animation futures resolved for {} callbacks and {} drops'.format(
+            len(channel.resolved), callbacks, sum(drops.values())))
+    if channel.cancelled != len(discarded):
+        failures.append('{} futures cancelled for {} discarded animations'.format(channel.cancelled, len(discarded)))
+    resolved = len(channel.resolved) + channel.cancelled + channel.unknown
+    if resolved != channel.animation_futures:
+        failures.append('{} animation futures neither resolved, cancelled nor unknown'.format(
+            channel.animation_futures - resolved))
+    failures.extend(trace_problems[:10])
+    failures.extend(loading_problems)
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    print('{} animations played, {}'.format(played, 'FAILED' if failures else 'all checks passed'))
+    sys.stdout.flush()
+    # Skip interpreter teardown, some PySide2 builds crash while destroying the application
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark of the ClippyJS batch converter.
+
+Builds a library of ClippyJS agents from the Clippy agent shipped with ClippyQt, then converts it with one process
+and with a process pool, using the silent decoder so ffmpeg is not needed. A last run checks that up to date agents
+are skipped.
+
+Usage: python benchmarks/bench_convert.py [--agents N] [--jobs N]
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import convert_clippyJS_resources as converter  # noqa: E402
+
+AGENT_DIR = os.path.join(ROOT, 'agents', 'Clippy')
+
+
+def make_clippy_js_agent(directory, name):
+    """ Write a ClippyJS agent directory, made from the converted Clippy agent. """
+    with open(os.path.join(AGENT_DIR, 'config.json'), 'r') as f:
+        config = json.load(f)
+    image_width = converter.png_size(os.path.join(AGENT_DIR, 'map.png'))[0]
+    width, height = config['framesize']
+    columns = image_width // width
+    for animation in config['animations'].values():
+        for frame in animation['frames']:
+            index = frame.pop('spriteIndex')
+            if index >= 0:
+                frame['images'] = [[(index % columns) * width, (index // columns) * height]]
+
+    os.makedirs(directory)
+    with open(os.path.join(directory, converter.AGENT_SOURCE), 'w') as f:
+        f.write("clippy.ready('{}', {});".format(name, json.dumps(config)))
+    shutil.copyfile(os.path.join(AGENT_DIR, 'map.png'), os.path.join(directory, converter.SPRITE_SOURCE))
+    payload = base64.b64encode(os.urandom(2048)).decode('ascii')
+    sounds = dict((sound, 'data:audio/ogg;base64,' + payload) for sound in config['sounds'])
+    with open(os.path.join(directory, converter.SOUNDS_SOURCE), 'w') as f:
+        f.write("clippy.soundsReady('{}', {});".format(name, json.dumps(sounds)))
+
+
+def convert(sources, output, jobs):
+    start = time.perf_counter()
+    results = []
+    failures = converter.convert_agents(sources, output, converter.SilentDecoder(), jobs=jobs,
+                                        report=lambda result, error=None: results.append((result, error)))
+    if failures:
+        raise RuntimeError([error for _result, error in results if error is not None])
+    skipped = sum(1 for result, _error in results if result['skipped'])
+    return time.perf_counter() - start, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--agents', type=int, default=16, help='Number of agents in the library')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Worker processes of the parallel run')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='clippy_convert_')
+    try:
+        library = os.path.join(work, 'clippy.js')
+        for i in range(args.agents):
+            make_clippy_js_agent(os.path.join(library, 'Agent{:02d}'.format(i)), 'Agent{:02d}'.format(i))
+        sources = converter.find_agent_sources([library])
+
+        serial, _ = convert(sources, os.path.join(work, 'serial'), 1)
+        parallel, _ = convert(sources, os.path.join(work, 'parallel'), args.jobs)
+        up_to_date, skipped = convert(sources, os.path.join(work, 'parallel'), args.jobs)
+        print('{} agents, 1 process:    {:7.2f}s'.format(len(sources), serial))
+        print('{} agents, {} processes: {:7.2f}s'.format(len(sources), args.jobs, parallel))
+        print('{} agents, up to date:   {:7.2f}s ({} skipped)'.format(len(sources), up_to_date, skipped))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
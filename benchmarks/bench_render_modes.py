@@ -0,0 +1,97 @@
+"""
+Compare the startup time, memory and paint cost of the sprite sheet render modes.
+
+Each mode runs in its own process, so resident memory is not shared between them.
+
+Usage: QT_QPA_PLATFORM=offscreen python benchmarks/bench_render_modes.py [map.png]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+DEFAULT_SPRITE = os.path.join(ROOT, 'agents', 'Clippy', 'map.png')
+DEFAULT_CONFIG = os.path.join(ROOT, 'agents', 'Clippy', 'config.json')
+
+
+def rss_kb():
+    """ Current resident set size, in kilobytes (Linux only, 0 elsewhere). """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def measure(mode, sprite, config, paints):
+    """ Load a sprite sheet in the given mode and paint every frame of every animation. """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide2 import QtGui, QtWidgets
+    from clippy_qt.animation import compile_animations
+    from clippy_qt.sprites import SpriteSheet
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])  # noqa: F841
+    with open(config, 'r') as f:
+        table = compile_animations(json.load(f))
+    width, height = table.framesize
+
+    before = rss_kb()
+    start = time.perf_counter()
+    sheet = SpriteSheet(QtGui.QPixmap(sprite), width, height, mode=mode)
+    startup = time.perf_counter() - start
+    after_load = rss_kb()
+
+    sprites = [index for name in table.names() for index in table[name].sprites]
+    target = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32_Premultiplied)
+    painter = QtGui.QPainter(target)
+    start = time.perf_counter()
+    for _ in range(paints):
+        for index in sprites:
+            sheet.draw(painter, 0, 0, index)
+    paint = (time.perf_counter() - start) / (paints * len(sprites))
+    painter.end()
+
+    return {
+        'mode': mode,
+        'startup_ms': startup * 1000,
+        'rss_after_load_kb': after_load - before,
+        'rss_after_paint_kb': rss_kb() - before,
+        'paint_us': paint * 1e6,
+    }
+
+
+def main():
+    from clippy_qt.sprites import RENDER_MODES
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sprite', nargs='?', default=DEFAULT_SPRITE)
+    parser.add_argument('--config', default=DEFAULT_CONFIG)
+    parser.add_argument('--paints', type=int, default=5, help='Passes over every frame of every animation')
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process, measure a single mode
+        print(json.dumps(measure(args.mode, args.sprite, args.config, args.paints)))
+        sys.stdout.flush()
+        # Skip interpreter teardown, some PySide2 builds crash while destroying the application
+        os._exit(0)
+
+    print('{:<8} {:>12} {:>16} {:>17} {:>10}'.format('mode', 'startup ms', 'rss load (KiB)', 'rss paint (KiB)',
+                                                     'paint us'))
+    for mode in RENDER_MODES:
+        output = subprocess.check_output([sys.executable, __file__, args.sprite, '--config', args.config,
+                                          '--paints', str(args.paints), '--mode', mode])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print('{mode:<8} {startup_ms:>12.1f} {rss_after_load_kb:>16} {rss_after_paint_kb:>17} {paint_us:>10.2f}'.format(
+            **result))
+
+
+if __name__ == '__main__':
+    main()
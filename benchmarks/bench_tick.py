@@ -0,0 +1,100 @@
+"""
+Microbenchmark of the per tick cost of the animation state machine.
+
+Compares the dict walking that Agent used to do on every tick against the compiled AnimationTable.
+Both paths do the work of one timer tick: pick the next frame (exitBranch, branching or next), then look up the
+duration for the timer, the sound to play and the sprite to paint.
+
+Usage: python benchmarks/bench_tick.py [config.json] [--ticks N]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from clippy_qt.animation import NO_BRANCH, NO_SOUND, compile_animations  # noqa: E402
+
+DEFAULT_CONFIG = os.path.join(ROOT, 'agents', 'Clippy', 'config.json')
+
+
+def dict_tick(animation, frame, stopping, rand):
+    """ One tick of the original dict based player. """
+    current_frame = animation['frames'][frame]
+    if stopping and current_frame.get('exitBranch', False):
+        next_frame = current_frame['exitBranch']
+    elif current_frame.get('branching', False):
+        random_roll = rand(0, 99)
+        for branch in current_frame['branching']['branches']:
+            if random_roll < branch['weight']:
+                next_frame = branch['frameIndex']
+                break
+            random_roll -= branch['weight']
+        else:
+            next_frame = frame + 1
+    else:
+        next_frame = frame + 1
+    if next_frame >= len(animation['frames']):
+        next_frame = 0
+    animation['frames'][next_frame]['duration']
+    if 'sound' in animation['frames'][next_frame]:
+        animation['frames'][next_frame]['sound']
+    animation['frames'][next_frame]['spriteIndex']
+    return next_frame
+
+
+def compiled_tick(animation, frame, stopping, rand):
+    """ One tick of the compiled player. """
+    next_frame = NO_BRANCH
+    if stopping:
+        next_frame = animation.exit_branches[frame]
+    if next_frame == NO_BRANCH and animation.branches[frame] is not None:
+        next_frame = animation.branches[frame].pick(rand(0, 99))
+    if next_frame == NO_BRANCH:
+        next_frame = frame + 1
+    if next_frame >= animation.frame_count:
+        next_frame = 0
+    animation.durations[next_frame]
+    animation.sounds[next_frame] != NO_SOUND
+    animation.sprites[next_frame]
+    return next_frame
+
+
+def run(animations, tick, ticks):
+    """ Tick through every animation, returns the time per tick in nanoseconds. """
+    rand = random.Random(0).randint
+
+    def loop():
+        for animation in animations:
+            frame = 0
+            for i in range(ticks):
+                frame = tick(animation, frame, i % 4 == 3, rand)
+
+    seconds = min(timeit.repeat(loop, number=1, repeat=5))
+    return seconds / (ticks * len(animations)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('config', nargs='?', default=DEFAULT_CONFIG)
+    parser.add_argument('--ticks', type=int, default=2000, help='Ticks per animation')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    # Keep the frames of the config, both paths must walk the same animations
+    table = compile_animations(config, collapse=False)
+
+    dict_ns = run(list(config['animations'].values()), dict_tick, args.ticks)
+    compiled_ns = run([table[name] for name in table.names()], compiled_tick, args.ticks)
+    print('dict path:     {:8.1f} ns/tick'.format(dict_ns))
+    print('compiled path: {:8.1f} ns/tick'.format(compiled_ns))
+    print('speedup:       {:8.2f}x'.format(dict_ns / compiled_ns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Checks of the animation state machine, run on a virtual clock so they are deterministic and fast.
+
+Every check plays animations of the Clippy agent shipped with ClippyQt and asserts what the timers did. The script
+exits with a non zero status if any check fails.
+
+Usage: python benchmarks/check_playback.py
+"""
+import json
+import os
+import random
+import sys
+import traceback
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from clippy_qt.animation import compile_animations  # noqa: E402
+from clippy_qt.idle import IdlePolicy  # noqa: E402
+from clippy_qt.playback import Playback, VirtualClock  # noqa: E402
+
+CONFIG = os.path.join(ROOT, 'agents', 'Clippy', 'config.json')
+
+with open(CONFIG, 'r') as f:
+    TABLE = compile_animations(json.load(f))
+
+
+def new_playback(seed=0, **kwargs):
+    clock = VirtualClock()
+    return Playback(TABLE, clock, rng=random.Random(seed), trace=True, **kwargs), clock
+
+
+def check_right_now_cancels_idle_timer():
+    """ The idle timer scheduled by the animation a right_now play replaces must not stop the new animation. """
+    playback, clock = new_playback()
+    playback.play('Wave')
+    clock.run(limit=60000, exclude=(playback._idle_timer,))
+    assert not playback.is_playing() and playback._idle_timer.isActive(), 'Wave should end and schedule idle'
+
+    # Play while the idle timer is pending, and again while an animation plays
+    playback.play('Searching', right_now=True)
+    playback.play('Searching', right_now=True)
+    assert not playback._idle_timer.isActive(), 'idle timer left running after a right_now play'
+    wakeups = playback.idle_wakeups
+    while playback.is_playing() and clock.now() < 600000:
+        clock.advance(100)
+    assert playback.idle_wakeups == wakeups, 'the idle timer fired while Searching played'
+
+
+def check_suspended_callbacks_fire():
+    """ Animations with a callback play through while suspended, then the timers stop again. """
+    playback, clock = new_playback()
+    playback.suspend()
+    called = []
+    playback.play('Wave', callback=lambda: called.append('Wave'))
+    playback.play('Congratulate', callback=lambda: called.append('Congratulate'))
+    assert not playback.is_suspended(), 'timers suspended while a callback is awaited'
+    clock.run(limit=600000)
+    assert called == ['Wave', 'Congratulate'], 'callbacks called: {}'.format(called)
+    assert playback.is_suspended() and not playback.is_playing(), 'timers not suspended again once called back'
+    assert not playback._idle_timer.isActive(), 'idle timer running while suspended'
+
+    # Without a callback, animations wait on their first frame until resume()
+    playback.play('Wave')
+    assert playback.is_suspended()
+    clock.advance(10000)
+    assert playback.current_animation() == 'Wave' and playback.current_frame() == 0
+    playback.resume()
+    clock.run(limit=clock.now() + 60000, exclude=(playback._idle_timer,))
+    assert not playback.is_playing(), 'Wave did not play once resumed'
+
+
+def check_suspend_after_stop_clears_callbacks():
+    """ Stopping the animation whose callback kept the timers running lets them suspend. """
+    playback, clock = new_playback()
+    playback.play('Searching')
+    playback.play('Wave', callback=lambda: None)
+    playback.suspend()
+    assert not playback.is_suspended()
+    playback.stop()
+    assert playback.is_suspended(), 'timers still running with no callback left'
+
+
+def check_queued_idle_is_time_limited():
+    """ An idle animation waiting behind another one is asked to stop max_duration after it starts. """
+    playback, clock = new_playback(idle_policy=IdlePolicy(max_duration=1000))
+    playback.play('Wave')
+    # IdleSnooze loops until it is asked to stop
+    playback.play('IdleSnooze')
+    assert playback.current_animation() == 'Wave' and len(playback.queue) == 1, 'IdleSnooze should be queued'
+    while playback.current_animation() != 'IdleSnooze' and clock.now() < 60000:
+        clock.advance(10)
+    assert playback.current_animation() == 'IdleSnooze', 'IdleSnooze never started'
+    assert playback._idle_timer.isActive(), 'no time limit on IdleSnooze'
+    started = clock.now()
+    wakeups = playback.idle_wakeups
+    while playback.current_animation() == 'IdleSnooze' and clock.now() < started + 60000:
+        clock.advance(10)
+    assert playback.idle_wakeups == wakeups + 1, 'IdleSnooze was not asked to stop'
+    assert clock.now() < started + 6000, 'IdleSnooze played for {} ms'.format(clock.now() - started)
+
+
+CHECKS = [
+    check_right_now_cancels_idle_timer,
+    check_suspended_callbacks_fire,
+    check_suspend_after_stop_clears_callbacks,
+    check_queued_idle_is_time_limited,
+]
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failures += 1
+            print('FAIL {}'.format(check.__name__))
+            traceback.print_exc()
+        else:
+            print('ok   {}'.format(check.__name__))
+    print('{} checks, {} failed'.format(len(CHECKS), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Checks of the sound mixer, run with the silent backend on a virtual clock so they are deterministic and need no audio
+device.
+
+Every check plays short wav files written to a temporary directory and asserts how often their clips were loaded. The
+script exits with a non zero status if any check fails.
+
+Usage: python benchmarks/check_sound.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import wave
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from clippy_qt.playback import VirtualClock  # noqa: E402
+from clippy_qt.sound import ClipCache, SilentBackend, SoundFile, SoundMixer  # noqa: E402
+
+
+def write_wav(path, duration):
+    """ Write a silent mono wav file lasting duration milliseconds. """
+    rate = 8000
+    writer = wave.open(path, 'wb')
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(rate)
+    writer.writeframes(b'\0\0' * (rate * duration // 1000))
+    writer.close()
+    return path
+
+
+def new_mixer(max_voices=4):
+    clock = VirtualClock()
+    backend = SilentBackend(clock)
+    return SoundMixer(backend, max_voices=max_voices, cache=ClipCache()), clock
+
+
+def check_second_play_does_not_load(directory):
+    """ Playing a clip again, once or while it still plays, reuses the loaded clip. """
+    mixer, clock = new_mixer()
+    sound = SoundFile(write_wav(os.path.join(directory, 'beep.wav'), 100))
+    assert mixer.play(sound)
+    assert mixer.cache.loads == 1 and mixer.backend.loads == 1
+    clock.advance(200)
+    assert mixer.play(sound)
+    assert mixer.cache.loads == 1, 'clip read {} times'.format(mixer.cache.loads)
+    assert mixer.backend.loads == 1, 'clip loaded {} times by the backend'.format(mixer.backend.loads)
+
+    # Overlapping plays need a player each, they are kept for the next plays
+    assert mixer.play(sound)
+    assert mixer.backend.loads == 2 and mixer.playing() == 2
+    clock.advance(200)
+    for _ in range(10):
+        assert mixer.play(sound)
+        clock.advance(200)
+    assert mixer.backend.loads == 2, 'clip loaded {} times by the backend'.format(mixer.backend.loads)
+    assert mixer.backend.played == [sound.path] * 13
+
+
+def check_switching_clips_reuses_players(directory):
+    """ A voice switching between clips takes back the players it loaded, instead of loading the clips again. """
+    mixer, clock = new_mixer(max_voices=1)
+    sounds = [SoundFile(write_wav(os.path.join(directory, '{}.wav'.format(name)), 50)) for name in ('a', 'b', 'c')]
+    for _ in range(5):
+        for sound in sounds:
+            assert mixer.play(sound)
+            clock.advance(100)
+    assert mixer.cache.loads == 3 and mixer.backend.loads == 3, 'clips loaded {} times'.format(mixer.backend.loads)
+
+    # Stolen voices switch clip as well
+    for _ in range(5):
+        for sound in sounds:
+            assert mixer.play(sound)
+    assert mixer.stolen == 14 and mixer.backend.loads == 3, 'clips loaded {} times'.format(mixer.backend.loads)
+
+
+CHECKS = [
+    check_second_play_does_not_load,
+    check_switching_clips_reuses_players,
+]
+
+
+def main():
+    failures = 0
+    directory = tempfile.mkdtemp()
+    try:
+        for check in CHECKS:
+            try:
+                check(directory)
+            except Exception:
+                failures += 1
+                print('FAIL {}'.format(check.__name__))
+                traceback.print_exc()
+            else:
+                print('ok   {}'.format(check.__name__))
+    finally:
+        shutil.rmtree(directory)
+    print('{} checks, {} failed'.format(len(CHECKS), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
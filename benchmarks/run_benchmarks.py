@@ -0,0 +1,437 @@
+"""
+Benchmark suite for ClippyQt, run under the offscreen platform.
+
+Covers agent construction (time and peak memory, split into config, atlas and sounds), the cost of a frame tick for
+every animation, Agent and Balloon paint costs, the throughput of play() calls into the animation queue, the
+timer wake ups and repaints saved by collapsing frame runs and skipping unchanged sprites, the timer wake ups of
+an agent left alone, the overhead of the instrumentation layer, and the cost and retargets of cursor tracking.
+Results are written as JSON so they can be compared between releases.
+
+Usage: python benchmarks/run_benchmarks.py [--output results.json] [--quick]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+AGENT_DIR = os.path.join(ROOT, 'agents', 'Clippy')
+CONFIG = os.path.join(AGENT_DIR, 'config.json')
+SPRITE = os.path.join(AGENT_DIR, 'map.png')
+SOUNDS = os.path.join(AGENT_DIR, 'sounds')
+
+
+def peak_rss_kb():
+    """ Peak resident set size of this process, in kilobytes (0 where unavailable). """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def timed(function, *args):
+    """ Call a function, return its result and the time it took in milliseconds. """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def application():
+    from PySide2 import QtWidgets
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def paint_into(widget):
+    """
+    Return a function calling the paintEvent of a widget, drawing into an offscreen image.
+
+    QWidget.render() goes through paintEvent like an exposed window would, without depending on the platform plugin
+    exposing windows.
+    """
+    from PySide2 import QtCore, QtGui, QtWidgets
+
+    image = QtGui.QImage(widget.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+    target = QtCore.QPoint()
+    region = QtGui.QRegion()
+    flags = QtWidgets.QWidget.RenderFlags(0)
+
+    def paint():
+        widget.render(image, target, region, flags)
+    return paint
+
+
+def bench_construction():
+    """
+    Construction of a Clippy agent with a cold registry, split into its loading stages.
+
+    Runs in a fresh process (see main), so the peak memory only accounts for one agent.
+    """
+    app = application()  # noqa: F841
+    from PySide2 import QtGui
+    from clippy_qt import registry
+    from clippy_qt.agents import Clippy
+    from clippy_qt.animation import compile_animations
+
+    result = {'rss_start_kb': peak_rss_kb()}
+
+    def load_config():
+        with open(CONFIG, 'r') as f:
+            return compile_animations(json.load(f))
+
+    table, result['config_ms'] = timed(load_config)
+    result['config_peak_rss_kb'] = peak_rss_kb()
+    _atlas, result['atlas_ms'] = timed(QtGui.QPixmap, SPRITE)
+    result['atlas_peak_rss_kb'] = peak_rss_kb()
+    _sounds, result['sounds_ms'] = timed(registry._load_sounds, table, SOUNDS)
+    result['sounds_peak_rss_kb'] = peak_rss_kb()
+    del _atlas, _sounds
+
+    registry.shared_registry.clear()
+    agent, result['agent_cold_ms'] = timed(Clippy)
+    result['agent_cold_peak_rss_kb'] = peak_rss_kb()
+    _second, result['agent_warm_ms'] = timed(Clippy)
+    result['agent_warm_peak_rss_kb'] = peak_rss_kb()
+    result['registry'] = registry.shared_registry.stats()
+    return result
+
+
+def bench_ticks(ticks):
+    """ Cost of a frame tick (Playback._next_frame and the update it requests), for every animation. """
+    app = application()  # noqa: F841
+    import random
+    from clippy_qt.agents import Clippy
+    from clippy_qt.playback import VirtualClock
+
+    agent = Clippy(clock=VirtualClock(), rng=random.Random(0))
+    agent.play_sounds = False
+    agent.show()
+    playback = agent.playback
+    per_animation = {}
+    total_time = 0.0
+    total_ticks = 0
+    for name in agent.animations():
+        elapsed = 0.0
+        done = 0
+        while done < ticks:
+            playback.play(name, right_now=True)
+            batch = 0
+            start = time.perf_counter()
+            while playback.is_playing() and batch < ticks - done:
+                playback._next_frame()
+                batch += 1
+            elapsed += time.perf_counter() - start
+            done += batch
+        per_animation[name] = elapsed / done * 1e9
+        total_time += elapsed
+        total_ticks += done
+    playback.stop(right_now=True)
+    return {'ns_per_tick': total_time / total_ticks * 1e9, 'ns_per_tick_by_animation': per_animation}
+
+
+def bench_agent_paint(repeats):
+    """ Cost of Agent.paintEvent, for every sprite of every animation. """
+    app = application()  # noqa: F841
+    from clippy_qt.agents import Clippy
+    from clippy_qt.playback import VirtualClock
+
+    agent = Clippy(clock=VirtualClock())
+    agent.play_sounds = False
+    agent.resize(agent.sizeHint())
+    paint = paint_into(agent)
+    playback = agent.playback
+    paints = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for name in agent.animations():
+            playback.play(name, right_now=True)
+            for frame in range(len(agent._animations[name])):
+                playback._current_frame = frame
+                paint()
+                paints += 1
+    elapsed = time.perf_counter() - start
+    playback.stop(right_now=True)
+    return {'us_per_paint': elapsed / paints * 1e6, 'paints': paints}
+
+
+def bench_balloon_paint(repeats, sizes):
+    """ Cost of Balloon.paintEvent at several sizes. """
+    app = application()  # noqa: F841
+    from clippy_qt.balloon import Balloon
+
+    results = {}
+    for width, height in sizes:
+        balloon = Balloon()
+        balloon.resize(width, height)
+        paint = paint_into(balloon)
+        paint()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            paint()
+        results['{}x{}'.format(width, height)] = (time.perf_counter() - start) / repeats * 1e6
+        balloon.deleteLater()
+    return {'us_per_paint_by_size': results}
+
+
+def bench_queue(calls):
+    """ Throughput of play() calls queued behind a playing animation. """
+    app = application()  # noqa: F841
+    from clippy_qt.agents import Clippy
+    from clippy_qt.playback import VirtualClock
+
+    agent = Clippy(clock=VirtualClock())
+    names = list(agent.animations())
+    agent.play('Processing')
+    start = time.perf_counter()
+    for i in range(calls):
+        agent.play(names[i % len(names)])
+    elapsed = time.perf_counter() - start
+    stats = agent.queue_stats()
+    agent.stop(right_now=True)
+    result = {'calls_per_second': calls / elapsed, 'us_per_call': elapsed / calls * 1e6}
+    result.update(('queue_' + key, value) for key, value in stats.items())
+    return result
+
+
+def bench_frame_runs(seeds):
+    """
+    Timer wake ups and repaints of every animation, played on a virtual clock until it ends (or for 60 s), before and
+    after collapsing frame runs and skipping repaints of unchanged sprites.
+    """
+    import random
+    from clippy_qt.animation import compile_animations
+    from clippy_qt.playback import Playback, VirtualClock
+
+    with open(CONFIG, 'r') as f:
+        config = json.load(f)
+
+    def play(table, name, seed):
+        clock = VirtualClock()
+        playback = Playback(table, clock, rng=random.Random(seed))
+        playback.idle_enabled = lambda: False
+        counts = {'wakeups': 0, 'repaints': 0, 'shown': None}
+
+        def frame_changed():
+            counts['wakeups'] += 1
+            sprite = playback.current_sprite()
+            if sprite != counts['shown']:
+                counts['shown'] = sprite
+                counts['repaints'] += 1
+        playback.on_frame = frame_changed
+        playback.play(name)
+        clock.run(limit=60000)
+        return counts['wakeups'], counts['repaints']
+
+    raw = compile_animations(config, collapse=False)
+    collapsed = compile_animations(config)
+    per_animation = {}
+    totals = {'frames': 0, 'collapsed_frames': 0, 'wakeups': 0, 'collapsed_wakeups': 0, 'repaints': 0,
+              'skipped_repaints': 0}
+    for name in raw.names():
+        result = {'frames': raw[name].frame_count, 'collapsed_frames': collapsed[name].frame_count,
+                  'wakeups': 0, 'collapsed_wakeups': 0, 'repaints': 0, 'skipped_repaints': 0}
+        for seed in range(seeds):
+            wakeups, _repaints = play(raw, name, seed)
+            collapsed_wakeups, repaints = play(collapsed, name, seed)
+            result['wakeups'] += wakeups
+            result['collapsed_wakeups'] += collapsed_wakeups
+            # Without skipping, every wake up repaints
+            result['repaints'] += wakeups
+            result['skipped_repaints'] += wakeups - repaints
+        per_animation[name] = result
+        for key in totals:
+            totals[key] += result[key]
+    totals['by_animation'] = per_animation
+    return totals
+
+
+def bench_idle(minutes, seeds):
+    """
+    Timer wake ups per minute of an agent left alone on a virtual clock: with idle animations at a fixed rate and
+    looping for ever, with the default idle policy, and with the timers suspended as when the agent is hidden.
+    """
+    import random
+    from clippy_qt.animation import compile_animations
+    from clippy_qt.idle import IdlePolicy
+    from clippy_qt.playback import Playback, VirtualClock
+
+    with open(CONFIG, 'r') as f:
+        table = compile_animations(json.load(f))
+
+    def wakeups_per_minute(policy, seed, suspended):
+        clock = VirtualClock()
+        playback = Playback(table, clock, rng=random.Random(seed), idle_policy=policy)
+        playback.play('Wave')
+        if suspended:
+            playback.suspend()
+        clock.run(limit=minutes * 60000)
+        return playback.power_stats()['wakeups_per_minute']
+
+    results = {}
+    for label, policy, suspended in (('fixed', lambda: IdlePolicy(backoff=1, max_duration=None), False),
+                                     ('backoff', IdlePolicy, False),
+                                     ('suspended', IdlePolicy, True)):
+        results['wakeups_per_minute_' + label] = sum(
+            wakeups_per_minute(policy(), seed, suspended) for seed in range(seeds)) / seeds
+    return results
+
+
+def bench_instrumentation(ticks, paints):
+    """ Cost of a timer tick and of an Agent paint, with the instrumentation disabled and enabled. """
+    app = application()  # noqa: F841
+    import random
+    from clippy_qt.agents import Clippy
+    from clippy_qt.instrumentation import Instrumentation
+    from clippy_qt.playback import VirtualClock
+
+    agent = Clippy(clock=VirtualClock(), rng=random.Random(0), power_saving=False)
+    agent.play_sounds = False
+    agent.resize(agent.sizeHint())
+    playback = agent.playback
+    paint = paint_into(agent)
+
+    def measure():
+        start = time.perf_counter()
+        done = 0
+        while done < ticks:
+            playback.play('Processing', right_now=True)
+            while playback.is_playing() and done < ticks:
+                # What the frame timer calls
+                playback._frame_timeout()
+                done += 1
+        tick_ns = (time.perf_counter() - start) / done * 1e9
+        start = time.perf_counter()
+        for _ in range(paints):
+            paint()
+        return tick_ns, (time.perf_counter() - start) / paints * 1e6
+
+    result = {}
+    result['ns_per_tick_disabled'], result['us_per_paint_disabled'] = measure()
+    agent.set_instrumentation(Instrumentation())
+    result['ns_per_tick_enabled'], result['us_per_paint_enabled'] = measure()
+    playback.stop(right_now=True)
+    return result
+
+
+def bench_tracking(points):
+    """
+    Cost of classifying a tracked point, and Look animations retargeted for a cursor wandering around the boundary
+    between two directions, without and with hysteresis.
+    """
+    app = application()
+    import math
+    import random
+    from PySide2 import QtCore
+    from clippy_qt.agents import Clippy
+    from clippy_qt.tracking import CursorTracker
+
+    agent = Clippy(rng=random.Random(0))
+    agent.play_sounds = False
+    agent.show()
+    app.processEvents()
+    center = agent.global_center()
+    rng = random.Random(0)
+    path = []
+    for _ in range(points):
+        # Within 8 degrees of the boundary between Left and DownLeft, 200 pixels away
+        angle = math.radians(22.5 + rng.uniform(-8, 8))
+        path.append(center + QtCore.QPoint(int(round(200 * math.cos(angle))), int(round(200 * math.sin(angle)))))
+
+    result = {}
+    start = time.perf_counter()
+    for point in path:
+        agent._get_direction(point)
+    result['us_per_direction'] = (time.perf_counter() - start) / points * 1e6
+    for label, hysteresis in (('no_hysteresis', 0), ('hysteresis', 10)):
+        tracker = CursorTracker(agent, hysteresis=hysteresis)
+        start = time.perf_counter()
+        for point in path:
+            # What every sample does, without waiting for the sampling timer
+            tracker._look_towards(point)
+        result['us_per_sample_' + label] = (time.perf_counter() - start) / points * 1e6
+        result['retargets_' + label] = tracker.retargets
+        agent.stop(right_now=True)
+    agent.hide()
+    return result
+
+
+BENCHMARKS = ('construction', 'ticks', 'agent_paint', 'balloon_paint', 'queue', 'frame_runs', 'idle',
+              'instrumentation', 'tracking')
+
+
+def run_benchmark(name, quick):
+    """ Run a single benchmark in this process. """
+    scale = 10 if quick else 1
+    if name == 'construction':
+        return bench_construction()
+    if name == 'ticks':
+        return bench_ticks(2000 // scale)
+    if name == 'agent_paint':
+        return bench_agent_paint(max(5 // scale, 1))
+    if name == 'balloon_paint':
+        return bench_balloon_paint(500 // scale, [(150, 80), (300, 200), (600, 400), (1200, 800)])
+    if name == 'queue':
+        return bench_queue(100000 // scale)
+    if name == 'frame_runs':
+        return bench_frame_runs(max(20 // scale, 1))
+    if name == 'idle':
+        return bench_idle(60, max(10 // scale, 1))
+    if name == 'instrumentation':
+        return bench_instrumentation(200000 // scale, 20000 // scale)
+    if name == 'tracking':
+        return bench_tracking(100000 // scale)
+    raise ValueError('Unknown benchmark {}'.format(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench_output.json'), help='Path of the JSON results')
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations, for a smoke test')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, help='Only run some benchmarks')
+    parser.add_argument('--child', choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_benchmark(args.child, args.quick)))
+        sys.stdout.flush()
+        # Skip interpreter teardown, some PySide2 builds crash while destroying the application
+        os._exit(0)
+
+    from PySide2 import __version__ as pyside_version
+
+    results = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'pyside2': pyside_version,
+            'platform': platform.platform(),
+            'qpa': os.environ['QT_QPA_PLATFORM'],
+            'quick': args.quick,
+        },
+    }
+    for name in args.only or BENCHMARKS:
+        # Every benchmark gets its own process, so memory and caches do not leak between them
+        command = [sys.executable, os.path.abspath(__file__), '--child', name]
+        if args.quick:
+            command.append('--quick')
+        output = subprocess.check_output(command)
+        results[name] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print('{:<14} done'.format(name))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,74 +1,543 @@
-""" Convert ClippyJS agent.js to ClippyQT config """
-import os
-import re
-import json
+"""
+Convert ClippyJS agents to ClippyQt agents.
+
+Usage: python convert_clippyJS_resources.py SOURCE [SOURCE ...] [--output agents] [--jobs N] [--decoder ffmpeg]
+
+A SOURCE is a ClippyJS agent directory (agent.js, map.png and sounds-ogg.js) or a directory of agent directories.
+Every agent is written to OUTPUT/<name> as config.json, map.png and sounds/*.wav, several agents at once in a process
+pool. Agents whose outputs are newer than their sources are skipped, unless --force is given.
+
+Sounds are decoded by a decoder backend: 'ffmpeg' pipes the compressed audio through ffmpeg, 'silent' writes silent
+clips without any external tool, for tests. Other backends are given as 'module:attribute', a callable returning an
+object with a decode(data) method returning wav bytes.
+"""
+import argparse
 import ast
 import base64
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# ffmpeg executable decoding the audio resources, looked up on the PATH unless FFMPEG is set
+FFMPEG_EXECUTABLE = os.getenv('FFMPEG', 'ffmpeg')
+
+AGENT_SOURCE = 'agent.js'
+SPRITE_SOURCE = 'map.png'
+SOUNDS_SOURCE = 'sounds-ogg.js'
+
+# Sources of the clippy_qt package, imported to build bundles
+SOURCE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+
+
+class ConversionError(Exception):
+    """ An agent could not be converted. """
+
+
+class FfmpegDecoder(object):
+    """
+    Decode audio with ffmpeg, streaming the compressed data in and the decoded samples out through pipes.
+
+    Parameters
+    ----------
+    executable : str
+    sample_rate : int
+    channels : int
+    """
+
+    def __init__(self, executable=None, sample_rate=44100, channels=1):
+        self.executable = executable or FFMPEG_EXECUTABLE
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    def decode(self, data):
+        """
+        Decode a compressed sound.
+
+        Parameters
+        ----------
+        data : bytes
+
+        Returns
+        -------
+        bytes
+            The sound as a 16 bits PCM wav file.
+        """
+        command = [self.executable, '-v', 'error', '-i', 'pipe:0', '-f', 's16le', '-acodec', 'pcm_s16le',
+                   '-ar', str(self.sample_rate), '-ac', str(self.channels), 'pipe:1']
+        try:
+            process = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as error:
+            raise ConversionError('Could not run {}: {}'.format(self.executable, error))
+        if process.returncode:
+            raise ConversionError('{} failed with return code {}: {}'.format(
+                self.executable, process.returncode, process.stderr.decode('utf-8', 'replace').strip()))
+        # Raw samples go through the pipe, the wav header is written here since ffmpeg cannot seek back to fill it
+        return pcm_to_wav(process.stdout, self.sample_rate, self.channels)
+
+
+class SilentDecoder(object):
+    """
+    Decode every sound to a silent clip, without any external tool.
+
+    Parameters
+    ----------
+    duration : int
+        Length of the clips, in milliseconds.
+    sample_rate : int
+    """
+
+    def __init__(self, duration=100, sample_rate=8000):
+        self.duration = duration
+        self.sample_rate = sample_rate
+
+    def decode(self, data):
+        frames = self.sample_rate * self.duration // 1000
+        return pcm_to_wav(b'\x00\x00' * frames, self.sample_rate, 1)
+
+
+DECODERS = {
+    'ffmpeg': FfmpegDecoder,
+    'silent': SilentDecoder,
+}
+
+
+def create_decoder(name):
+    """
+    Create a decoder backend.
+
+    Parameters
+    ----------
+    name : str
+        One of DECODERS, or 'module:attribute' naming a callable which returns a decoder.
+
+    Returns
+    -------
+    object
+        An object with a decode(data) method returning wav bytes.
+    """
+    if name in DECODERS:
+        return DECODERS[name]()
+    module_name, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError('Unknown decoder {!r}, use one of {} or module:attribute'.format(
+            name, ', '.join(sorted(DECODERS))))
+    return getattr(importlib.import_module(module_name), attribute)()
+
+
+def pcm_to_wav(samples, sample_rate, channels):
+    """ Wrap 16 bits PCM samples in a wav file, returned as bytes. """
+    stream = io.BytesIO()
+    writer = wave.open(stream, 'wb')
+    writer.setnchannels(channels)
+    writer.setsampwidth(2)
+    writer.setframerate(sample_rate)
+    writer.writeframes(samples)
+    writer.close()
+    return stream.getvalue()
+
+
+def png_size(path):
+    """ Return the width and height of a png image, read from its header. """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+        raise ConversionError('{} is not a png image'.format(path))
+    return struct.unpack('>II', header[16:24])
+
+
+def _read_js_payload(path, function):
+    """ Return the object literal passed to a clippy.<function>('<name>', {...}) call of a ClippyJS file. """
+    with open(path, 'r') as f:
+        raw = f.read().strip()
+    trim_head = re.sub(r"^clippy\.{}\('[\S]+', ".format(function), '', raw)
+    return re.sub(r"\);?$", '', trim_head)
+
+
+def sprite_index(frame, framesize, image_size):
+    """
+    Return the index of the sprite drawn by a ClippyJS frame, -1 if it draws nothing.
 
+    Raises
+    ------
+    ConversionError
+        If the frame's offsets are not on the sprite grid of the image, or out of it.
+    """
+    if 'images' not in frame:
+        return -1
+    sprite_width, sprite_height = framesize
+    image_width, image_height = image_size
+    x_offset, y_offset = frame['images'][0][:2]
+    if x_offset % sprite_width or y_offset % sprite_height:
+        raise ConversionError('offset {},{} is not a multiple of the frame size {}x{}'.format(
+            x_offset, y_offset, sprite_width, sprite_height))
+    if not (0 <= x_offset <= image_width - sprite_width and 0 <= y_offset <= image_height - sprite_height):
+        raise ConversionError('offset {},{} is outside of the {}x{} sprite sheet'.format(
+            x_offset, y_offset, image_width, image_height))
+    return (x_offset // sprite_width) + (y_offset // sprite_height) * (image_width // sprite_width)
 
-# Set this path to the directory containing the ffmpeg binary, used to convert audio resources
-FFMPEG_EXECUTABLE = r'C:\Users\herro\Downloads\ffmpeg-6.0-full_build\ffmpeg-6.0-full_build\bin\ffmpeg.exe'
 
+def validate_sprite_indices(config, image_size):
+    """
+    Check the spriteIndex of every frame of a converted config against its sprite sheet.
 
-def convert_clippy_js_config(source, target, image_width):
-    with open(source, 'r') as f:
-        raw = f.read()
+    Returns
+    -------
+    list of str
+        A description of every invalid frame, empty if they are all valid.
+    """
+    sprite_width, sprite_height = config['framesize']
+    sprite_count = (image_size[0] // sprite_width) * (image_size[1] // sprite_height)
+    errors = []
+    for animation_name, animation in sorted(config['animations'].items()):
+        for index, frame in enumerate(animation['frames']):
+            value = frame.get('spriteIndex')
+            if not isinstance(value, int) or isinstance(value, bool) or not -1 <= value < sprite_count:
+                errors.append('{} frame {}: spriteIndex {!r} is not in [-1, {})'.format(
+                    animation_name, index, value, sprite_count))
+    return errors
 
-    # Convert to json
-    trim_head = re.sub(r"^clippy\.ready\('[\S]+', ", '', raw)
-    trim_tail = re.sub(r"\);$", '', trim_head)
 
-    js_config = json.loads(trim_tail)
-    sprite_width = js_config['framesize'][0]
-    sprite_height = js_config['framesize'][1]
+def convert_clippy_js_config(source, target, image_width, image_height=None):
+    """
+    Convert a ClippyJS agent.js to a ClippyQt config.json.
 
+    Parameters
+    ----------
+    source : str
+    target : str
+    image_width : int
+        Width of the sprite sheet.
+    image_height : int
+        Height of the sprite sheet, to validate the sprites, defaults to as many rows as the offsets need.
+
+    Returns
+    -------
+    dict
+        The converted config.
+    """
+    js_config = json.loads(_read_js_payload(source, 'ready'))
+    framesize = js_config['framesize']
+    if image_height is None:
+        image_height = max([frame['images'][0][1] + framesize[1]
+                            for animation in js_config['animations'].values()
+                            for frame in animation['frames'] if 'images' in frame] + [0])
+
+    errors = []
     for animation_name, animation in js_config['animations'].items():
-        for frame in animation['frames']:
-            print(frame)
-            if 'images' in frame:
-                # We need to convert the x/y offseets in "images" to a spriteIndex
-                x_offset = frame['images'][0][0]
-                y_offset = frame['images'][0][1]
-                index = (x_offset // sprite_width) + (y_offset // sprite_height) * (image_width // sprite_width)
-                frame['spriteIndex'] = index
-                frame.pop('images')
-            else:
-                frame['spriteIndex'] = -1
+        for index, frame in enumerate(animation['frames']):
+            # Convert the x/y offsets in "images" to a spriteIndex
+            try:
+                frame['spriteIndex'] = sprite_index(frame, framesize, (image_width, image_height))
+            except ConversionError as error:
+                errors.append('{} frame {}: {}'.format(animation_name, index, error))
+                continue
+            frame.pop('images', None)
+    errors = errors or validate_sprite_indices(js_config, (image_width, image_height))
+    if errors:
+        raise ConversionError('Invalid sprites in {}:\n  {}'.format(source, '\n  '.join(errors)))
 
     with open(target, 'w') as f:
         json.dump(js_config, f, indent=4)
+    return js_config
 
 
-def convert_audio_resources(source, target):
-    """ Convert audio resources from ClippyJS (ogg stored in .js files) to .wav format compatible with QSound """
-    with open(source, 'r') as f:
-        raw = f.read()
-
-    # Convert to json
-    trim_head = re.sub(r"^clippy\.soundsReady\('[\S]+', ", '', raw)
-    trim_tail = re.sub(r"\);$", '', trim_head)
+def convert_audio_resources(source, target, decoder=None):
+    """
+    Convert audio resources from ClippyJS (ogg stored in .js files) to .wav files compatible with QSoundEffect.
 
-    js_sounds = ast.literal_eval(trim_tail)
+    Parameters
+    ----------
+    source : str
+        Path of the ClippyJS sounds file.
+    target : str
+        Directory to write the wav files to.
+    decoder : object
+        Decoder backend, defaults to FfmpegDecoder.
 
+    Returns
+    -------
+    list of str
+        Names of the converted sounds.
+    """
+    if decoder is None:
+        decoder = FfmpegDecoder()
+    js_sounds = ast.literal_eval(_read_js_payload(source, 'soundsReady'))
+    os.makedirs(target, exist_ok=True)
     for sound_name, sound in js_sounds.items():
-        # Sound is a binary string, write it out to a temporary file
-        temp_path = os.path.join(os.path.dirname(target), '{}.ogg'.format(sound_name))
-        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-        # Convert str to base 64
-        sound = sound.replace('data:audio/ogg;base64,', '')
-        sound_bytes = base64.b64decode(sound.encode("ascii"))
-        with open(temp_path, 'wb') as f:
-            f.write(sound_bytes)
-        # Convert to wav using ffmpeg
-        wav_path = os.path.join(os.path.dirname(target), '{}.wav'.format(sound_name))
-        ret = os.system('{} -i "{}" "{}"'.format(FFMPEG_EXECUTABLE, temp_path, wav_path))
-        print('Converted {} to wav with return code {}'.format(sound_name, ret))
-        # Remove the temp ogg file
-        os.remove(temp_path)
+        # Sounds are data urls, decode the base 64 payload whatever its mime type
+        sound_bytes = base64.b64decode(sound.split(',', 1)[-1].encode('ascii'))
+        wav_data = decoder.decode(sound_bytes)
+        with open(os.path.join(target, '{}.wav'.format(sound_name)), 'wb') as f:
+            f.write(wav_data)
+    return sorted(js_sounds)
+
+
+def find_agent_sources(paths):
+    """
+    Return the ClippyJS agent directories among paths and their immediate sub directories.
+
+    Returns
+    -------
+    list of str
+    """
+    agents = []
+    for path in paths:
+        if os.path.isfile(os.path.join(path, AGENT_SOURCE)):
+            agents.append(path)
+            continue
+        if not os.path.isdir(path):
+            raise ConversionError('{} is not a ClippyJS agent or a directory of agents'.format(path))
+        for entry in sorted(os.listdir(path)):
+            if os.path.isfile(os.path.join(path, entry, AGENT_SOURCE)):
+                agents.append(os.path.join(path, entry))
+    return agents
+
+
+def is_up_to_date(source_dir, target_dir):
+    """ Return whether every output of an agent exists and is newer than the agent's sources. """
+    sources = [os.path.join(source_dir, name) for name in (AGENT_SOURCE, SPRITE_SOURCE, SOUNDS_SOURCE)]
+    targets = [os.path.join(target_dir, 'config.json'), os.path.join(target_dir, 'map.png')]
+    if os.path.exists(sources[2]):
+        targets.append(os.path.join(target_dir, 'sounds'))
+    try:
+        oldest_target = min(os.path.getmtime(target) for target in targets)
+    except OSError:
+        return False
+    return all(oldest_target >= os.path.getmtime(source) for source in sources if os.path.exists(source))
+
+
+def _use_clippy_qt():
+    """ Make the clippy_qt package importable, once. """
+    if SOURCE_ROOT not in sys.path:
+        sys.path.insert(0, SOURCE_ROOT)
+
+
+def is_bundle_up_to_date(agent_dir):
+    """ Return whether the bundle of a converted agent exists and is newer than its config, sprite and sounds. """
+    _use_clippy_qt()
+    from clippy_qt.bundle import find_bundle
+
+    config = os.path.join(agent_dir, 'config.json')
+    return find_bundle(config, os.path.join(agent_dir, 'map.png')) is not None
+
+
+def convert_agent(source_dir, target_dir, decoder=None, force=False, bundle=False):
+    """
+    Convert a ClippyJS agent directory, safe to run in a worker process.
+
+    Parameters
+    ----------
+    source_dir : str
+    target_dir : str
+    decoder : object
+        Decoder backend, see convert_audio_resources().
+    force : bool
+        Convert even if the outputs are up to date.
+    bundle : bool
+        Pack the converted agent into a bundle as well. Agents skipped because they are up to date are still
+        bundled when their bundle is missing or older than them.
+
+    Returns
+    -------
+    dict
+        'name', 'skipped', 'bundled', 'animations', 'sounds' and 'seconds' of the conversion.
+    """
+    name = os.path.basename(os.path.normpath(source_dir))
+    result = {'name': name, 'skipped': False, 'bundled': False, 'animations': 0, 'sounds': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+    if not force and is_up_to_date(source_dir, target_dir):
+        result['skipped'] = True
+        if bundle and not is_bundle_up_to_date(target_dir):
+            build_agent_bundle(target_dir, verbose=False)
+            result['bundled'] = True
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    os.makedirs(target_dir, exist_ok=True)
+    sprite = os.path.join(source_dir, SPRITE_SOURCE)
+    if not os.path.isfile(sprite):
+        raise ConversionError('{} has no {}'.format(source_dir, SPRITE_SOURCE))
+    image_width, image_height = png_size(sprite)
+
+    # The sprite sheet is written last: it marks the agent as converted, see is_up_to_date()
+    config = convert_clippy_js_config(os.path.join(source_dir, AGENT_SOURCE), os.path.join(target_dir, 'config.json'),
+                                      image_width, image_height)
+    result['animations'] = len(config['animations'])
+    sounds = os.path.join(source_dir, SOUNDS_SOURCE)
+    if os.path.exists(sounds):
+        sounds_dir = os.path.join(target_dir, 'sounds')
+        result['sounds'] = len(convert_audio_resources(sounds, sounds_dir, decoder))
+        # Overwriting wav files does not touch the directory
+        os.utime(sounds_dir)
+    shutil.copyfile(sprite, os.path.join(target_dir, 'map.png'))
+    if bundle:
+        build_agent_bundle(target_dir, verbose=False)
+        result['bundled'] = True
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def convert_agents(sources, output, decoder=None, jobs=None, force=False, bundle=False, report=None):
+    """
+    Convert several ClippyJS agents concurrently.
+
+    Parameters
+    ----------
+    sources : list of str
+        ClippyJS agent directories.
+    output : str
+        Directory to write the agents to, one sub directory per agent.
+    decoder : object
+        Decoder backend, must be picklable to be sent to the worker processes.
+    jobs : int
+        Number of worker processes, defaults to the number of CPUs. 1 converts in this process.
+    force : bool
+    bundle : bool
+    report : callable
+        Called with the result of every agent (see convert_agent()), or with its name and the exception it failed
+        with, as soon as it is done.
+
+    Returns
+    -------
+    int
+        Number of agents which failed to convert.
+    """
+    if report is None:
+        def report(result, error=None):
+            pass
+    tasks = [(source, os.path.join(output, os.path.basename(os.path.normpath(source)))) for source in sources]
+    failures = 0
+    if jobs == 1 or len(tasks) < 2:
+        for source, target in tasks:
+            try:
+                report(convert_agent(source, target, decoder, force, bundle))
+            except Exception as error:
+                failures += 1
+                report({'name': os.path.basename(target)}, error)
+        return failures
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = dict((pool.submit(convert_agent, source, target, decoder, force, bundle), os.path.basename(target))
+                       for source, target in tasks)
+        for future in as_completed(futures):
+            try:
+                report(future.result())
+            except Exception as error:
+                failures += 1
+                report({'name': futures[future]}, error)
+    return failures
+
+
+def build_agent_bundle(agent_dir, target=None, verbose=True):
+    """
+    Pack a converted agent (config.json, map.png and sounds/*.wav) into a single memory mappable bundle.
+
+    Parameters
+    ----------
+    agent_dir : str
+        Directory of the converted agent.
+    target : str
+        Path of the bundle to write, defaults to the bundle name agents look for next to their config.json.
+    verbose : bool
+        Print the bundle written.
+
+    Returns
+    -------
+    str
+        Path of the written bundle.
+    """
+    _use_clippy_qt()
+    from PySide2 import QtGui
+    from clippy_qt.animation import compile_animations
+    from clippy_qt.bundle import BUNDLE_NAME, write_bundle
+
+    with open(os.path.join(agent_dir, 'config.json'), 'r') as f:
+        table = compile_animations(json.load(f))
+    atlas = QtGui.QImage(os.path.join(agent_dir, 'map.png'))
+    if atlas.isNull():
+        raise IOError('Could not read the sprite sheet of {}'.format(agent_dir))
+
+    sounds = {}
+    sounds_dir = os.path.join(agent_dir, 'sounds')
+    if os.path.isdir(sounds_dir):
+        for wav_file in os.listdir(sounds_dir):
+            sound_name, ext = os.path.splitext(wav_file)
+            if ext == '.wav':
+                with open(os.path.join(sounds_dir, wav_file), 'rb') as f:
+                    sounds[sound_name] = f.read()
+
+    if target is None:
+        target = os.path.join(agent_dir, BUNDLE_NAME)
+    write_bundle(target, table, atlas, sounds)
+    if verbose:
+        print('Wrote bundle {} ({} animations, {} sounds)'.format(target, len(table), len(sounds)))
+    return target
+
+
+def _print_result(result, error=None):
+    if error is not None:
+        print('{:<20} failed: {}'.format(result['name'], error))
+    elif result['skipped']:
+        print('{:<20} up to date{}'.format(result['name'], ', bundled' if result['bundled'] else ''))
+    else:
+        print('{:<20} {} animations, {} sounds{} in {:.2f}s'.format(
+            result['name'], result['animations'], result['sounds'], ', bundled' if result['bundled'] else '',
+            result['seconds']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sources', nargs='*', metavar='SOURCE',
+                        help='ClippyJS agent directory, or directory of agent directories')
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agents'),
+                        help='Directory to write the converted agents to, defaults to ./agents')
+    parser.add_argument('--jobs', '-j', type=int, help='Number of agents converted at once, defaults to the CPU count')
+    parser.add_argument('--decoder', default='ffmpeg',
+                        help="Audio decoder: {} or module:attribute".format(', '.join(sorted(DECODERS))))
+    parser.add_argument('--force', action='store_true', help='Convert agents even if they are up to date')
+    parser.add_argument('--bundles', action='store_true', help='Pack every converted agent into a bundle as well')
+    parser.add_argument('--bundle', metavar='AGENT_DIR',
+                        help='Pack an already converted agent directory into a precompiled bundle')
+    parser.add_argument('--bundle-output', help='Path of the bundle to write, defaults to AGENT_DIR/agent.cqb')
+    args = parser.parse_args(argv)
+
+    if args.bundle:
+        build_agent_bundle(args.bundle, args.bundle_output)
+        return 0
+    if not args.sources:
+        parser.error('give at least one SOURCE, or --bundle')
+
+    try:
+        decoder = create_decoder(args.decoder)
+        sources = find_agent_sources(args.sources)
+    except (ConversionError, ValueError, ImportError, AttributeError) as error:
+        parser.error(str(error))
+    if not sources:
+        parser.error('no ClippyJS agent found in {}'.format(', '.join(args.sources)))
+
+    skipped = []
+
+    def report(result, error=None):
+        if error is None and result['skipped']:
+            skipped.append(result['name'])
+        _print_result(result, error)
+
+    start = time.perf_counter()
+    failures = convert_agents(sources, args.output, decoder, args.jobs, args.force, args.bundles, report)
+    print('{} agents in {:.2f}s: {} converted, {} up to date, {} failed'.format(
+        len(sources), time.perf_counter() - start, len(sources) - len(skipped) - failures, len(skipped), failures))
+    return 1 if failures else 0
 
 
 if __name__ == '__main__':
-    # convert_clippy_js_config(r'C:\Users\herro\repos\ClippyQt\agents\Clippy.js',
-    #                          r'C:\Users\herro\repos\ClippyQt\agents\Clippy\config.json', 3348)
-    convert_audio_resources(r'C:\Users\herro\Downloads\sounds-ogg.js',
-                            r'C:\Users\herro\repos\ClippyQt\agents\Clippy\sounds')
+    sys.exit(main())
@@ -1,281 +1,567 @@
-import os
-import math
-from collections import deque
+import time
+import warnings
+from functools import partial
 
-from PySide2 import QtCore, QtGui, QtWidgets, QtMultimedia
-import random
-import json
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from clippy_qt.commands import CommandChannel
+from clippy_qt.instrumentation import AGENT_PAINT
+from clippy_qt.playback import Playback
+from clippy_qt.registry import shared_registry
+from clippy_qt.scheduler import LOCAL_CLOCK
+from clippy_qt.sound import default_mixer
+from clippy_qt.sprites import RENDER_ATLAS
+from clippy_qt.tracking import COARSE_DIRECTIONS, GRANULAR_DIRECTIONS, CursorTracker, direction_of
+
+
+def _check_scale(scale):
+    """ Return a display scale, raising a ValueError unless it is positive. """
+    if not scale > 0:
+        raise ValueError('scale must be positive, not {}'.format(scale))
+    return scale
 
 
 class Agent(QtWidgets.QWidget):
+    """
+    An animated agent.
+
+    The widget is a view over a clippy_qt.playback.Playback, which holds the animation state machine.
+
+    Parameters
+    ----------
+    config : str
+        Path to the agent's config.json. An up to date bundle next to it is used instead when there is one, a path to
+        a bundle can also be given directly (see clippy_qt.bundle).
+    sprite : str
+        Path to the agent's sprite sheet, may be None when config is a bundle
+    sounds : str
+        Path to the directory containing the agent's sounds, or None to disable sounds
+    parent : QtWidgets.QWidget
+    render_mode : str
+        How frames are drawn from the sprite sheet, one of the RENDER_* modes of clippy_qt.sprites.
+        The default draws straight from the atlas without slicing it into tiles.
+    registry : clippy_qt.registry.AssetRegistry
+        Registry to get the agent's resources from, defaults to the process wide shared registry.
+    asynchronous : bool
+        If True, load the resources on a thread pool instead of blocking the GUI thread. The agent is blank until
+        they are loaded and the ready signal is emitted, animations played before that are queued until then. If
+        they cannot be loaded, the failed signal is emitted instead and the queued animations are discarded.
+    clock : clippy_qt.scheduler.LocalClock or clippy_qt.scheduler.AnimationScheduler
+        Clock driving the agent's timers. Defaults to timers owned by the agent, pass
+        clippy_qt.scheduler.global_scheduler() to share a single clock between many agents.
+    catch_up : bool
+        If True, keep animations in step with the clock when the event loop stalls: frames whose time has already
+        passed are skipped (following branches and exit branches as usual) and their sounds are not played. Late
+        ticks and skipped frames are counted, see timing_stats().
+    rng : random.Random
+        Random generator for branching and idle animations, seed one to make the agent deterministic.
+    queue : clippy_qt.animation_queue.AnimationQueue
+        Queue of the animations waiting to play, to configure its depth, drop policy and coalescing. Defaults to a
+        bounded queue where only the latest Look* and Gesture* requests wait.
+    interrupt : bool
+        If True, stop() and activate() make the animation jump straight onto its shortest exit path, so the agent
+        responds quickly even during long looping animations. See stop_latency().
+    max_stop_latency : int
+        In interrupt mode, the longest an animation may keep playing once asked to stop, in milliseconds.
+    mixer : clippy_qt.sound.SoundMixer
+        Mixer to play the sounds on, to limit the voices or play silently. Defaults to the process wide mixer shared
+        by all agents, created (and QtMultimedia imported) when the first sound plays.
+    scale : float
+        Display scale of the agent. Frames are smooth scaled once, at the resolution of the screen (devicePixelRatio
+        included), into a cache shared with the agents of the same scale, see set_scale().
+    idle_policy : clippy_qt.idle.IdlePolicy
+        When to play idle animations and which ones. Defaults to backing off exponentially while the user is away.
+    power_saving : bool
+        If True, suspend the agent's timers while it cannot be seen: hidden, in a minimized or unexposed window, or
+        while the application is inactive. Animations with a callback still play through, see Playback.suspend().
+        See power_stats().
+    """
 
     started = QtCore.Signal()
     stopped = QtCore.Signal()
-
-    def __init__(self, config, sprite, sounds, parent=None):
+    ready = QtCore.Signal()
+    # Animation name and reason, when a queued animation is dropped
+    dropped = QtCore.Signal(str, str)
+    # Sprite index, when the sprite to display changes
+    sprite_changed = QtCore.Signal(int)
+    # Callback of an animation discarded by stop() before it played, the callback is not called
+    discarded = QtCore.Signal(object)
+    # Exception raised while loading the resources asynchronously
+    failed = QtCore.Signal(object)
+    # Callback and KeyError of an animation played while the resources loaded, which the agent turned out not to have
+    rejected = QtCore.Signal(object, object)
+
+    def __init__(self, config, sprite, sounds, parent=None, render_mode=RENDER_ATLAS, registry=None,
+                 asynchronous=False, clock=None, catch_up=False, rng=None, queue=None,
+                 interrupt=False, max_stop_latency=None, mixer=None, scale=1.0, idle_policy=None, power_saving=True):
         super(Agent, self).__init__(parent)
 
         # public properties
-        self.play_sounds = True
-
-        # Animation resources
-        with open(config, 'r') as f:
-            self._config = json.load(f)
-        self._sprite = sprite
-        self._sounds = {}
-
-        self._stopping = False
-
-        # Animation and callback queue:
-        self._queue = deque()
-        self._current_callback = None
+        self.play_sounds = bool(sounds)
+
+        # Animation resources, shared with the other agents using the same files
+        self._assets = None
+        self._animations = None
+        self._sounds = ()
+        self._mixer = mixer
+        # play() calls made before the resources are loaded
+        self._pending = []
+        # Why the resources could not be loaded asynchronously
+        self._load_error = None
 
         # Tile properties
-        self._frames = []
-        self._tile_width = self._config['framesize'][0]
-        self._tile_height = self._config['framesize'][1]
-
-        # Animation state
-        self._current_animation = None
-        self._current_frame = 0
-        self._frame_rate = 1000 / 24
-        self._playing = False
-        self._looping = False
-
-        self._timer = QtCore.QTimer(self)
-        self._idle_timer = QtCore.QTimer(self)
-
-        self._load_frames()
-        self._preload_sounds(sounds)
+        self._render_mode = render_mode
+        self._sprites = None
+        self._tile_width = 0
+        self._tile_height = 0
+        self._scale = _check_scale(scale)
+        # Scaled frames for the current scale and device pixel ratio, None when drawing at 1:1
+        self._scaled_sprites = None
+        # Sprite index of the last repaint requested, repaints are skipped while it does not change
+        self._shown_sprite = None
+        # Measurements, see set_instrumentation()
+        self._instrumentation = None
+
+        self._clock = clock if clock is not None else LOCAL_CLOCK
+        self._playback = Playback(None, self._clock, rng=rng, catch_up=catch_up, timer_parent=self, queue=queue,
+                                  interrupt=interrupt, max_stop_latency=max_stop_latency, idle_policy=idle_policy)
+
+        # Window and window handle watched for state and exposure changes, in power saving mode
+        self._power_saving = power_saving
+        self._watched_window = None
+        self._watched_handle = None
+        # Created by the first follow_cursor() or track() call
+        self._tracker = None
+
         self.init_ui()
 
+        if registry is None:
+            registry = shared_registry
+        if asynchronous:
+            request = registry.acquire_async(config, sprite, sounds, self._set_assets,
+                                             error_callback=self._load_failed)
+            self.destroyed.connect(request.cancel)
+        else:
+            assets = registry.acquire(config, sprite, sounds)
+            self.destroyed.connect(partial(registry.release, assets))
+            self._set_assets(assets)
+
     def init_ui(self):
         """ Initialize the widget """
-        self._timer.timeout.connect(self._next_frame)
-        self._timer.setSingleShot(True)
-
-        self._idle_timer.timeout.connect(self.play_random_idle)
-        self._idle_timer.setSingleShot(True)
+        self._playback.on_started = self.started.emit
+        self._playback.on_stopped = self.stopped.emit
+        self._playback.on_frame = self._frame_changed
+        self._playback.on_sound = self._play_sound
+        self._playback.on_dropped = self.dropped.emit
+        self._playback.on_discarded = self.discarded.emit
+        # Commands from other threads, see clippy_qt.commands
+        self.commands = CommandChannel(self, parent=self)
+        self._playback.idle_enabled = self.isVisible
+        QtGui.QGuiApplication.instance().applicationStateChanged.connect(self._update_power_state)
+        self._update_power_state()
+
+    @property
+    def playback(self):
+        """ The animation state machine driving this agent. """
+        return self._playback
+
+    @property
+    def power_saving(self):
+        """ Whether the timers are suspended while the agent cannot be seen, see the power_saving parameter. """
+        return self._power_saving
+
+    @power_saving.setter
+    def power_saving(self, enabled):
+        self._power_saving = bool(enabled)
+        self._update_power_state()
+
+    def is_ready(self):
+        """ Return True once the agent's resources are loaded. """
+        return self._assets is not None
+
+    def load_error(self):
+        """ Return the exception raised while loading the resources asynchronously, None unless it failed. """
+        return self._load_error
 
     def animations(self):
-        """ Return a list of available animations. """
-        return self._config['animations'].keys()
+        """ Return a list of available animations, empty until the agent is ready. """
+        if self._animations is None:
+            return []
+        return self._animations.names()
 
-    def play(self, animation, right_now=False, callback=None):
+    def play(self, animation, right_now=False, callback=None, priority=0):
         """
         Play an animation, optionally with a callback when the animation is done.
 
         Parameters
         ----------
         animation : str
-            Name of the animation to play
+            Name of the animation to play. KeyError is raised if the agent has no such animation, or once the resources
+            are loaded for animations played before, with the rejected signal.
         right_now : bool
             If True, play the animation immediately, discarding the current animation and the queue.
             If False, add the animation to the queue.
         callback : callable
             Function to call when the animation is done. Use a lambda or partial if it needs arguments.
+            If the animation is dropped from the queue instead, the callback is called when it is dropped.
+        priority : int
+            Queued animations of higher priority play first, and are the last to be dropped when the queue is full.
         """
-        self.activate()
-        if right_now:
-            self.stop(right_now=True)
-        if not self._playing:
-            self._play(animation, callback)
-        else:
-            self._queue.append((animation, callback))
+        if self._assets is None:
+            if self._load_error is not None:
+                # Will never play
+                if callback is not None:
+                    self.discarded.emit(callback)
+                return
+            self._pending.append((animation, right_now, callback, priority))
+            return
+        self._playback.play(animation, right_now=right_now, callback=callback, priority=priority)
 
     def play_random_idle(self):
         """ Play a random idle animation. """
-        idle_animations = [name for name in self._config['animations'] if name.startswith('Idle')]
-        anim = random.choice(idle_animations)
-        self.play(anim)
+        self._playback.play_random_idle()
 
-    def gesture_at(self, position):
+    def gesture_at(self, position, callback=None):
         """
         Gesture towards a position on the screen
 
         Parameters
         ----------
         position : QtCore.QPoint
+        callback : callable
+            Function to call when the gesture is done, see play().
         """
         self.activate()
         direction = self._get_direction(position, granular=False)
         gesture = 'Gesture{}'.format(direction)
-        self.play(gesture)
+        self.play(gesture, callback=callback)
 
-    def look_at(self, position):
+    def look_at(self, position, callback=None):
         """
         Look towards a position on the screen
 
         Parameters
         ----------
         position : QtCore.QPoint
+        callback : callable
+            Function to call when the look is done, see play().
         """
         self.activate()
         direction = self._get_direction(position)
         look = 'Look{}'.format(direction)
-        self.play(look)
+        self.play(look, callback=callback)
 
-    def activate(self):
+    def tracker(self):
         """
-        Get out of idle mode.
+        Return the tracker keeping the agent looking towards the cursor, see clippy_qt.tracking.
+
+        Returns
+        -------
+        clippy_qt.tracking.CursorTracker
         """
-        self._idle_timer.stop()
-        if self._playing:
-            self._stopping = True
+        if self._tracker is None:
+            self._tracker = CursorTracker(self, parent=self)
+        return self._tracker
 
-    def _next_frame(self):
-        """ Advance to the next frame in the current animation. """
-        if self._current_animation is None:
-            return
+    def follow_cursor(self, enabled=True, rate=None):
+        """
+        Keep looking towards the cursor, retargeting only when it moves to another direction.
 
-        current_frame = self._current_animation['frames'][self._current_frame]
-
-        if self._stopping and current_frame.get('exitBranch', False):
-            next_frame = current_frame['exitBranch']
-        elif current_frame.get('branching', False):
-            # Pick a random branch based on the weights of each possible branch
-            random_roll = random.randint(0, 99)
-            for branch in current_frame['branching']['branches']:
-                if random_roll < branch['weight']:
-                    next_frame = branch['frameIndex']
-                    break
-                random_roll -= branch['weight']
-            else:
-                next_frame = self._current_frame + 1
-        else:
-            next_frame = self._current_frame + 1
+        Parameters
+        ----------
+        enabled : bool
+        rate : float
+            Cursor samples per second, leave None to keep the tracker's rate (10 by default).
+        """
+        tracker = self.tracker()
+        if rate is not None:
+            tracker.set_rate(rate)
+        tracker.follow_cursor(enabled)
 
-        if next_frame >= len(self._current_animation['frames']):
-            if self._looping:
-                self._current_frame = 0
-            else:
-                self._stop()
-                return
-        else:
-            self._current_frame = next_frame
+    def track(self, position):
+        """
+        Look towards one point of a stream, see CursorTracker.track(). Unlike look_at(), only the points moving to
+        another direction play an animation, and the points are throttled to the tracker's rate.
 
-        self._queue_next_frame()
-        self._play_sound()
-        self.update()
+        Parameters
+        ----------
+        position : QtCore.QPoint
+            In global coordinates.
+        """
+        self.tracker().track(position)
+
+    def activate(self):
+        """
+        Get out of idle mode.
+        """
+        self._playback.activate()
 
     def stop(self, right_now=False):
         """ stop the current animation and clear the queue."""
-        self._queue.clear()
+        pending, self._pending = self._pending, []
+        for _animation, _right_now, callback, _priority in pending:
+            if callback is not None:
+                self.discarded.emit(callback)
+        self._playback.stop(right_now=right_now)
+
+    def stop_latency(self, animation):
+        """
+        Return the worst case time an animation keeps playing once asked to stop, see Playback.stop_latency().
 
-        if not right_now and self._playing:
-            self._stopping = True
+        Parameters
+        ----------
+        animation : str
+
+        Returns
+        -------
+        float
+            Milliseconds, infinity if the animation can loop forever while stopping.
+        """
+        return self._playback.stop_latency(animation)
+
+    def queue_stats(self):
+        """
+        Return the queue depth and drop counters, see AnimationQueue.stats().
+
+        Returns
+        -------
+        dict
+        """
+        return self._playback.queue_stats()
+
+    def timing_stats(self):
+        """
+        Return the frame timing counters, see Playback.timing_stats().
+
+        Returns
+        -------
+        dict
+        """
+        return self._playback.timing_stats()
+
+    def reset_timing_stats(self):
+        """ Reset the frame timing counters. """
+        self._playback.reset_timing_stats()
+
+    def instrumentation(self):
+        """ Return the instrumentation recording the agent's timings, or None. """
+        return self._instrumentation
+
+    def set_instrumentation(self, instrumentation):
+        """
+        Record frame lateness, paint durations, queue waits and animation durations.
+
+        Parameters
+        ----------
+        instrumentation : clippy_qt.instrumentation.Instrumentation
+            None stops recording.
+        """
+        self._instrumentation = instrumentation
+        self._playback.instrumentation = instrumentation
+
+    def power_stats(self):
+        """
+        Return the timer wake up counters, see Playback.power_stats().
+
+        Returns
+        -------
+        dict
+        """
+        return self._playback.power_stats()
+
+    def reset_power_stats(self):
+        """ Reset the timer wake up counters. """
+        self._playback.reset_power_stats()
+
+    def is_exposed(self):
+        """ Return True if the agent can be seen: shown in an exposed, unminimized window of an active application. """
+        if not self.isVisible():
+            return False
+        window = self.window()
+        if window.isMinimized():
+            return False
+        handle = window.windowHandle()
+        if handle is not None and not handle.isExposed():
+            return False
+        return QtGui.QGuiApplication.applicationState() == QtCore.Qt.ApplicationActive
+
+    def _update_power_state(self):
+        """ Suspend the timers while the agent cannot be seen, resume them when it can. """
+        exposed = self.is_exposed()
+        if self._tracker is not None and exposed:
+            self._tracker.wake()
+        if exposed or not self._power_saving:
+            self._playback.resume()
+        else:
+            self._playback.suspend()
+
+    def _watch_window(self):
+        """ Watch the agent's window for minimizing, and its native window for exposure changes. """
+        window = self.window()
+        handle = window.windowHandle()
+        if window is self._watched_window and handle is self._watched_handle:
             return
-        if right_now:
-            self._current_callback = None  # Cancel the current callback
-        self._stop()
-
-    def _stop(self):
-        """ Fully stop the animation and emit the stopped signal. """
-        self._playing = False
-        self._stopping = False
-        self._current_animation = None
-        self._current_frame = 0
+        for watched in (self._watched_window, self._watched_handle):
+            if watched is not None and watched is not self:
+                watched.removeEventFilter(self)
+        self._watched_window = window
+        self._watched_handle = handle
+        for watched in (window, handle):
+            if watched is not None and watched is not self:
+                watched.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        if event.type() in (QtCore.QEvent.WindowStateChange, QtCore.QEvent.Expose) and (
+                watched is self._watched_window or watched is self._watched_handle):
+            self._update_power_state()
+        return super(Agent, self).eventFilter(watched, event)
+
+    def showEvent(self, event):
+        super(Agent, self).showEvent(event)
+        self._watch_window()
+        self._update_power_state()
+
+    def hideEvent(self, event):
+        super(Agent, self).hideEvent(event)
+        self._update_power_state()
+
+    def changeEvent(self, event):
+        # Minimizing the agent's own window, when it is a top level one
+        if event.type() == QtCore.QEvent.WindowStateChange:
+            self._update_power_state()
+        super(Agent, self).changeEvent(event)
+
+    def _set_assets(self, assets):
+        """ Start using loaded resources, and play what was queued while they were loading. """
+        self._assets = assets
+        self._animations = assets.animations
+        self._sounds = assets.sounds
+        self._sprites = assets.sprite_sheet(self._render_mode)
+        self._tile_width, self._tile_height = self._animations.framesize
+        self._playback.set_animations(self._animations)
+        self.updateGeometry()
+        self._shown_sprite = self._playback.current_sprite()
         self.update()
-        self.stopped.emit()
-        if self._current_callback:
-            self._current_callback()
-            self._current_callback = None
-        if self.isVisible():
-            self._idle_timer.start(random.randint(5000, 15000))
-        if self._queue:
-            self._play_next_in_queue()
-
-    def _play(self, animation, callback=None):
-        """ Play an animation and call the callback when done. """
-        self._current_animation = self._config['animations'][animation]
-        self._current_callback = callback
-        self._current_frame = 0
-        self._playing = True
-        self.started.emit()
-        self._queue_next_frame()
+        self.sprite_changed.emit(self._shown_sprite)
+        self.ready.emit()
+        pending, self._pending = self._pending, []
+        for animation, right_now, callback, priority in pending:
+            try:
+                self.play(animation, right_now=right_now, callback=callback, priority=priority)
+            except KeyError as error:
+                # Nobody is left to catch it, the caller of play() returned long ago
+                warnings.warn('Could not play {}: {}'.format(animation, error))
+                self.rejected.emit(callback, error)
+
+    def _load_failed(self, error):
+        """ Give up on the resources, and discard what was queued while they were loading. """
+        self._load_error = error
+        warnings.warn('Could not load the agent resources: {}'.format(error))
+        self.failed.emit(error)
+        pending, self._pending = self._pending, []
+        for _animation, _right_now, callback, _priority in pending:
+            if callback is not None:
+                self.discarded.emit(callback)
+
+    def _frame_changed(self):
+        """ Repaint, unless the new frame shows the sprite already on screen. """
+        sprite = self._playback.current_sprite()
+        if sprite == self._shown_sprite:
+            return
+        self._shown_sprite = sprite
         self.update()
+        self.sprite_changed.emit(sprite)
 
-    def _play_next_in_queue(self):
-        """ Play the next animation in the queue. """
-        animation, callback = self._queue.popleft()
-        self._play(animation, callback=callback)
-
-    def _queue_next_frame(self):
-        """ Queue the next frame in the animation. """
-        self._timer.start(self._current_animation['frames'][self._current_frame]['duration'])
-
-    def _load_frames(self):
-        """ Load the frames from the sprite sheet. """
-        self._frames = []
-        pixmap = QtGui.QPixmap(self._sprite)
-        columns = pixmap.width() // self._tile_width
-        rows = pixmap.height() // self._tile_height
-        for i in range(rows):
-            for j in range(columns):
-                frame = pixmap.copy(j * self._tile_width, i * self._tile_height, self._tile_width, self._tile_height)
-                self._frames.append(frame)
-
-    def _preload_sounds(self, sounds):
-        """ Preload the sounds. """
-        if not sounds:
-            self.play_sounds = False
+    def scale(self):
+        """ Return the display scale of the agent. """
+        return self._scale
+
+    def set_scale(self, scale):
+        """
+        Change the display scale of the agent.
+
+        The frames scaled for the previous scale are released, and the new ones are scaled as they are displayed.
+
+        Parameters
+        ----------
+        scale : float
+        """
+        scale = _check_scale(scale)
+        if scale == self._scale:
             return
-        for wav_file in os.listdir(sounds):
-            sound_name, ext = os.path.splitext(wav_file)
-            if ext != '.wav':
-                continue
-            self._sounds[sound_name] = QtMultimedia.QSound(os.path.join(sounds, wav_file))
-
-    def _play_sound(self):
-        """ Play a sound if the current frame has one. """
+        self._scale = scale
+        self._scaled_sprites = None
+        self.updateGeometry()
+        self.adjustSize()
+        self.update()
+
+    def _sprite_sheet(self):
+        """ Return the sprite sheet to draw with, scaled for the current scale and screen. """
+        device_pixel_ratio = self.devicePixelRatioF()
+        if self._scale == 1.0 and device_pixel_ratio == 1.0:
+            return self._sprites
+        scaled = self._scaled_sprites
+        if scaled is None or scaled.device_pixel_ratio != device_pixel_ratio:
+            # Moved to a screen of another pixel density, or the scale changed
+            scaled = self._scaled_sprites = self._sprites.scaled(self._scale, device_pixel_ratio)
+        return scaled
+
+    def shape_mask(self):
+        """
+        Return the opaque area of the sprite displayed, in widget coordinates.
+
+        Returns
+        -------
+        QtGui.QRegion
+            Empty while the resources are loading.
+        """
+        if self._sprites is None:
+            return QtGui.QRegion()
+        return self._sprite_sheet().mask(self._playback.current_sprite())
+
+    def _play_sound(self, sound_id):
+        """ Play a sound of the current animation. """
         if not self.play_sounds:
             return
-        if 'sound' in self._current_animation['frames'][self._current_frame]:
-            sound_name = self._current_animation['frames'][self._current_frame]['sound']
-            self._sounds[sound_name].play()
+        sound = self._sounds[sound_id]
+        if sound is None:
+            return
+        if self._mixer is None:
+            self._mixer = default_mixer()
+        self._mixer.play(sound)
+
+    def global_center(self):
+        """
+        Return the center of the agent, in global coordinates.
+
+        It is mapped on every call rather than cached: any ancestor of the agent may have moved since the last one.
+
+        Returns
+        -------
+        QtCore.QPoint
+        """
+        return self.mapToGlobal(self.rect().center())
 
     def _get_direction(self, position, granular=True):
         """ Get a direction based on a position on the screen. """
-        direction = position - self.mapToGlobal(self.rect().center())
-        angle = (180 * math.atan2(direction.y(), direction.x())) / math.pi
-        if granular:
-            if -22.5 < angle <= 22.5:
-                return 'Left'
-            elif 22.5 < angle <= 67.5:
-                return 'DownLeft'
-            elif 67.5 < angle <= 112.5:
-                return 'Down'
-            elif 112.5 < angle <= 157.5:
-                return 'DownRight'
-            elif 157.5 < angle <= 180 or -180 <= angle <= -157.5:
-                return 'Right'
-            elif -157.5 < angle <= -112.5:
-                return 'UpRight'
-            elif -112.5 < angle <= -67.5:
-                return 'Up'
-            elif -67.5 < angle <= -22.5:
-                return 'UpLeft'
-        else:
-            if -45 < angle <= 45:
-                return 'Left'
-            elif 45 < angle <= 135:
-                return 'Down'
-            elif 135 < angle <= 180 or -180 <= angle <= -135:
-                return 'Right'
-            elif -135 < angle <= -45:
-                return 'Up'
+        delta = position - self.global_center()
+        return direction_of(delta.x(), delta.y(), GRANULAR_DIRECTIONS if granular else COARSE_DIRECTIONS)
 
     def paintEvent(self, _event):
         """ Draw the current frame."""
 
+        if self._sprites is None:
+            # Still loading, stay blank
+            return
+        instrumentation = self._instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
         painter = QtGui.QPainter(self)
-        if not self._current_animation:
-            target_frame = 0
-        else:
-            target_frame = self._current_animation['frames'][self._current_frame]['spriteIndex']
-        painter.drawPixmap(0, 0, self._frames[target_frame])
+        self._sprite_sheet().draw(painter, 0, 0, self._playback.current_sprite())
         painter.end()
+        if instrumentation is not None:
+            instrumentation.record(AGENT_PAINT, (time.perf_counter() - start) * 1000)
 
     def sizeHint(self):
         """ Return the size hint for the widget. """
-        return QtCore.QSize(self._tile_width, self._tile_height)
+        return QtCore.QSize(int(round(self._tile_width * self._scale)), int(round(self._tile_height * self._scale)))
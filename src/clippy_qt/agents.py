@@ -1,15 +1,317 @@
+"""
+Agents shipped with ClippyQt, and discovery of the agents installed under AGENTS_ROOT.
+
+Every directory of AGENTS_ROOT holding a config.json (or a bundle, see clippy_qt.bundle) is an agent, named after the
+directory. Listing agents only reads a small manifest per agent: its frame size, animation names and categories and
+sound names. Manifests are cached next to the agent's files and rebuilt when the config, sprite sheet or bundle is
+more recent, so the cost of listing agents does not depend on the size of their assets. The assets themselves are
+only loaded when an agent is created.
+"""
+import json
 import os
+import threading
+
 from clippy_qt.agent import Agent
+from clippy_qt.animation import animation_category
+from clippy_qt.bundle import BUNDLE_NAME
 
 
 AGENTS_ROOT = os.getenv('CLIPPY_QT_AGENTS',
                         os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'agents')))
 
+CONFIG_NAME = 'config.json'
+SPRITE_NAME = 'map.png'
+SOUNDS_NAME = 'sounds'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+class AgentManifest(object):
+    """
+    What an agent offers, without its assets.
+
+    Attributes
+    ----------
+    name : str
+    directory : str
+    framesize : tuple of int
+        Width and height of the agent's frames.
+    animations : tuple of str
+        Animation names, sorted.
+    categories : dict
+        Category name to the sorted tuple of its animation names, see clippy_qt.animation.animation_category().
+    sounds : tuple of str
+        Sound names, as referred to by the animation frames.
+    """
+
+    def __init__(self, name, directory, framesize, animations, sounds, sources):
+        self.name = name
+        self.directory = directory
+        self.framesize = tuple(framesize)
+        self.animations = tuple(sorted(animations))
+        self.sounds = tuple(sounds)
+        categories = {}
+        for animation in self.animations:
+            categories.setdefault(animation_category(animation), []).append(animation)
+        self.categories = dict((category, tuple(names)) for category, names in categories.items())
+        # Modification time of the files the manifest was built from, by file name
+        self._sources = sources
+
+    def __repr__(self):
+        return '{}({!r}, {} animations)'.format(type(self).__name__, self.name, len(self.animations))
+
+    @property
+    def config(self):
+        """ Path of the agent's config.json, or of its bundle when it only ships a bundle. """
+        config = os.path.join(self.directory, CONFIG_NAME)
+        if CONFIG_NAME in self._sources or BUNDLE_NAME not in self._sources:
+            return config
+        return os.path.join(self.directory, BUNDLE_NAME)
+
+    @property
+    def sprite(self):
+        """ Path of the agent's sprite sheet. """
+        return os.path.join(self.directory, SPRITE_NAME)
+
+    @property
+    def sound_directory(self):
+        """ Path of the agent's directory of wav files, None if it has none. """
+        path = os.path.join(self.directory, SOUNDS_NAME)
+        return path if os.path.isdir(path) else None
+
+    def is_current(self):
+        """ Return whether the files the manifest was built from are unchanged. """
+        return _source_times(self.directory) == self._sources
+
+    def to_json(self):
+        return {
+            'version': MANIFEST_VERSION,
+            'framesize': list(self.framesize),
+            'animations': list(self.animations),
+            'sounds': list(self.sounds),
+            'sources': self._sources,
+        }
+
+    @classmethod
+    def from_json(cls, name, directory, data):
+        return cls(name, directory, data['framesize'], data['animations'], data['sounds'], data['sources'])
+
+
+def _source_times(directory):
+    """ Return the modification time of the files an agent's manifest is built from, by file name. """
+    times = {}
+    for source in (CONFIG_NAME, SPRITE_NAME, BUNDLE_NAME):
+        try:
+            times[source] = os.path.getmtime(os.path.join(directory, source))
+        except OSError:
+            pass
+    return times
+
+
+def _is_agent_directory(directory):
+    return os.path.isfile(os.path.join(directory, CONFIG_NAME)) or os.path.isfile(os.path.join(directory, BUNDLE_NAME))
+
+
+def build_manifest(name, directory):
+    """
+    Build the manifest of an agent from its config.json, or from its bundle when it has no config.
+
+    Parameters
+    ----------
+    name : str
+    directory : str
+
+    Returns
+    -------
+    AgentManifest
+    """
+    sources = _source_times(directory)
+    if CONFIG_NAME in sources:
+        with open(os.path.join(directory, CONFIG_NAME), 'r') as f:
+            config = json.load(f)
+        framesize = config['framesize']
+        animations = list(config['animations'])
+        sounds = config.get('sounds', [])
+    else:
+        from clippy_qt.bundle import Bundle
+
+        table = Bundle(os.path.join(directory, BUNDLE_NAME)).animations
+        framesize = table.framesize
+        animations = table.names()
+        sounds = table.sounds
+    return AgentManifest(name, directory, framesize, animations, sounds, sources)
+
+
+def read_manifest(name, directory):
+    """
+    Return the manifest of an agent, from its cache file if it is up to date, building and caching it otherwise.
+
+    The cache is skipped silently when the agent's directory is read only.
+
+    Parameters
+    ----------
+    name : str
+    directory : str
+
+    Returns
+    -------
+    AgentManifest
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        data = None
+    if data is not None and data.get('version') == MANIFEST_VERSION:
+        try:
+            manifest = AgentManifest.from_json(name, directory, data)
+        except (KeyError, TypeError):
+            manifest = None
+        if manifest is not None and manifest.is_current():
+            return manifest
+
+    manifest = build_manifest(name, directory)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, 'w') as f:
+            json.dump(manifest.to_json(), f, indent=1)
+        os.replace(temporary, path)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return manifest
+
+
+class AgentCatalog(object):
+    """
+    The agents installed in a directory, see the module's documentation.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding a sub directory per agent, defaults to AGENTS_ROOT.
+    """
+
+    def __init__(self, root=None):
+        self.root = root if root is not None else AGENTS_ROOT
+        self._lock = threading.Lock()
+        self._names = None
+        self._manifests = {}
+
+    def names(self):
+        """
+        Return the names of the agents, scanning the root directory on first use.
+
+        Returns
+        -------
+        list of str
+        """
+        with self._lock:
+            if self._names is None:
+                try:
+                    entries = os.listdir(self.root)
+                except OSError:
+                    entries = []
+                self._names = sorted(entry for entry in entries
+                                     if _is_agent_directory(os.path.join(self.root, entry)))
+            return list(self._names)
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def manifest(self, name):
+        """
+        Return the manifest of an agent, rebuilt if the agent's files changed since it was last read.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        AgentManifest
+
+        Raises
+        ------
+        KeyError
+            If there is no such agent.
+        """
+        with self._lock:
+            manifest = self._manifests.get(name)
+            if manifest is not None and manifest.is_current():
+                return manifest
+            directory = os.path.join(self.root, name)
+            if not _is_agent_directory(directory):
+                raise KeyError('No agent named {!r} in {}'.format(name, self.root))
+            manifest = self._manifests[name] = read_manifest(name, directory)
+            return manifest
+
+    def manifests(self):
+        """ Return the manifest of every agent, by name. """
+        return dict((name, self.manifest(name)) for name in self.names())
+
+    def create(self, name, parent=None, **kwargs):
+        """
+        Create an agent, loading its assets.
+
+        Parameters
+        ----------
+        name : str
+        parent : QtWidgets.QWidget
+        kwargs
+            Passed on to Agent.
+
+        Returns
+        -------
+        clippy_qt.agent.Agent
+        """
+        manifest = self.manifest(name)
+        return Agent(manifest.config, manifest.sprite, manifest.sound_directory, parent=parent, **kwargs)
+
+    def refresh(self):
+        """ Forget the agents found so far, the next call scans the root directory again. """
+        with self._lock:
+            self._names = None
+            self._manifests.clear()
+
+
+_catalogs = {}
+
+
+def agent_catalog(root=None):
+    """
+    Return the process wide catalog of a directory.
+
+    Parameters
+    ----------
+    root : str
+        Defaults to AGENTS_ROOT.
+
+    Returns
+    -------
+    AgentCatalog
+    """
+    root = os.path.abspath(root if root is not None else AGENTS_ROOT)
+    catalog = _catalogs.get(root)
+    if catalog is None:
+        catalog = _catalogs.setdefault(root, AgentCatalog(root))
+    return catalog
+
+
+def available_agents():
+    """ Return the names of the agents installed under AGENTS_ROOT. """
+    return agent_catalog().names()
+
+
+def create_agent(name, parent=None, **kwargs):
+    """ Create one of the agents installed under AGENTS_ROOT, see AgentCatalog.create(). """
+    return agent_catalog().create(name, parent=parent, **kwargs)
+
 
 class Clippy(Agent):
     """ Good old Clippy, our Superstar! """
-    def __init__(self):
-        config_path = os.path.join(AGENTS_ROOT, 'Clippy', 'config.json')
-        sprite_path = os.path.join(AGENTS_ROOT, 'Clippy', 'map.png')
-        sounds_path = os.path.join(AGENTS_ROOT, 'Clippy', 'sounds')
-        super(Clippy, self).__init__(config_path, sprite_path, sounds_path)
+    def __init__(self, parent=None, **kwargs):
+        manifest = agent_catalog().manifest('Clippy')
+        super(Clippy, self).__init__(manifest.config, manifest.sprite, manifest.sound_directory, parent=parent,
+                                     **kwargs)
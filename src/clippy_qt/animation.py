@@ -0,0 +1,518 @@
+""" Compile agent configs into compact, index based animation tables. """
+import heapq
+from array import array
+from bisect import bisect_right
+from types import MappingProxyType
+
+
+# Sentinel used in the compiled arrays when a frame has no sound or no exit branch
+NO_SOUND = -1
+NO_BRANCH = -1
+
+# Animations are grouped by the prefix of their name, the others are actions
+IDLE_CATEGORY = 'Idle'
+ANIMATION_CATEGORIES = (IDLE_CATEGORY, 'Look', 'Gesture')
+ACTION_CATEGORY = 'Action'
+
+
+def animation_category(name):
+    """
+    Return the category of an animation, from its name.
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    str
+        One of ANIMATION_CATEGORIES, or ACTION_CATEGORY.
+    """
+    for category in ANIMATION_CATEGORIES:
+        if name.startswith(category):
+            return category
+    return ACTION_CATEGORY
+
+
+class BranchTable(object):
+    """
+    Weighted branches of a single frame, with the weights precomputed as a cumulative table.
+
+    Rolling a number between 0 and 99 and bisecting the cumulative weights gives the same result as walking the
+    branches and subtracting their weights one at a time, which is what ClippyJS does.
+    """
+
+    __slots__ = ('cumulative_weights', 'targets')
+
+    def __init__(self, branches):
+        total = 0
+        cumulative = []
+        targets = []
+        for branch in branches:
+            total += branch['weight']
+            cumulative.append(total)
+            targets.append(branch['frameIndex'])
+        self.cumulative_weights = tuple(cumulative)
+        self.targets = tuple(targets)
+
+    @classmethod
+    def from_cumulative(cls, cumulative_weights, targets):
+        """
+        Build a branch table from weights which are already cumulative.
+
+        Parameters
+        ----------
+        cumulative_weights : list of int
+        targets : list of int
+
+        Returns
+        -------
+        BranchTable
+        """
+        table = cls(())
+        table.cumulative_weights = tuple(cumulative_weights)
+        table.targets = tuple(targets)
+        return table
+
+    def pick(self, roll):
+        """
+        Pick a branch for a given roll.
+
+        Parameters
+        ----------
+        roll : int
+            Random number between 0 and 99.
+
+        Returns
+        -------
+        int
+            Frame index to jump to, or NO_BRANCH if the roll did not pick any branch.
+        """
+        index = bisect_right(self.cumulative_weights, roll)
+        if index < len(self.targets):
+            return self.targets[index]
+        return NO_BRANCH
+
+
+class CompiledAnimation(object):
+    """
+    A single animation stored as parallel arrays, one entry per frame.
+
+    The arrays are read only memoryviews, compiled tables are shared between agents and must not change.
+
+    Attributes
+    ----------
+    name : str
+    durations : memoryview
+        Duration of each frame, in milliseconds.
+    sprites : memoryview
+        Sprite index of each frame in the agent's atlas.
+    sounds : memoryview
+        Index of the sound to play on each frame in AnimationTable.sounds, or NO_SOUND.
+    exit_branches : memoryview
+        Frame to jump to when the animation is stopping, or NO_BRANCH.
+    branches : tuple
+        BranchTable for each frame, or None when the frame does not branch.
+    source_frames : memoryview
+        Index in the config of the first frame each frame was compiled from, see collapse_frame_runs().
+    frame_count : int
+    """
+
+    __slots__ = ('name', 'durations', 'sprites', 'sounds', 'exit_branches', 'branches', 'source_frames', 'frame_count',
+                 '_exit_index')
+
+    def __init__(self, name, durations, sprites, sounds, exit_branches, branches, source_frames=None):
+        self.name = name
+        self.durations = _read_only(durations)
+        self.sprites = _read_only(sprites)
+        self.sounds = _read_only(sounds)
+        self.exit_branches = _read_only(exit_branches)
+        self.branches = tuple(branches)
+        if source_frames is None:
+            source_frames = array('i', range(len(durations)))
+        self.source_frames = _read_only(source_frames)
+        self.frame_count = len(durations)
+        self._exit_index = None
+
+    @property
+    def exit_index(self):
+        """ The ExitIndex of this animation, computed on first use. """
+        if self._exit_index is None:
+            self._exit_index = ExitIndex(self)
+        return self._exit_index
+
+    def __len__(self):
+        return self.frame_count
+
+    def __repr__(self):
+        return '<CompiledAnimation {} ({} frames)>'.format(self.name, self.frame_count)
+
+
+class ExitIndex(object):
+    """
+    Shortest way out of an animation from each of its frames.
+
+    Frames can move on to their exit branch, to any of their branches, or to the next frame in order. Dijkstra's
+    algorithm over these moves, weighted by the frame durations, gives the quickest path from every frame to the end
+    of the animation. Interrupting an animation follows that path instead of waiting for the random branches to reach
+    an exit branch.
+
+    Attributes
+    ----------
+    next_frames : array
+        Next frame on the shortest exit path of each frame, the frame count when the animation ends after it.
+    latencies : array
+        Time from the start of each frame to the end of the animation along the shortest exit path, in milliseconds.
+    """
+
+    def __init__(self, animation):
+        frame_count = animation.frame_count
+        durations = animation.durations
+        # Reversed moves, the end of the animation is node frame_count
+        predecessors = [[] for _ in range(frame_count + 1)]
+        for frame in range(frame_count):
+            for target in _interrupt_moves(animation, frame):
+                predecessors[min(target, frame_count)].append(frame)
+
+        unreached = float('inf')
+        latencies = [unreached] * (frame_count + 1)
+        next_frames = [frame_count] * (frame_count + 1)
+        latencies[frame_count] = 0
+        heap = [(0, frame_count)]
+        while heap:
+            latency, node = heapq.heappop(heap)
+            if latency > latencies[node]:
+                continue
+            for frame in predecessors[node]:
+                candidate = latency + durations[frame]
+                if candidate < latencies[frame]:
+                    latencies[frame] = candidate
+                    next_frames[frame] = node
+                    heapq.heappush(heap, (candidate, frame))
+
+        # The next frame in order is always a move, every frame reaches the end
+        self.next_frames = array('i', next_frames[:frame_count])
+        self.latencies = array('i', latencies[:frame_count])
+        self._animation = animation
+        self._natural_latency = None
+
+    def interrupt_target(self, frame, max_stop_latency=None):
+        """
+        Return the frame to jump to when interrupting an animation.
+
+        Parameters
+        ----------
+        frame : int
+            Frame displayed when the interruption happens, it is cut short.
+        max_stop_latency : int
+            Skip frames of the exit path until the rest of the path fits in this many milliseconds.
+
+        Returns
+        -------
+        int
+            The frame to display, the frame count if the animation should end right away.
+        """
+        frame_count = self._animation.frame_count
+        frame = self.next_frames[frame]
+        if max_stop_latency is not None:
+            while frame < frame_count and self.latencies[frame] > max_stop_latency:
+                frame = self.next_frames[frame]
+        return frame
+
+    def interrupt_latency(self, max_stop_latency=None):
+        """
+        Return the worst case time an interrupted animation keeps playing, in milliseconds.
+
+        Parameters
+        ----------
+        max_stop_latency : int
+
+        Returns
+        -------
+        int
+        """
+        frame_count = self._animation.frame_count
+        worst = 0
+        for frame in range(frame_count):
+            target = self.interrupt_target(frame, max_stop_latency)
+            if target < frame_count:
+                worst = max(worst, self.latencies[target])
+        return worst
+
+    def natural_latency(self):
+        """
+        Return the worst case time an animation keeps playing once asked to stop without interrupting it.
+
+        Stopping follows exit branches, and otherwise keeps playing the animation with its random branches, so loops
+        make the worst case unbounded.
+
+        Returns
+        -------
+        float
+            Milliseconds, infinity if a loop can be reached while stopping.
+        """
+        if self._natural_latency is None:
+            self._natural_latency = _longest_stopping_path(self._animation)
+        return self._natural_latency
+
+
+def _interrupt_moves(animation, frame):
+    """ Return the frames an interrupted animation may move to from a frame. """
+    moves = {frame + 1}
+    exit_branch = animation.exit_branches[frame]
+    if exit_branch != NO_BRANCH:
+        moves.add(exit_branch)
+    branches = animation.branches[frame]
+    if branches is not None:
+        moves.update(branches.targets)
+    return moves
+
+
+def _stopping_moves(animation, frame):
+    """ Return the frames an animation asked to stop may move to from a frame, following the rules of Playback. """
+    exit_branch = animation.exit_branches[frame]
+    if exit_branch != NO_BRANCH:
+        return (exit_branch,)
+    branches = animation.branches[frame]
+    if branches is None:
+        return (frame + 1,)
+    moves = []
+    previous = 0
+    for weight, target in zip(branches.cumulative_weights, branches.targets):
+        if weight > previous:
+            moves.append(target)
+        previous = weight
+    if previous < 100:
+        moves.append(frame + 1)
+    return moves
+
+
+def _longest_stopping_path(animation):
+    """ Return the longest time from the start of any frame to the end, while stopping, infinity on loops. """
+    frame_count = animation.frame_count
+    longest = {}
+    visiting = set()
+
+    for start in range(frame_count):
+        if start in longest:
+            continue
+        # Iterative depth first search, the paths are as long as the animations
+        stack = [(start, iter(_stopping_moves(animation, start)))]
+        visiting.add(start)
+        while stack:
+            frame, moves = stack[-1]
+            for target in moves:
+                if target >= frame_count or target in longest:
+                    continue
+                if target in visiting:
+                    # Any loop is unbounded for the frames on it
+                    return float('inf')
+                visiting.add(target)
+                stack.append((target, iter(_stopping_moves(animation, target))))
+                break
+            else:
+                stack.pop()
+                visiting.discard(frame)
+                rest = [longest[target] if target < frame_count else 0 for target in _stopping_moves(animation, frame)]
+                longest[frame] = animation.durations[frame] + max(rest)
+    return max(longest.values()) if longest else 0
+
+
+class AnimationTable(object):
+    """
+    All the animations of an agent, compiled once at load time.
+
+    Attributes
+    ----------
+    framesize : tuple
+        Width and height of a single sprite tile.
+    sounds : tuple
+        Sound names, indexed by the sound ids of the compiled animations.
+    animations : MappingProxyType
+        Read only mapping of animation name to CompiledAnimation.
+    """
+
+    def __init__(self, framesize, sounds, animations):
+        self.framesize = tuple(framesize)
+        self.sounds = tuple(sounds)
+        self.animations = MappingProxyType(dict(animations))
+        # Animation names by category, indexed on first use
+        self._categories = None
+
+    def __getitem__(self, name):
+        return self.animations[name]
+
+    def __contains__(self, name):
+        return name in self.animations
+
+    def __len__(self):
+        return len(self.animations)
+
+    def names(self):
+        """ Return the names of the animations, in config order. """
+        return self.animations.keys()
+
+    def category(self, category):
+        """
+        Return the names of the animations of a category, see animation_category().
+
+        Parameters
+        ----------
+        category : str
+
+        Returns
+        -------
+        tuple of str
+            In config order, empty for an unknown category.
+        """
+        if self._categories is None:
+            categories = {}
+            for name in self.animations:
+                categories.setdefault(animation_category(name), []).append(name)
+            self._categories = dict((key, tuple(names)) for key, names in categories.items())
+        return self._categories.get(category, ())
+
+
+def _read_only(values):
+    """ Return a read only view of an array. """
+    if isinstance(values, memoryview):
+        return values.toreadonly()
+    return memoryview(values).toreadonly()
+
+
+def compile_animation(name, animation, sound_ids):
+    """
+    Compile a single animation from its config dict.
+
+    Parameters
+    ----------
+    name : str
+    animation : dict
+        The animation as found in config.json, with a 'frames' list.
+    sound_ids : dict
+        Mapping of sound name to sound id. Unknown sounds are added to it.
+
+    Returns
+    -------
+    CompiledAnimation
+    """
+    frames = animation['frames']
+    durations = array('i')
+    sprites = array('i')
+    sounds = array('i')
+    exit_branches = array('i')
+    branches = []
+    for frame in frames:
+        durations.append(frame['duration'])
+        sprites.append(frame.get('spriteIndex', -1))
+        sound = frame.get('sound')
+        if sound is None:
+            sounds.append(NO_SOUND)
+        else:
+            sounds.append(sound_ids.setdefault(sound, len(sound_ids)))
+        exit_branch = frame.get('exitBranch')
+        # exitBranch 0 is falsy, and was never honoured by the dict based player, keep it that way
+        exit_branches.append(exit_branch if exit_branch else NO_BRANCH)
+        branching = frame.get('branching')
+        branches.append(BranchTable(branching['branches']) if branching else None)
+    return CompiledAnimation(name, durations, sprites, sounds, exit_branches, branches)
+
+
+def collapse_frame_runs(animation):
+    """
+    Merge runs of consecutive frames showing the same sprite into single, longer frames.
+
+    A frame merges into the previous one when it shows the same sprite, has no sound, and is not the target of any
+    branch or exit branch, as long as the previous frame does not branch nor has an exit branch itself. The merged
+    frame keeps the sound of the first frame of the run and the branches of the last one, so the animation plays
+    exactly the same with fewer timer wake ups. Branch targets are remapped to the merged frame indices, and the
+    source_frames of the merged frames keep the first original frame of their run.
+
+    Parameters
+    ----------
+    animation : CompiledAnimation
+
+    Returns
+    -------
+    CompiledAnimation
+        The animation itself when no frames could be merged.
+    """
+    frame_count = animation.frame_count
+    targets = set(frame for frame in animation.exit_branches if frame != NO_BRANCH)
+    for branches in animation.branches:
+        if branches is not None:
+            targets.update(branches.targets)
+
+    # Index of the merged frame each original frame belongs to, and the original frames starting a merged one
+    merged_index = []
+    starts = []
+    for frame in range(frame_count):
+        previous = frame - 1
+        if (starts and animation.sprites[frame] == animation.sprites[previous]
+                and animation.sounds[frame] == NO_SOUND and frame not in targets
+                and animation.exit_branches[previous] == NO_BRANCH and animation.branches[previous] is None):
+            merged_index.append(len(starts) - 1)
+        else:
+            merged_index.append(len(starts))
+            starts.append(frame)
+    if len(starts) == frame_count:
+        return animation
+
+    merged_count = len(starts)
+
+    def remap(target):
+        if target == NO_BRANCH:
+            return NO_BRANCH
+        if target >= frame_count:
+            # Past the end of the animation, which keeps ending it
+            return merged_count + target - frame_count
+        return merged_index[target]
+
+    durations = array('i')
+    sprites = array('i')
+    sounds = array('i')
+    exit_branches = array('i')
+    source_frames = array('i')
+    branches = []
+    for start, end in zip(starts, starts[1:] + [frame_count]):
+        last = end - 1
+        durations.append(sum(animation.durations[start:end]))
+        source_frames.append(animation.source_frames[start])
+        sprites.append(animation.sprites[start])
+        sounds.append(animation.sounds[start])
+        exit_branches.append(remap(animation.exit_branches[last]))
+        last_branches = animation.branches[last]
+        if last_branches is None:
+            branches.append(None)
+        else:
+            branches.append(BranchTable.from_cumulative(last_branches.cumulative_weights,
+                                                        [remap(target) for target in last_branches.targets]))
+    return CompiledAnimation(animation.name, durations, sprites, sounds, exit_branches, branches, source_frames)
+
+
+def compile_animations(config, collapse=True):
+    """
+    Compile the animations section of an agent config into an AnimationTable.
+
+    Parameters
+    ----------
+    config : dict
+        Parsed config.json of an agent.
+    collapse : bool
+        If True, merge the runs of frames showing the same sprite, see collapse_frame_runs(). Frame indices of the
+        compiled animations then no longer match the ones of the config, source_frames maps them back.
+
+    Returns
+    -------
+    AnimationTable
+    """
+    sound_ids = {}
+    for sound in config.get('sounds', ()):
+        sound_ids.setdefault(sound, len(sound_ids))
+    animations = {}
+    for name, animation in config['animations'].items():
+        animations[name] = compile_animation(name, animation, sound_ids)
+        if collapse:
+            animations[name] = collapse_frame_runs(animations[name])
+    sounds = sorted(sound_ids, key=sound_ids.get)
+    return AnimationTable(config['framesize'], sounds, animations)
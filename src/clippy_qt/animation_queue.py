@@ -0,0 +1,242 @@
+"""
+Bounded, priority aware queue of the animations waiting to play.
+
+Requests are ordered by priority, then by arrival. Requests which supersede each other, like the Look* animations
+played while following the cursor, are coalesced so only the latest one waits in the queue. When the queue is full,
+the lowest priority request is dropped, the oldest or the newest one depending on the drop policy.
+
+The queue only decides what gets dropped, Playback resolves the callbacks of the dropped requests.
+"""
+import bisect
+
+# When the queue is full, drop the oldest of the lowest priority requests.
+DROP_OLDEST = 'oldest'
+# When the queue is full, drop the newest of the lowest priority requests, usually the one being added.
+DROP_NEWEST = 'newest'
+
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+# Reasons a request was dropped for
+DROPPED_OVERFLOW = 'overflow'
+DROPPED_COALESCED = 'coalesced'
+
+# Animations of these families supersede each other, only the latest request of each family is kept.
+COALESCE_PREFIXES = ('Look', 'Gesture')
+
+
+class AnimationRequest(object):
+    """
+    An animation waiting to play.
+
+    Attributes
+    ----------
+    animation : str
+    callback : callable or None
+    priority : int
+    sequence : int
+        Arrival order, breaks ties between requests of the same priority.
+    key : str or None
+        Requests with the same key coalesce, None never coalesces.
+    queued_at : float or None
+        Time the request was queued at, in milliseconds, if the caller gave it.
+    """
+
+    __slots__ = ('animation', 'callback', 'priority', 'sequence', 'key', 'queued_at')
+
+    def __init__(self, animation, callback, priority, sequence, key, queued_at=None):
+        self.animation = animation
+        self.callback = callback
+        self.priority = priority
+        self.sequence = sequence
+        self.key = key
+        self.queued_at = queued_at
+
+    def sort_key(self):
+        # Highest priority first, then first come first served
+        return -self.priority, self.sequence
+
+    def __repr__(self):
+        return '{}({!r}, priority={})'.format(type(self).__name__, self.animation, self.priority)
+
+
+class AnimationQueue(object):
+    """
+    Queue of animation requests, see the module's documentation.
+
+    Parameters
+    ----------
+    max_depth : int
+        Maximum number of requests waiting, None for an unbounded queue.
+    drop_policy : str
+        DROP_OLDEST or DROP_NEWEST, which request to drop when the queue is full.
+    coalesce_prefixes : sequence of str
+        Families of animations which supersede each other: a request for an animation whose name starts with one of
+        them replaces the request of the same family already waiting, keeping its place in the queue.
+    coalesce_duplicates : bool
+        If True, a request for an animation which is already waiting replaces it as well.
+
+    Attributes
+    ----------
+    dropped : dict
+        Number of dropped requests, by reason.
+    max_depth_seen : int
+        Highest number of requests that waited at once.
+    """
+
+    def __init__(self, max_depth=32, drop_policy=DROP_OLDEST, coalesce_prefixes=COALESCE_PREFIXES,
+                 coalesce_duplicates=False):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('drop_policy must be one of {}, not {!r}'.format(', '.join(DROP_POLICIES), drop_policy))
+        if max_depth is not None and max_depth < 1:
+            raise ValueError('max_depth must be at least 1, not {}'.format(max_depth))
+        self.max_depth = max_depth
+        self.drop_policy = drop_policy
+        self.coalesce_prefixes = tuple(coalesce_prefixes)
+        self.coalesce_duplicates = coalesce_duplicates
+
+        self.dropped = {DROPPED_OVERFLOW: 0, DROPPED_COALESCED: 0}
+        self.max_depth_seen = 0
+
+        # Requests in play order, and their sort keys for bisecting
+        self._requests = []
+        self._keys = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __bool__(self):
+        return bool(self._requests)
+
+    def __iter__(self):
+        return iter(self._requests)
+
+    def coalesce_key(self, animation):
+        """
+        Return the key under which requests for an animation coalesce.
+
+        Parameters
+        ----------
+        animation : str
+
+        Returns
+        -------
+        str or None
+        """
+        for prefix in self.coalesce_prefixes:
+            if animation.startswith(prefix):
+                return prefix
+        if self.coalesce_duplicates:
+            return animation
+        return None
+
+    def push(self, animation, callback=None, priority=0, queued_at=None):
+        """
+        Add a request to the queue.
+
+        Parameters
+        ----------
+        animation : str
+        callback : callable
+        priority : int
+            Higher priorities play first.
+        queued_at : float
+            Time of the request, to measure how long it waits.
+
+        Returns
+        -------
+        list of tuple
+            The requests dropped to make room, or replaced, as (AnimationRequest, reason) tuples. The new request
+            itself is in there if it did not make it into the queue.
+        """
+        self._sequence += 1
+        request = AnimationRequest(animation, callback, priority, self._sequence, self.coalesce_key(animation),
+                                   queued_at)
+        dropped = []
+
+        if request.key is not None:
+            for index, queued in enumerate(self._requests):
+                if queued.key == request.key and queued.priority == request.priority:
+                    # The latest request wins, in the place of the one it supersedes
+                    request.sequence = queued.sequence
+                    self._requests[index] = request
+                    dropped.append((queued, DROPPED_COALESCED))
+                    self.dropped[DROPPED_COALESCED] += 1
+                    return dropped
+
+        self._insert(request)
+        if self.max_depth is not None and len(self._requests) > self.max_depth:
+            victim = self._pick_victim()
+            self._remove(victim)
+            dropped.append((victim, DROPPED_OVERFLOW))
+            self.dropped[DROPPED_OVERFLOW] += 1
+        self.max_depth_seen = max(self.max_depth_seen, len(self._requests))
+        return dropped
+
+    def pop(self):
+        """
+        Remove and return the next request to play.
+
+        Returns
+        -------
+        AnimationRequest
+        """
+        del self._keys[0]
+        return self._requests.pop(0)
+
+    def clear(self):
+        """
+        Remove every request, without resolving them.
+
+        Returns
+        -------
+        list of AnimationRequest
+            The removed requests.
+        """
+        requests = self._requests
+        self._requests = []
+        del self._keys[:]
+        return requests
+
+    def stats(self):
+        """
+        Return the queue counters.
+
+        Returns
+        -------
+        dict
+            depth: requests waiting. max_depth_seen: highest depth reached. dropped_overflow: requests dropped because
+            the queue was full. dropped_coalesced: requests replaced by a later one.
+        """
+        return {
+            'depth': len(self._requests),
+            'max_depth_seen': self.max_depth_seen,
+            'dropped_overflow': self.dropped[DROPPED_OVERFLOW],
+            'dropped_coalesced': self.dropped[DROPPED_COALESCED],
+        }
+
+    def reset_stats(self):
+        """ Reset the drop counters and the highest depth. """
+        for reason in self.dropped:
+            self.dropped[reason] = 0
+        self.max_depth_seen = len(self._requests)
+
+    def _insert(self, request):
+        key = request.sort_key()
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._requests.insert(index, request)
+
+    def _remove(self, request):
+        index = bisect.bisect_left(self._keys, request.sort_key())
+        del self._keys[index]
+        del self._requests[index]
+
+    def _pick_victim(self):
+        """ Return the request to drop from a full queue, the oldest or newest of the lowest priority. """
+        lowest = self._requests[-1].priority
+        if self.drop_policy == DROP_NEWEST:
+            return self._requests[-1]
+        # Requests of the same priority are in arrival order, the oldest one is the first of the lowest priority
+        index = bisect.bisect_left(self._keys, (-lowest, 0))
+        return self._requests[index]
@@ -1,36 +1,196 @@
+import time
+from collections import OrderedDict
+
 from PySide2 import QtCore, QtGui, QtWidgets
 
+from .instrumentation import BALLOON_CONTENTS_CHANGED, BALLOON_PAINT
 from .palette import get_clippy_palette
 
 
 class Balloon(QtWidgets.QWidget):
+    """
+    A speech balloon, showing a single content widget at a time.
+
+    Contents set with a key are kept alive in a stacked layout once they have been shown, so swapping back to them
+    with show_widget() neither rebuilds them nor lays them out again.
+    """
 
     contents_changed = QtCore.Signal()
 
+    # Number of balloon sizes whose bubble paths and shape masks are kept
+    shape_cache_size = 16
+
     def __init__(self, parent=None):
         super(Balloon, self).__init__(parent)
 
         self._internal_layout = QtWidgets.QVBoxLayout(self)
         self._internal_layout.setContentsMargins(10, 10, 10, 25)
+        self._stack = QtWidgets.QStackedLayout()
+        self._internal_layout.addLayout(self._stack)
         self.setPalette(get_clippy_palette())
 
+        # Content widget without a key, replaced by the next one
+        self._widget = None
+        # Content widgets by key, and the size policies they had before being hidden in the stack
+        self._keyed_widgets = {}
+        self._size_policies = {}
+        # Bubble path and shape mask (computed on demand), by size
+        self._shapes = OrderedDict()
+        # Measurements, see set_instrumentation()
+        self._instrumentation = None
+
+    def set_instrumentation(self, instrumentation):
+        """
+        Record paint durations and contents size changes.
+
+        Parameters
+        ----------
+        instrumentation : clippy_qt.instrumentation.Instrumentation
+            None stops recording.
+        """
+        self._instrumentation = instrumentation
+
     def _clear_layout(self):
-        layout = self._internal_layout
-        while layout.count():
-            child = layout.takeAt(0)
-            widget = child.widget()
-            if widget is not None:
-                widget.setParent(None)
-                widget.deleteLater()
-
-    def set_widget(self, widget):
+        """ Delete the content widget which has no key. """
+        widget, self._widget = self._widget, None
+        if widget is not None:
+            self._stack.removeWidget(widget)
+            widget.setParent(None)
+            widget.deleteLater()
+
+    def set_widget(self, widget, key=None):
+        """
+        Show a content widget in the balloon.
+
+        Parameters
+        ----------
+        widget : QtWidgets.QWidget or None
+            None shows an empty balloon.
+        key : object
+            If given, the widget is kept under this key, to be shown again with show_widget(). A widget previously
+            kept under the same key is deleted. Widgets without a key are deleted when replaced.
+        """
+        # Measured before the stack changes, adding a widget to an empty stack makes it current
+        size_hint = self.sizeHint()
+        current = self._stack.currentWidget()
         self._clear_layout()
         if widget is not None:
-            self._internal_layout.addWidget(widget)
-        self.contents_changed.emit()
+            if key is None:
+                self._widget = widget
+            else:
+                self.discard_widget(key)
+                self._keyed_widgets[key] = widget
+            self._stack.addWidget(widget)
+        self._show(widget, size_hint, current)
 
-    def paintEvent(self, _event):
-        """ Draw the speech bubble """
+    def show_widget(self, key):
+        """
+        Show a content widget kept with set_widget().
+
+        Parameters
+        ----------
+        key : object
+
+        Returns
+        -------
+        bool
+            False if no widget is kept under that key.
+        """
+        widget = self._keyed_widgets.get(key)
+        if widget is None:
+            return False
+        self._clear_layout()
+        self._show(widget)
+        return True
+
+    def has_widget(self, key):
+        """ Return True if a content widget is kept under a key. """
+        return key in self._keyed_widgets
+
+    def discard_widget(self, key):
+        """
+        Delete the content widget kept under a key, if any.
+
+        Parameters
+        ----------
+        key : object
+        """
+        widget = self._keyed_widgets.pop(key, None)
+        if widget is None:
+            return
+        self._size_policies.pop(widget, None)
+        if self._stack.currentWidget() is widget:
+            self._show(None)
+        self._stack.removeWidget(widget)
+        widget.setParent(None)
+        widget.deleteLater()
+
+    def _show(self, widget, size_hint=None, current=None):
+        """
+        Make a widget of the stack current, and notify if the balloon needs to change size.
+
+        size_hint and current are the balloon's size hint and the current widget before the stack changed, they
+        default to the ones of now.
+        """
+        if size_hint is None:
+            size_hint = self.sizeHint()
+            current = self._stack.currentWidget()
+        if current is not None and current is not widget and self._stack.indexOf(current) >= 0:
+            # Hidden widgets of the stack must not weigh on the balloon's size
+            self._size_policies[current] = current.sizePolicy()
+            current.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
+        if widget is None:
+            self._stack.setCurrentIndex(-1)
+            for index in range(self._stack.count()):
+                self._stack.widget(index).hide()
+        else:
+            policy = self._size_policies.pop(widget, None)
+            if policy is not None:
+                widget.setSizePolicy(policy)
+            self._stack.setCurrentWidget(widget)
+            widget.show()
+        if self.sizeHint() != size_hint or widget is None or current is None:
+            if self._instrumentation is not None:
+                self._instrumentation.count(BALLOON_CONTENTS_CHANGED)
+            self.contents_changed.emit()
+
+    def shape_mask(self):
+        """
+        Return the area covered by the speech bubble, outline included, in widget coordinates.
+
+        Masks are cached per balloon size.
+
+        Returns
+        -------
+        QtGui.QRegion
+        """
+        shape = self._shape()
+        if shape[1] is None:
+            image = QtGui.QImage(self.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+            image.fill(QtCore.Qt.transparent)
+            painter = QtGui.QPainter(image)
+            painter.setBrush(QtCore.Qt.black)
+            painter.setPen(QtCore.Qt.black)
+            painter.drawPath(shape[0])
+            painter.end()
+            shape[1] = QtGui.QRegion(QtGui.QBitmap.fromImage(image.createAlphaMask(QtCore.Qt.ThresholdAlphaDither)))
+        return shape[1]
+
+    def _shape(self):
+        """ Return the cached [bubble path, shape mask or None] of the current size. """
+        size = self.size()
+        key = (size.width(), size.height())
+        shape = self._shapes.get(key)
+        if shape is not None:
+            self._shapes.move_to_end(key)
+            return shape
+        shape = self._shapes[key] = [self._bubble_path(), None]
+        if len(self._shapes) > self.shape_cache_size:
+            self._shapes.popitem(last=False)
+        return shape
+
+    def _bubble_path(self):
+        """ Build the outline of the speech bubble for the current size. """
         # Use a QPainterPath to draw a rounded speech bubble
         path = QtGui.QPainterPath()
 
@@ -46,7 +206,14 @@ class Balloon(QtWidgets.QWidget):
 
         # Bake the QPainterPath
         path.setFillRule(QtCore.Qt.WindingFill)
-        path = path.simplified()
+        return path.simplified()
+
+    def paintEvent(self, _event):
+        """ Draw the speech bubble """
+        instrumentation = self._instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
+        path = self._shape()[0]
 
         painter = QtGui.QPainter(self)
         # Set the fill to FFFFCC
@@ -54,3 +221,5 @@ class Balloon(QtWidgets.QWidget):
         painter.setPen(QtGui.QColor(0, 0, 0))
         painter.drawPath(path)
         painter.end()
+        if instrumentation is not None:
+            instrumentation.record(BALLOON_PAINT, (time.perf_counter() - start) * 1000)
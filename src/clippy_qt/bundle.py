@@ -0,0 +1,389 @@
+"""
+Precompiled agent bundles.
+
+A bundle packs everything an agent needs in a single file, laid out so it can be memory mapped and used without any
+parsing or decoding: the compiled animation tables, the sprite atlas as raw premultiplied ARGB32 pixels and the wav
+data of the sounds.
+
+Layout, all integers little endian:
+
+    header          HEADER struct, see below
+    strings         u32 length + utf-8 bytes, for every animation and sound name
+    animations      ANIMATION struct per animation: name, first frame, frame count
+    frames          5 int32 arrays of the total frame count: durations, sprites, sounds, exit branches, source frames
+    branch index    int32 per frame, offset of its branch record in the branch data, or -1
+    branch data     u32 count, then count pairs of int32 (cumulative weight, target frame)
+    sounds          SOUND struct per sound: name, data offset, data size
+    sound data      wav files, back to back
+    atlas           bytes_per_line * height bytes of premultiplied ARGB32, aligned on 64 bytes
+
+Frame indices (exit branches, branch targets and source frames) are relative to the start of their animation.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from clippy_qt.animation import AnimationTable, BranchTable, CompiledAnimation
+
+
+BUNDLE_EXTENSION = '.cqb'
+# Name of the bundle looked up next to an agent's config.json
+BUNDLE_NAME = 'agent' + BUNDLE_EXTENSION
+
+MAGIC = b'CLIPPYQT'
+VERSION = 2
+
+# magic, version, tile width, tile height, atlas width, atlas height, atlas bytes per line, then an offset and a
+# count (or a size in bytes for the data sections) for each section: strings, animations, frames, branch index,
+# branch data, sounds, sound data and atlas
+HEADER = struct.Struct('<8s6I16Q')
+ANIMATION = struct.Struct('<3I')
+SOUND = struct.Struct('<I2Q')
+BRANCH = struct.Struct('<2i')
+COUNT = struct.Struct('<I')
+
+# Sections start on 8 bytes boundaries so the int32 arrays can be mapped as they are, the atlas on a cache line
+SECTION_ALIGNMENT = 8
+ATLAS_ALIGNMENT = 64
+
+
+class BundleError(Exception):
+    """ Raised when a bundle can not be read. """
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _int32_array(values):
+    """ Return an int32 array, whatever the size of a C int is on this platform. """
+    for typecode in 'ilh':
+        if array(typecode).itemsize == 4:
+            return array(typecode, values)
+    raise BundleError('No 32 bit integer array type on this platform')
+
+
+def _little_endian_bytes(values):
+    """ Return the bytes of an int32 array, in little endian order. """
+    values = _int32_array(values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_bundle(target, table, atlas, sounds=None):
+    """
+    Write a bundle to disk.
+
+    Parameters
+    ----------
+    target : str
+        Path of the bundle to write.
+    table : clippy_qt.animation.AnimationTable
+    atlas : QtGui.QImage
+        The sprite sheet, converted to premultiplied ARGB32 if needed.
+    sounds : dict
+        Mapping of sound name to wav bytes. Sounds of the table which are missing are left out of the bundle.
+    """
+    from PySide2 import QtGui
+
+    sounds = sounds or {}
+    atlas = atlas.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+
+    strings = []
+    string_ids = {}
+
+    def string_id(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    animation_records = []
+    durations, sprites, sound_ids, exit_branches, source_frames = [], [], [], [], []
+    branch_index = []
+    branch_data = bytearray()
+    for name in table.names():
+        animation = table[name]
+        animation_records.append(ANIMATION.pack(string_id(name), len(durations), animation.frame_count))
+        durations.extend(animation.durations)
+        sprites.extend(animation.sprites)
+        sound_ids.extend(animation.sounds)
+        exit_branches.extend(animation.exit_branches)
+        source_frames.extend(animation.source_frames)
+        for branch in animation.branches:
+            if branch is None:
+                branch_index.append(-1)
+                continue
+            branch_index.append(len(branch_data))
+            branch_data += COUNT.pack(len(branch.targets))
+            for weight, target_frame in zip(branch.cumulative_weights, branch.targets):
+                branch_data += BRANCH.pack(weight, target_frame)
+
+    # Sound ids of the bundle are the ids of the table, which may include sounds with no data
+    sound_records = []
+    sound_data = bytearray()
+    for name in table.sounds:
+        data = sounds.get(name, b'')
+        sound_records.append(SOUND.pack(string_id(name), len(sound_data), len(data)))
+        sound_data += data
+
+    string_data = bytearray()
+    for value in strings:
+        encoded = value.encode('utf-8')
+        string_data += COUNT.pack(len(encoded)) + encoded
+
+    sections = [
+        (bytes(string_data), len(strings)),
+        (b''.join(animation_records), len(animation_records)),
+        (b''.join(_little_endian_bytes(values) for values in (durations, sprites, sound_ids, exit_branches,
+                                                                             source_frames)),
+         len(durations)),
+        (_little_endian_bytes(branch_index), len(branch_index)),
+        (bytes(branch_data), len(branch_data)),
+        (b''.join(sound_records), len(sound_records)),
+        (bytes(sound_data), len(sound_data)),
+    ]
+
+    offsets = []
+    offset = HEADER.size
+    for data, _count in sections:
+        offset = _align(offset, SECTION_ALIGNMENT)
+        offsets.append(offset)
+        offset += len(data)
+    atlas_offset = _align(offset, ATLAS_ALIGNMENT)
+    atlas_data = bytes(atlas.constBits())
+
+    section_fields = []
+    for (_data, count), section_offset in zip(sections, offsets):
+        section_fields.extend((section_offset, count))
+    section_fields.extend((atlas_offset, len(atlas_data)))
+
+    header = HEADER.pack(MAGIC, VERSION, table.framesize[0], table.framesize[1], atlas.width(), atlas.height(),
+                         atlas.bytesPerLine(), *section_fields)
+
+    temp_target = target + '.tmp'
+    with open(temp_target, 'wb') as f:
+        f.write(header)
+        for (data, _count), section_offset in zip(sections, offsets):
+            f.write(b'\0' * (section_offset - f.tell()))
+            f.write(data)
+        f.write(b'\0' * (atlas_offset - f.tell()))
+        f.write(atlas_data)
+    # Replace atomically, agents may have the previous bundle mapped
+    os.replace(temp_target, target)
+
+
+class Bundle(object):
+    """
+    A memory mapped bundle.
+
+    The animation table and the atlas are views on the mapped file, nothing is copied or decoded, and the file stays
+    mapped as long as the bundle or any of them is alive.
+
+    Parameters
+    ----------
+    path : str
+
+    Attributes
+    ----------
+    path : str
+    animations : clippy_qt.animation.AnimationTable
+    atlas_size : tuple
+        Width and height of the atlas.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise BundleError('Bundles can only be mapped on little endian platforms')
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if len(self._view) < HEADER.size:
+            raise BundleError('{} is not a ClippyQt bundle'.format(path))
+
+        fields = HEADER.unpack_from(self._view, 0)
+        magic, version, tile_width, tile_height, atlas_width, atlas_height, bytes_per_line = fields[:7]
+        if magic != MAGIC:
+            raise BundleError('{} is not a ClippyQt bundle'.format(path))
+        if version != VERSION:
+            raise BundleError('{} is a version {} bundle, expected version {}'.format(path, version, VERSION))
+        (strings_offset, string_count, animations_offset, animation_count, frames_offset, frame_count,
+         branch_index_offset, _, branch_data_offset, _, sounds_offset, sound_count,
+         self._sound_data_offset, _, atlas_offset, atlas_size) = fields[7:]
+        if atlas_offset + atlas_size > len(self._view) or atlas_size < bytes_per_line * atlas_height:
+            raise BundleError('{} is truncated'.format(path))
+
+        self._strings = self._read_strings(strings_offset, string_count)
+        self._sound_records = [SOUND.unpack_from(self._view, sounds_offset + i * SOUND.size)
+                               for i in range(sound_count)]
+
+        def int32_section(index):
+            start = frames_offset + index * frame_count * 4
+            return self._view[start:start + frame_count * 4].cast('i')
+
+        durations, sprites, sounds, exit_branches, source_frames = [int32_section(i) for i in range(5)]
+        branch_index = self._view[branch_index_offset:branch_index_offset + frame_count * 4].cast('i')
+
+        animations = {}
+        for i in range(animation_count):
+            name_id, first, count = ANIMATION.unpack_from(self._view, animations_offset + i * ANIMATION.size)
+            last = first + count
+            branches = [self._read_branch(branch_data_offset, branch_index[frame]) for frame in range(first, last)]
+            animations[self._strings[name_id]] = CompiledAnimation(
+                self._strings[name_id], durations[first:last], sprites[first:last], sounds[first:last],
+                exit_branches[first:last], branches, source_frames[first:last])
+
+        self.animations = AnimationTable((tile_width, tile_height),
+                                         [self._strings[record[0]] for record in self._sound_records], animations)
+        self.atlas_size = (atlas_width, atlas_height)
+        self._atlas_bytes_per_line = bytes_per_line
+        self._atlas = self._view[atlas_offset:atlas_offset + atlas_size]
+
+    def _read_strings(self, offset, count):
+        strings = []
+        for _ in range(count):
+            length, = COUNT.unpack_from(self._view, offset)
+            offset += COUNT.size
+            strings.append(bytes(self._view[offset:offset + length]).decode('utf-8'))
+            offset += length
+        return strings
+
+    def _read_branch(self, data_offset, branch_offset):
+        if branch_offset < 0:
+            return None
+        offset = data_offset + branch_offset
+        count, = COUNT.unpack_from(self._view, offset)
+        pairs = [BRANCH.unpack_from(self._view, offset + COUNT.size + i * BRANCH.size) for i in range(count)]
+        return BranchTable.from_cumulative([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+
+    def atlas(self):
+        """
+        Return the atlas as an image backed by the mapped file.
+
+        Returns
+        -------
+        QtGui.QImage
+        """
+        from PySide2 import QtGui
+
+        width, height = self.atlas_size
+        image = QtGui.QImage(self._atlas, width, height, self._atlas_bytes_per_line,
+                             QtGui.QImage.Format_ARGB32_Premultiplied)
+        # QImage does not own the buffer, keep the mapping alive as long as the image is
+        image._bundle = self
+        return image
+
+    def sound_names(self):
+        """ Return the names of the sounds which have data in the bundle. """
+        return [self._strings[name_id] for name_id, _offset, size in self._sound_records if size]
+
+    def sound_data(self, name):
+        """
+        Return the wav data of a sound.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        memoryview or None
+            None if the bundle has no data for that sound.
+        """
+        for name_id, offset, size in self._sound_records:
+            if self._strings[name_id] == name and size:
+                start = self._sound_data_offset + offset
+                return self._view[start:start + size]
+        return None
+
+
+def bundle_path_for(config):
+    """
+    Return the path of the bundle matching an agent's config.json.
+
+    Parameters
+    ----------
+    config : str
+
+    Returns
+    -------
+    str
+    """
+    if config.endswith(BUNDLE_EXTENSION):
+        return config
+    return os.path.join(os.path.dirname(config), BUNDLE_NAME)
+
+
+def newest_sound_time(directory):
+    """
+    Return the modification time of the newest file of a sounds directory, or of the directory itself if later.
+
+    The directory's own time changes when files are added or removed, the files' times when they are rewritten.
+
+    Parameters
+    ----------
+    directory : str
+
+    Returns
+    -------
+    float or None
+        None if there is no such directory.
+    """
+    try:
+        newest = os.path.getmtime(directory)
+        entries = os.listdir(directory)
+    except OSError:
+        return None
+    for entry in entries:
+        try:
+            newest = max(newest, os.path.getmtime(os.path.join(directory, entry)))
+        except OSError:
+            pass
+    return newest
+
+
+def find_bundle(config, sprite, sounds=None):
+    """
+    Return the bundle to use for an agent, if there is an up to date one of the current bundle version.
+
+    Parameters
+    ----------
+    config : str
+        Path to the agent's config.json, or to a bundle.
+    sprite : str
+        Path to the agent's sprite sheet, may be None when config is a bundle.
+    sounds : str
+        Path to the agent's sounds directory, defaults to the sounds directory next to the config.
+
+    Returns
+    -------
+    str or None
+    """
+    path = bundle_path_for(config)
+    if path == config:
+        return path
+    try:
+        bundle_time = os.path.getmtime(path)
+    except OSError:
+        return None
+    for source in (config, sprite):
+        if source and os.path.exists(source) and os.path.getmtime(source) > bundle_time:
+            return None
+    if sounds is None:
+        sounds = os.path.join(os.path.dirname(config), 'sounds')
+    sound_time = newest_sound_time(sounds)
+    if sound_time is not None and sound_time > bundle_time:
+        return None
+    # Bundles written by another version of ClippyQt are stale as well
+    try:
+        with open(path, 'rb') as f:
+            magic, version = struct.unpack('<8sI', f.read(12))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != VERSION:
+        return None
+    return path
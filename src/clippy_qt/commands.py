@@ -0,0 +1,246 @@
+"""
+Drive agents from any thread.
+
+Agents and engines are widgets, they can only be used from the GUI thread. A CommandChannel lets other threads send
+them commands: commands are queued under a lock and the GUI thread is woken up by a queued signal, once per burst, to
+apply every command waiting in a single event loop iteration.
+
+Each command returns a concurrent.futures.Future. The futures of animations resolve when the animation's callback
+fires, which includes animations dropped from a full queue (see clippy_qt.animation_queue). They fail with
+CommandCancelled when the animation is discarded by stop() instead, or because the agent's resources failed to load,
+and with KeyError when the agent has no such animation.
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from PySide2 import QtCore
+
+
+class CommandCancelled(Exception):
+    """ The animation of a command was discarded before it played. """
+
+
+class _Completion(object):
+    """ Animation callback resolving a future. """
+
+    __slots__ = ('future', 'result')
+
+    def __init__(self, future, result):
+        self.future = future
+        self.result = result
+
+    def __call__(self):
+        if not self.future.done():
+            self.future.set_result(self.result)
+
+    def cancel(self):
+        # A running future cannot be cancelled, fail it instead so waiters wake up
+        if not self.future.done():
+            self.future.set_exception(CommandCancelled('{} was discarded before it played'.format(self.result)))
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class CommandChannel(QtCore.QObject):
+    """
+    Thread safe commands for an agent, and optionally the engine showing it.
+
+    Must be created on the GUI thread, every command is applied there.
+
+    Parameters
+    ----------
+    agent : clippy_qt.agent.Agent
+    engine : clippy_qt.engine.ClippyEngine
+        Required for the balloon commands.
+    parent : QtCore.QObject
+
+    Attributes
+    ----------
+    batches : int
+        Number of event loop iterations which applied commands.
+    applied : int
+        Number of commands applied.
+    """
+
+    _wake_up = QtCore.Signal()
+
+    def __init__(self, agent, engine=None, parent=None):
+        super(CommandChannel, self).__init__(parent)
+        self.agent = agent
+        self.engine = engine
+        self.batches = 0
+        self.applied = 0
+
+        self._lock = threading.Lock()
+        self._commands = deque()
+        self._woken = False
+        self._wake_up.connect(self._apply, QtCore.Qt.QueuedConnection)
+        agent.discarded.connect(self._discarded)
+        agent.rejected.connect(self._rejected)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Call a function on the GUI thread.
+
+        Parameters
+        ----------
+        function : callable
+            Called with args and kwargs, its return value is the result of the future.
+
+        Returns
+        -------
+        concurrent.futures.Future
+        """
+        future = Future()
+        self._push(future, function, args, kwargs)
+        return future
+
+    def play(self, animation, right_now=False, priority=0):
+        """
+        Play an animation, see Agent.play().
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the animation name when its callback fires.
+        """
+        future = Future()
+        self._push(future, self._play, (future, animation, right_now, priority), {})
+        return future
+
+    def gesture_at(self, position):
+        """
+        Gesture towards a position on the screen, see Agent.gesture_at().
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves when the gesture is done.
+        """
+        future = Future()
+        self._push(future, self._animate, (future, self.agent.gesture_at, position), {})
+        return future
+
+    def look_at(self, position):
+        """
+        Look towards a position on the screen, see Agent.look_at().
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves when the look is done.
+        """
+        future = Future()
+        self._push(future, self._animate, (future, self.agent.look_at, position), {})
+        return future
+
+    def stop(self, right_now=False):
+        """
+        Stop the agent, see Agent.stop(). Futures of the discarded animations fail with CommandCancelled.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves once the agent was told to stop.
+        """
+        return self.submit(self.agent.stop, right_now=right_now)
+
+    def set_widget(self, widget, key=None):
+        """
+        Show a widget in the engine's balloon, see ClippyEngine.set_widget().
+
+        Parameters
+        ----------
+        widget : QtWidgets.QWidget or callable or None
+            Widgets can only be created on the GUI thread, pass a callable returning the widget to create it there.
+        key : object
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the widget once it is shown.
+        """
+        return self.submit(self._set_widget, widget, key)
+
+    def show_widget(self, key):
+        """
+        Show a widget kept in the engine's balloon, see ClippyEngine.show_widget().
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to False if no widget is kept under the key.
+        """
+        return self.submit(self._show_widget, key)
+
+    def pending(self):
+        """ Return the number of commands waiting to be applied. """
+        with self._lock:
+            return len(self._commands)
+
+    def _require_engine(self):
+        if self.engine is None:
+            raise RuntimeError('Balloon commands need a CommandChannel created with an engine')
+        return self.engine
+
+    def _push(self, future, function, args, kwargs):
+        with self._lock:
+            self._commands.append((future, function, args, kwargs))
+            wake_up = not self._woken
+            self._woken = True
+        # A single wake up per burst, the commands queued meanwhile are applied with it
+        if wake_up:
+            self._wake_up.emit()
+
+    def _apply(self):
+        """ Apply every command waiting, on the GUI thread. """
+        with self._lock:
+            commands = self._commands
+            self._commands = deque()
+            self._woken = False
+        self.batches += 1
+        for future, function, args, kwargs in commands:
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.applied += 1
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if result is not _DEFERRED and not future.done():
+                    future.set_result(result)
+
+    def _play(self, future, animation, right_now, priority):
+        self.agent.play(animation, right_now=right_now, callback=_Completion(future, animation), priority=priority)
+        return _DEFERRED
+
+    def _animate(self, future, method, position):
+        method(position, callback=_Completion(future, None))
+        return _DEFERRED
+
+    def _set_widget(self, widget, key):
+        engine = self._require_engine()
+        if callable(widget):
+            widget = widget()
+        engine.set_widget(widget, key=key)
+        return widget
+
+    def _show_widget(self, key):
+        return self._require_engine().show_widget(key)
+
+    def _discarded(self, callback):
+        if isinstance(callback, _Completion):
+            callback.cancel()
+
+    def _rejected(self, callback, error):
+        if isinstance(callback, _Completion):
+            callback.fail(error)
+
+
+# Returned by commands whose future is resolved later, by an animation callback
+_DEFERRED = object()
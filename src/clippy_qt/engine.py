@@ -4,10 +4,29 @@ from PySide2 import QtCore, QtGui, QtWidgets
 from clippy_qt.agent import Agent
 from clippy_qt.agents import Clippy
 from clippy_qt.balloon import Balloon
+from clippy_qt.commands import CommandChannel
+from clippy_qt.instrumentation import ENGINE_RELAYOUTS, ENGINE_RESIZES
 
 
 class ClippyEngine(QtWidgets.QDialog):
-    def __init__(self, agent=None, parent=None):
+    """
+    A frameless window showing an agent, and a speech balloon above it.
+
+    Parameters
+    ----------
+    agent : clippy_qt.agent.Agent
+        Defaults to Clippy.
+    parent : QtWidgets.QWidget
+    shaped : bool
+        If True, shape the window to the agent's sprite and the balloon with setMask(), instead of compositing a
+        translucent window. Much cheaper on compositors which blend the whole window on every frame, at the cost of
+        aliased edges.
+    """
+
+    # Events of the agent and balloon after which the window's shape changes
+    _mask_events = (QtCore.QEvent.Show, QtCore.QEvent.Hide, QtCore.QEvent.Move, QtCore.QEvent.Resize)
+
+    def __init__(self, agent=None, parent=None, shaped=False):
         super(ClippyEngine, self).__init__(parent)
 
         if agent is None:
@@ -17,17 +36,25 @@ class ClippyEngine(QtWidgets.QDialog):
 
         self.agent = agent
         self.balloon = Balloon(parent=self)
+        self.shaped = shaped
+        # Commands from other threads, for the agent and the balloon, see clippy_qt.commands
+        self.commands = CommandChannel(agent, engine=self, parent=self)
 
         # Mouse tracking for dragging the dialog
         self._mouse_pressed = False
         self._old_pos = None
         self._old_rect = None
+        # Sprite, balloon size and positions of the mask last applied
+        self._mask_key = None
+        # Measurements, see set_instrumentation()
+        self._instrumentation = None
 
         self.init_ui()
 
     def init_ui(self):
         self.setWindowFlags(QtCore.Qt.Tool | QtCore.Qt.FramelessWindowHint)
-        self.setAttribute(QtCore.Qt.WA_TranslucentBackground)
+        if not self.shaped:
+            self.setAttribute(QtCore.Qt.WA_TranslucentBackground)
         # self.setWindowFlag(QtCore.Qt.WindowStaysOnTopHint)  # Not needed if setting parent
         self.setWindowFlag(QtCore.Qt.WindowDoesNotAcceptFocus)
         # Delete on close
@@ -48,7 +75,54 @@ class ClippyEngine(QtWidgets.QDialog):
         self.balloon.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Minimum)
 
         # Connect signals
-        self.balloon.contents_changed.connect(self.adjustSize)
+        self.balloon.contents_changed.connect(self._fit_contents)
+        if self.shaped:
+            self.agent.sprite_changed.connect(self.update_mask)
+            # Layout changes move the agent and resize the balloon
+            self.agent.installEventFilter(self)
+            self.balloon.installEventFilter(self)
+
+    def set_instrumentation(self, instrumentation):
+        """
+        Record the timings of the agent and the balloon, see clippy_qt.instrumentation, and the engine's relayouts.
+
+        Parameters
+        ----------
+        instrumentation : clippy_qt.instrumentation.Instrumentation
+            None stops recording.
+        """
+        self._instrumentation = instrumentation
+        self.agent.set_instrumentation(instrumentation)
+        self.balloon.set_instrumentation(instrumentation)
+
+    def _fit_contents(self):
+        """ Resize the window to the balloon's new contents. """
+        if self._instrumentation is not None:
+            self._instrumentation.count(ENGINE_RELAYOUTS)
+        self.adjustSize()
+
+    def update_mask(self):
+        """ Shape the window to the current sprite and the balloon, in shaped mode. """
+        if not self.shaped:
+            return
+        balloon_visible = self.balloon.isVisibleTo(self)
+        agent_pos = self.agent.pos()
+        balloon_geometry = self.balloon.geometry() if balloon_visible else None
+        key = (self.agent.playback.current_sprite(), self.agent.geometry().getRect(),
+               balloon_geometry.getRect() if balloon_visible else None)
+        if key == self._mask_key:
+            return
+        self._mask_key = key
+
+        mask = self.agent.shape_mask().translated(agent_pos)
+        if balloon_visible:
+            mask = mask.united(self.balloon.shape_mask().translated(balloon_geometry.topLeft()))
+        self.setMask(mask)
+
+    def eventFilter(self, watched, event):
+        if event.type() in self._mask_events and (watched is self.agent or watched is self.balloon):
+            self.update_mask()
+        return super(ClippyEngine, self).eventFilter(watched, event)
 
     # Allow moving the dialog by clicking and dragging the agent
     def mousePressEvent(self, event):
@@ -74,6 +148,8 @@ class ClippyEngine(QtWidgets.QDialog):
         self._old_rect = None
 
     def resizeEvent(self, event):
+        if self._instrumentation is not None:
+            self._instrumentation.count(ENGINE_RESIZES)
         old_size = event.oldSize()
         if old_size == QtCore.QSize(-1, -1):
             # This is the first resize event, ignore it
@@ -83,13 +159,27 @@ class ClippyEngine(QtWidgets.QDialog):
         offset = QtCore.QPoint(old_size.width() - new_size.width(), old_size.height() - new_size.height())
         self.move(self.pos() + offset)
 
-    def set_widget(self, widget):
-        self.balloon.set_widget(widget)
+    def set_scale(self, scale):
+        """ Change the display scale of the agent, see Agent.set_scale(), and fit the window to it. """
+        self.agent.set_scale(scale)
+        self.adjustSize()
+
+    def set_widget(self, widget, key=None):
+        """ Show a widget in the balloon, see Balloon.set_widget(). None hides the balloon. """
+        self.balloon.set_widget(widget, key=key)
         if widget is None:
             self.balloon.hide()
         elif not self.balloon.isVisible():
             self.balloon.show()
 
+    def show_widget(self, key):
+        """ Show a widget kept in the balloon under a key, see Balloon.show_widget(). """
+        if not self.balloon.show_widget(key):
+            return False
+        if not self.balloon.isVisible():
+            self.balloon.show()
+        return True
+
     def show(self):
         """ Show the agent then after its greeting, show the balloon """
         self.balloon.hide()
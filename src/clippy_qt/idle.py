@@ -0,0 +1,97 @@
+"""
+When agents play idle animations.
+
+An agent left alone plays a random Idle* animation every 5 to 15 seconds. While the user is away, nothing asks the
+agent to do anything else, so an IdlePolicy backs off: every idle animation played in a row multiplies the delay
+before the next one, up to a ceiling, and any other animation or activate() call brings the delay back down. Idle
+animations which loop until they are stopped are asked to stop after a while, instead of animating until the user
+comes back.
+
+Idle animations are picked from the category index of the animation table, see clippy_qt.animation.
+"""
+from clippy_qt.animation import IDLE_CATEGORY
+
+
+class IdlePolicy(object):
+    """
+    Delays between idle animations, and which one to play.
+
+    Parameters
+    ----------
+    min_delay : int
+    max_delay : int
+        Range of the random delay before the first idle animation, in milliseconds.
+    backoff : float
+        Factor applied to the delay for every idle animation played in a row. 1 disables the back off.
+    max_idle_delay : int
+        Ceiling of the backed off delay, in milliseconds.
+    max_duration : int
+        Time after which an animation of the idle category is asked to stop, in milliseconds, counted from when it
+        starts playing. None to let it play until it ends.
+    category : str
+        Category of the animations to pick from.
+
+    Attributes
+    ----------
+    streak : int
+        Number of idle animations played in a row, since the user was last active.
+    """
+
+    def __init__(self, min_delay=5000, max_delay=15000, backoff=2.0, max_idle_delay=240000, max_duration=30000,
+                 category=IDLE_CATEGORY):
+        if not 0 <= min_delay <= max_delay:
+            raise ValueError('Invalid idle delay range: {} to {}'.format(min_delay, max_delay))
+        if backoff < 1:
+            raise ValueError('backoff must be at least 1, not {}'.format(backoff))
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.max_idle_delay = max_idle_delay
+        self.max_duration = max_duration
+        self.category = category
+        self.streak = 0
+
+    def next_delay(self, rng):
+        """
+        Return the delay before the next idle animation.
+
+        Parameters
+        ----------
+        rng : random.Random
+
+        Returns
+        -------
+        int
+            Milliseconds.
+        """
+        delay = rng.randint(self.min_delay, self.max_delay) * self.backoff ** self.streak
+        return int(min(delay, max(self.max_idle_delay, self.max_delay)))
+
+    def choose(self, animations, rng):
+        """
+        Return a random idle animation.
+
+        Parameters
+        ----------
+        animations : clippy_qt.animation.AnimationTable
+        rng : random.Random
+
+        Returns
+        -------
+        str or None
+            None if the agent has no animation in the idle category.
+        """
+        names = animations.category(self.category)
+        if not names:
+            return None
+        return rng.choice(names)
+
+    def idle_played(self):
+        """ Back off, an idle animation played. """
+        # Stop counting once the ceiling is reached, the delay cannot grow anymore
+        if self.backoff > 1 and self.min_delay * self.backoff ** self.streak < self.max_idle_delay:
+            self.streak += 1
+
+    def user_active(self):
+        """ Reset the back off, something else than an idle animation was asked for. """
+        self.streak = 0
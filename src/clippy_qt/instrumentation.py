@@ -0,0 +1,242 @@
+"""
+Opt-in measurements of how smoothly agents run.
+
+An Instrumentation collects timing samples in fixed size ring buffers, one per series, and counts events. Agents,
+balloons and engines only record into one once it is set with their set_instrumentation() method: until then their
+only cost is a check that it is None.
+
+Recorded series, all in milliseconds:
+
+- frame_lateness: how late each frame timer fired, after the frame's deadline.
+- agent_paint and balloon_paint: durations of Agent.paintEvent and Balloon.paintEvent.
+- queue_wait: time animations waited in the queue before they started.
+- animation_duration/<name>: how long each animation played, from its start to its end.
+
+Recorded counters:
+
+- balloon_contents_changed: times the balloon contents changed size.
+- engine_relayouts: times the engine resized itself to fit them.
+- engine_resizes: resize events of the engine window.
+
+snapshot() summarizes every series as a histogram with percentiles, export() writes it to a JSON file.
+"""
+import json
+import math
+import time
+from array import array
+
+FRAME_LATENESS = 'frame_lateness'
+AGENT_PAINT = 'agent_paint'
+BALLOON_PAINT = 'balloon_paint'
+QUEUE_WAIT = 'queue_wait'
+ANIMATION_DURATION = 'animation_duration'
+
+BALLOON_CONTENTS_CHANGED = 'balloon_contents_changed'
+ENGINE_RELAYOUTS = 'engine_relayouts'
+ENGINE_RESIZES = 'engine_resizes'
+
+# Upper bounds of the histogram buckets, in milliseconds. Samples above the last one fall in an overflow bucket.
+DEFAULT_BUCKETS = (0.5, 1, 2, 4, 8, 16, 33, 66, 100, 250, 500, 1000, 5000, 30000)
+
+
+def animation_series(name):
+    """ Return the name of the series of an animation's durations. """
+    return '{}/{}'.format(ANIMATION_DURATION, name)
+
+
+class RingBuffer(object):
+    """
+    The latest samples of a series, in a fixed size buffer.
+
+    Parameters
+    ----------
+    capacity : int
+
+    Attributes
+    ----------
+    total : int
+        Number of samples ever added, including the ones overwritten since.
+    """
+
+    __slots__ = ('capacity', 'total', '_values')
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1, not {}'.format(capacity))
+        self.capacity = capacity
+        self.total = 0
+        self._values = array('d', bytes(8 * capacity))
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, value):
+        self._values[self.total % self.capacity] = value
+        self.total += 1
+
+    def values(self):
+        """ Return the samples kept, oldest first. """
+        if self.total <= self.capacity:
+            return list(self._values[:self.total])
+        start = self.total % self.capacity
+        return list(self._values[start:]) + list(self._values[:start])
+
+    def clear(self):
+        self.total = 0
+
+
+def percentile(ordered, fraction):
+    """
+    Return a percentile of sorted values, by nearest rank.
+
+    Parameters
+    ----------
+    ordered : list of float
+        Sorted, not empty.
+    fraction : float
+        Between 0 and 1.
+
+    Returns
+    -------
+    float
+    """
+    rank = max(int(math.ceil(fraction * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+def summarize(values, buckets=DEFAULT_BUCKETS):
+    """
+    Return the histogram summary of samples.
+
+    Parameters
+    ----------
+    values : list of float
+    buckets : sequence of float
+        Upper bounds of the histogram buckets, sorted.
+
+    Returns
+    -------
+    dict
+        count, min, max, mean, p50, p90 and p99 of the samples, and histogram: the number of samples in each bucket,
+        the last one counting the samples above every bound.
+    """
+    histogram = [0] * (len(buckets) + 1)
+    if not values:
+        return {'count': 0, 'min': None, 'max': None, 'mean': None, 'p50': None, 'p90': None, 'p99': None,
+                'histogram': histogram}
+    ordered = sorted(values)
+    index = 0
+    for value in ordered:
+        while index < len(buckets) and value > buckets[index]:
+            index += 1
+        histogram[index] += 1
+    return {
+        'count': len(ordered),
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': sum(ordered) / len(ordered),
+        'p50': percentile(ordered, 0.5),
+        'p90': percentile(ordered, 0.9),
+        'p99': percentile(ordered, 0.99),
+        'histogram': histogram,
+    }
+
+
+class Instrumentation(object):
+    """
+    Timing samples and event counters, see the module's documentation.
+
+    Only use it from the GUI thread.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of samples kept per series, older ones are overwritten.
+    buckets : sequence of float
+        Upper bounds of the histogram buckets of the summaries, in milliseconds.
+
+    Attributes
+    ----------
+    counters : dict
+        Event counts, by name.
+    """
+
+    def __init__(self, capacity=1024, buckets=DEFAULT_BUCKETS):
+        self.capacity = capacity
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self._series = {}
+        self._started = time.time()
+
+    def record(self, series, value):
+        """
+        Add a sample to a series.
+
+        Parameters
+        ----------
+        series : str
+        value : float
+        """
+        ring = self._series.get(series)
+        if ring is None:
+            ring = self._series[series] = RingBuffer(self.capacity)
+        ring.append(value)
+
+    def count(self, counter, increment=1):
+        """ Increment an event counter. """
+        self.counters[counter] = self.counters.get(counter, 0) + increment
+
+    def series(self):
+        """ Return the names of the series with samples. """
+        return sorted(self._series)
+
+    def values(self, series):
+        """ Return the samples kept of a series, oldest first, empty for an unknown series. """
+        ring = self._series.get(series)
+        return ring.values() if ring is not None else []
+
+    def summary(self, series):
+        """ Return the histogram summary of a series, see summarize(). """
+        summary = summarize(self.values(series), self.buckets)
+        ring = self._series.get(series)
+        summary['total'] = ring.total if ring is not None else 0
+        return summary
+
+    def snapshot(self, include_values=False):
+        """
+        Return the state of every series and counter.
+
+        Parameters
+        ----------
+        include_values : bool
+            If True, include the samples of every series as well as their summaries.
+
+        Returns
+        -------
+        dict
+            started: when recording started, in seconds since the epoch. buckets: upper bounds of the histogram
+            buckets. counters: event counts. series: summary of every series, by name, see summary(). The summaries
+            also hold the number of samples ever recorded in 'total', and the samples in 'values' if requested.
+        """
+        series = {}
+        for name in self.series():
+            series[name] = self.summary(name)
+            if include_values:
+                series[name]['values'] = self.values(name)
+        return {
+            'started': self._started,
+            'buckets': list(self.buckets),
+            'counters': dict(self.counters),
+            'series': series,
+        }
+
+    def export(self, path, include_values=False):
+        """ Write a snapshot to a JSON file, see snapshot(). """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(include_values), f, indent=1, sort_keys=True)
+
+    def reset(self):
+        """ Forget every sample and counter. """
+        self._series.clear()
+        self.counters.clear()
+        self._started = time.time()
@@ -0,0 +1,83 @@
+"""
+Report how long the animations of an agent keep playing once asked to stop.
+
+Usage: python -m clippy_qt.latency path/to/config.json [--max-stop-latency MS]
+
+The path can also be a precompiled bundle (see clippy_qt.bundle).
+"""
+import argparse
+import json
+
+from clippy_qt.animation import compile_animations
+
+
+def stop_latencies(animations, max_stop_latency=None):
+    """
+    Return the worst case stop latency of every animation of an agent.
+
+    Parameters
+    ----------
+    animations : clippy_qt.animation.AnimationTable
+    max_stop_latency : int
+        Latency budget of the interrupt mode, in milliseconds, None for no budget.
+
+    Returns
+    -------
+    dict
+        Animation name to a dict with the animation's 'duration' and its worst case stop latencies: 'natural' when
+        stopping by following exit branches (infinity if it can loop), 'interrupt' when jumping onto the shortest exit
+        path, all in milliseconds.
+    """
+    latencies = {}
+    for name in animations.names():
+        animation = animations[name]
+        index = animation.exit_index
+        latencies[name] = {
+            'duration': sum(animation.durations),
+            'natural': index.natural_latency(),
+            'interrupt': index.interrupt_latency(max_stop_latency),
+        }
+    return latencies
+
+
+def load_animations(path):
+    """ Load the animation table of a config.json or of a bundle. """
+    from clippy_qt.bundle import BUNDLE_EXTENSION
+
+    if path.endswith(BUNDLE_EXTENSION):
+        from clippy_qt.bundle import Bundle
+        return Bundle(path).animations
+    with open(path, 'r') as f:
+        return compile_animations(json.load(f))
+
+
+def format_report(latencies):
+    """ Format stop latencies as a text table, the slowest animations to stop first. """
+    def ordering(item):
+        return -item[1]['natural'], -item[1]['interrupt'], item[0]
+
+    width = max([len(name) for name in latencies] + [len('Animation')])
+    lines = ['{:<{width}}  {:>9}  {:>9}  {:>9}'.format('Animation', 'Duration', 'Natural', 'Interrupt', width=width)]
+    for name, latency in sorted(latencies.items(), key=ordering):
+        natural = latency['natural']
+        lines.append('{:<{width}}  {:>9}  {:>9}  {:>9}'.format(
+            name, latency['duration'], 'unbounded' if natural == float('inf') else natural, latency['interrupt'],
+            width=width))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help="Path of an agent's config.json or bundle")
+    parser.add_argument('--max-stop-latency', type=int, metavar='MS', help='Latency budget of the interrupt mode')
+    args = parser.parse_args(argv)
+
+    latencies = stop_latencies(load_animations(args.path), args.max_stop_latency)
+    print(format_report(latencies))
+    print('\nWorst cases, in milliseconds. Natural: following exit branches. Interrupt: jumping onto the shortest '
+          'exit path{}.'.format(', with a {} ms budget'.format(args.max_stop_latency)
+                                if args.max_stop_latency is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,726 @@
+"""
+Qt independent animation playback.
+
+Playback is the state machine behind Agent: the animation queue, frame stepping, branching, exit branches, callbacks
+and the idle timer. It runs on a pluggable clock and a seedable random generator, so it can be driven by the Qt clocks
+of clippy_qt.scheduler, or by a VirtualClock to simulate animations as fast as the CPU allows, with no Qt at all.
+Its timers can be suspended while nobody can see the agent, without losing its place in the animation, as long as no
+animation callback is awaited.
+"""
+import heapq
+import itertools
+import random
+
+from clippy_qt.animation import NO_BRANCH, NO_SOUND, animation_category
+from clippy_qt.animation_queue import AnimationQueue
+from clippy_qt.idle import IdlePolicy
+from clippy_qt.instrumentation import FRAME_LATENESS, QUEUE_WAIT, animation_series
+
+
+class VirtualTimer(object):
+    """ A single shot timer of a VirtualClock, with the same start/stop/isActive API as a QTimer. """
+
+    def __init__(self, clock, callback):
+        self._clock = clock
+        self._callback = callback
+        self._generation = 0
+        self._active = False
+
+    def start(self, msec):
+        """ (Re)start the timer, firing in msec milliseconds of virtual time. """
+        self._generation += 1
+        self._active = True
+        self._clock._schedule(self, msec)
+
+    def stop(self):
+        """ Stop the timer, it will not fire. """
+        self._generation += 1
+        self._active = False
+
+    def isActive(self):
+        return self._active
+
+
+class VirtualClock(object):
+    """
+    A clock which only moves when it is told to, firing the timers that fall due in deadline order.
+
+    Parameters
+    ----------
+    start : float
+        Initial time, in milliseconds.
+
+    Attributes
+    ----------
+    fired : int
+        Number of timers fired.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = float(start)
+        self._queue = []
+        self._counter = itertools.count()
+        self.fired = 0
+
+    def now(self):
+        """ Return the time of the clock, in milliseconds. """
+        return self._now
+
+    def create_timer(self, callback, parent=None):
+        """
+        Create a single shot timer.
+
+        Parameters
+        ----------
+        callback : callable
+            Called when the timer fires.
+        parent : object
+            Ignored, accepted for compatibility with the Qt clocks.
+
+        Returns
+        -------
+        VirtualTimer
+        """
+        return VirtualTimer(self, callback)
+
+    def _schedule(self, timer, msec):
+        heapq.heappush(self._queue, (self._now + msec, next(self._counter), timer, timer._generation))
+
+    def next_deadline(self):
+        """ Return the deadline of the next timer to fire, or None if no timer is active. """
+        queue = self._queue
+        while queue and (not queue[0][2]._active or queue[0][2]._generation != queue[0][3]):
+            heapq.heappop(queue)
+        return queue[0][0] if queue else None
+
+    def advance(self, msec):
+        """
+        Move the clock forward, firing every timer which falls due on the way.
+
+        Parameters
+        ----------
+        msec : float
+        """
+        self.run_until(self._now + msec)
+
+    def run_until(self, time):
+        """
+        Move the clock to an absolute time, firing every timer which falls due on the way.
+
+        Parameters
+        ----------
+        time : float
+        """
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > time:
+                break
+            _deadline, _order, timer, _generation = heapq.heappop(self._queue)
+            self._now = max(self._now, deadline)
+            timer._active = False
+            self.fired += 1
+            timer._callback()
+        self._now = max(self._now, time)
+
+    def run(self, limit=None, exclude=()):
+        """
+        Fire timers until none is left, or until the clock reaches a limit.
+
+        Parameters
+        ----------
+        limit : float
+            Time to stop at, in milliseconds. Required if timers keep restarting themselves, like the idle timer.
+        exclude : sequence of VirtualTimer
+            Timers which do not keep the clock running on their own, the clock stops when only they are active.
+        """
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or (limit is not None and deadline > limit):
+                break
+            if exclude and all(timer in exclude for _d, _o, timer, generation in self._queue
+                               if timer._active and timer._generation == generation):
+                break
+            self.run_until(deadline)
+        if limit is not None:
+            self._now = max(self._now, limit)
+
+
+class Playback(object):
+    """
+    The animation state machine of an agent.
+
+    Parameters
+    ----------
+    animations : clippy_qt.animation.AnimationTable
+        May be None, and set later with set_animations().
+    clock : object
+        Clock with now() and create_timer(callback, parent) methods, see clippy_qt.scheduler and VirtualClock.
+    rng : random.Random
+        Random generator used for branching and idle animations, defaults to a new randomly seeded one.
+    catch_up : bool
+        If True, skip frames whose time has already passed when a tick is late, see Agent.
+    timer_parent : object
+        Passed to the clock when creating the timers, Qt clocks stop them when it is destroyed.
+    trace : bool
+        If True, record every frame, sound, start, stop and callback in the trace list.
+    queue : clippy_qt.animation_queue.AnimationQueue
+        Queue of the animations waiting to play, defaults to a bounded queue coalescing Look* and Gesture* requests.
+    interrupt : bool
+        If True, an animation asked to stop jumps straight onto its shortest exit path (see
+        clippy_qt.animation.ExitIndex) instead of playing on until it reaches an exit branch.
+    max_stop_latency : int
+        In interrupt mode, the longest an animation may keep playing once asked to stop, in milliseconds. Frames of
+        the exit path are skipped to fit in it.
+    idle_policy : clippy_qt.idle.IdlePolicy
+        When to play idle animations and which ones, defaults to a policy backing off while the user is away.
+
+    Attributes
+    ----------
+    on_started : callable
+        Called with no argument when an animation starts.
+    on_stopped : callable
+        Called with no argument when an animation stops.
+    on_frame : callable
+        Called with no argument when the frame to display changed.
+    on_sound : callable
+        Called with the sound id of frames which have a sound.
+    on_dropped : callable
+        Called with the animation name and the reason (see clippy_qt.animation_queue) when a queued request is
+        dropped, after its callback.
+    on_discarded : callable
+        Called with the callback of every request stop() discards without calling it.
+    idle_enabled : callable
+        Returns whether the idle timer should run after an animation stops.
+    instrumentation : clippy_qt.instrumentation.Instrumentation or None
+        Records frame lateness, queue waits and animation durations when set.
+    trace : list or None
+        Recorded events, tuples starting with the clock time and the event name:
+        (time, 'started', animation), (time, 'frame', animation, frame, sprite, source frame), (time, 'sound',
+        animation, frame, sound id), (time, 'stopped', animation), (time, 'callback', animation), (time, 'dropped',
+        animation, reason). Frames are indices in the compiled animation, which may have merged frames of the config
+        (see clippy_qt.animation.collapse_frame_runs), source frames the index of the config frame they started with.
+    late_ticks : int
+    skipped_frames : int
+    interrupted_frames : int
+        Frames of exit paths skipped to honour max_stop_latency.
+    frame_wakeups : int
+        Number of times the frame timer fired.
+    idle_wakeups : int
+        Number of times the idle timer fired.
+    """
+
+    # A tick this many milliseconds after its frame's deadline counts as late, and the sound of a frame which started
+    # longer ago than that is stale and not played in catch up mode.
+    late_tolerance = 20
+    # Upper bound of the frames skipped in a single tick, protects against loops of zero duration frames
+    max_catch_up_frames = 10000
+
+    def __init__(self, animations, clock, rng=None, catch_up=False, timer_parent=None, trace=False, queue=None,
+                 interrupt=False, max_stop_latency=None, idle_policy=None):
+        self.animations = animations
+        self.clock = clock
+        self.rng = rng if rng is not None else random.Random()
+        self.catch_up = catch_up
+        self.interrupt = interrupt
+        self.max_stop_latency = max_stop_latency
+        self.idle_policy = idle_policy if idle_policy is not None else IdlePolicy()
+
+        self.on_started = None
+        self.on_stopped = None
+        self.on_frame = None
+        self.on_sound = None
+        self.on_dropped = None
+        self.on_discarded = None
+        self.idle_enabled = None
+        self.trace = [] if trace else None
+        self.instrumentation = None
+
+        # Animation and callback queue:
+        self._queue = queue if queue is not None else AnimationQueue()
+        self._current_callback = None
+
+        # Animation state
+        self._current_animation = None
+        self._current_frame = 0
+        self._started_at = 0.0
+        self._playing = False
+        self._looping = False
+        self._stopping = False
+
+        # Wall clock frame scheduling
+        self._frame_deadline = 0.0
+        self.late_ticks = 0
+        self.skipped_frames = 0
+        self.interrupted_frames = 0
+
+        # Power management: suspend() requests the timers to stop, they stop once no callback is awaited
+        self._suspend_requested = False
+        self._suspended = False
+        # Time left of the frame showing when the timers were suspended
+        self._remaining = None
+        # Deadline of the idle timer, and its time left when the timers were suspended
+        self._idle_deadline = 0.0
+        self._idle_remaining = None
+        self.frame_wakeups = 0
+        self.idle_wakeups = 0
+        self._power_stats_start = clock.now()
+
+        self._timer = clock.create_timer(self._frame_timeout, timer_parent)
+        self._idle_timer = clock.create_timer(self._idle_timeout, timer_parent)
+
+    def set_animations(self, animations):
+        """ Set the animation table, when it was not available at construction. """
+        self.animations = animations
+
+    def is_playing(self):
+        """ Return True while an animation is playing. """
+        return self._playing
+
+    def current_animation(self):
+        """ Return the name of the animation playing, or None. """
+        if self._current_animation is None:
+            return None
+        return self._current_animation.name
+
+    def current_frame(self):
+        """ Return the index of the frame displayed in the current animation. """
+        return self._current_frame
+
+    def current_sprite(self):
+        """ Return the sprite index to display, 0 (the rest pose) when no animation is playing. """
+        if self._current_animation is None:
+            return 0
+        return self._current_animation.sprites[self._current_frame]
+
+    @property
+    def queue(self):
+        """ The queue of animations waiting to play. """
+        return self._queue
+
+    def queue_length(self):
+        """ Return the number of animations waiting in the queue. """
+        return len(self._queue)
+
+    def queue_stats(self):
+        """
+        Return the queue depth and drop counters, see AnimationQueue.stats().
+
+        Returns
+        -------
+        dict
+        """
+        return self._queue.stats()
+
+    def play(self, animation, right_now=False, callback=None, priority=0):
+        """
+        Play an animation, optionally with a callback when the animation is done.
+
+        Parameters
+        ----------
+        animation : str
+            Name of the animation to play, KeyError is raised right away if the table has no such animation.
+        right_now : bool
+            If True, play the animation immediately, discarding the current animation and the queue.
+            If False, add the animation to the queue.
+        callback : callable
+            Function to call when the animation is done. Use a lambda or partial if it needs arguments.
+            If the request is dropped from the queue instead, the callback is called when it is dropped.
+        priority : int
+            Queued animations of higher priority play first, and are the last to be dropped when the queue is full.
+        """
+        # Checked before queuing, an unknown animation would fail when its turn comes and never call its callback
+        if animation not in self.animations:
+            raise KeyError('Unknown animation {!r}'.format(animation))
+        self.activate()
+        self._enqueue(animation, right_now, callback, priority)
+
+    def play_random_idle(self):
+        """ Play a random idle animation, picked by the idle policy. """
+        animation = self.idle_policy.choose(self.animations, self.rng)
+        if animation is None:
+            return
+        self._leave_idle()
+        self.idle_policy.idle_played()
+        self._enqueue(animation)
+
+    def activate(self):
+        """
+        Get out of idle mode.
+        """
+        self.idle_policy.user_active()
+        self._leave_idle()
+
+    def is_suspended(self):
+        """ Return True while the timers are suspended. """
+        return self._suspended
+
+    def suspend(self):
+        """
+        Stop every timer, until resume() is called.
+
+        The frame showing keeps its place, animations played meanwhile start but wait on their first frame. Animations
+        whose callback is awaited are the exception: the timers keep running until neither the current animation nor
+        a queued one has a callback, so nothing waiting on an animation stalls.
+        """
+        self._suspend_requested = True
+        self._update_suspension()
+
+    def resume(self):
+        """ Restart the timers stopped by suspend(), the frame showing gets the time it had left. """
+        self._suspend_requested = False
+        self._update_suspension()
+
+    def _awaits_callbacks(self):
+        """ Return True if the current animation or a queued one has a callback. """
+        if self._current_callback is not None:
+            return True
+        return any(request.callback is not None for request in self._queue)
+
+    def _update_suspension(self):
+        """ Stop or restart the timers, as requested by suspend() and resume() and allowed by pending callbacks. """
+        suspend = self._suspend_requested and not self._awaits_callbacks()
+        if suspend == self._suspended:
+            return
+        self._suspended = suspend
+        if suspend:
+            if self._timer.isActive():
+                self._remaining = max(self._frame_deadline - self.clock.now(), 0)
+                self._timer.stop()
+            if self._idle_timer.isActive() and self._playing:
+                self._idle_remaining = max(self._idle_deadline - self.clock.now(), 0)
+            self._idle_timer.stop()
+            return
+
+        remaining, self._remaining = self._remaining, None
+        idle_remaining, self._idle_remaining = self._idle_remaining, None
+        if self._playing:
+            remaining = remaining if remaining is not None else 0
+            self._frame_deadline = self.clock.now() + remaining
+            self._timer.start(int(remaining))
+            if idle_remaining is not None:
+                self._start_idle_timer(int(idle_remaining))
+        else:
+            self._schedule_idle()
+
+    def power_stats(self):
+        """
+        Return the timer wake up counters.
+
+        Returns
+        -------
+        dict
+            frame_wakeups and idle_wakeups: times the frame and idle timers fired. wakeups: their sum.
+            wakeups_per_minute: wake ups per minute of the clock since the counters were reset. idle_streak: idle
+            animations played in a row, see clippy_qt.idle.IdlePolicy. suspended: whether the timers are suspended.
+        """
+        wakeups = self.frame_wakeups + self.idle_wakeups
+        elapsed = self.clock.now() - self._power_stats_start
+        return {
+            'frame_wakeups': self.frame_wakeups,
+            'idle_wakeups': self.idle_wakeups,
+            'wakeups': wakeups,
+            'wakeups_per_minute': wakeups * 60000.0 / elapsed if elapsed > 0 else 0.0,
+            'idle_streak': self.idle_policy.streak,
+            'suspended': self._suspended,
+        }
+
+    def reset_power_stats(self):
+        """ Reset the timer wake up counters. """
+        self.frame_wakeups = 0
+        self.idle_wakeups = 0
+        self._power_stats_start = self.clock.now()
+
+    def stop(self, right_now=False):
+        """ stop the current animation and clear the queue, the callbacks of the cleared requests are not called."""
+        discarded = [request.callback for request in self._queue.clear() if request.callback is not None]
+
+        if right_now and self._current_callback is not None:
+            discarded.append(self._current_callback)
+            self._current_callback = None  # Cancel the current callback
+        if self.on_discarded is not None:
+            for callback in discarded:
+                self.on_discarded(callback)
+
+        if not right_now and self._playing:
+            self._request_stop()
+            if self._suspend_requested:
+                # The cleared requests may have been the only callbacks keeping the timers running
+                self._update_suspension()
+            return
+        self._stop()
+
+    def stop_latency(self, animation):
+        """
+        Return the worst case time an animation keeps playing once asked to stop, with the current settings.
+
+        Parameters
+        ----------
+        animation : str
+
+        Returns
+        -------
+        float
+            Milliseconds, infinity if the animation can loop forever while stopping.
+        """
+        index = self.animations[animation].exit_index
+        if self.interrupt:
+            return index.interrupt_latency(self.max_stop_latency)
+        return index.natural_latency()
+
+    def timing_stats(self):
+        """
+        Return the frame timing counters.
+
+        Returns
+        -------
+        dict
+            late_ticks: ticks which fired more than late_tolerance ms after their frame's deadline.
+            skipped_frames: frames skipped to catch up with the clock, only in catch up mode.
+            interrupted_frames: frames of exit paths skipped to honour max_stop_latency.
+        """
+        return {'late_ticks': self.late_ticks, 'skipped_frames': self.skipped_frames,
+                'interrupted_frames': self.interrupted_frames}
+
+    def reset_timing_stats(self):
+        """ Reset the frame timing counters. """
+        self.late_ticks = 0
+        self.skipped_frames = 0
+        self.interrupted_frames = 0
+
+    def _enqueue(self, animation, right_now=False, callback=None, priority=0):
+        """ Play an animation now or queue it, see play(). """
+        if right_now:
+            self.stop(right_now=True)
+        if not self._playing:
+            self._play(animation, callback)
+        else:
+            for request, reason in self._queue.push(animation, callback, priority, self.clock.now()):
+                self._dropped(request, reason)
+        if self._suspended and callback is not None:
+            # Keep playing until the callback is called
+            self._update_suspension()
+
+    def _leave_idle(self):
+        self._idle_timer.stop()
+        if self._playing:
+            self._request_stop()
+
+    def _schedule_idle(self):
+        """ Start the idle timer, unless idle animations are disabled or the timers are suspended. """
+        if self._suspended or (self.idle_enabled is not None and not self.idle_enabled()):
+            return
+        self._start_idle_timer(self.idle_policy.next_delay(self.rng))
+
+    def _start_idle_timer(self, msec):
+        if self._suspended:
+            self._idle_remaining = msec
+            return
+        self._idle_deadline = self.clock.now() + msec
+        self._idle_timer.start(msec)
+
+    def _start_frame_timer(self, msec):
+        if self._suspended:
+            # Started by resume()
+            self._remaining = msec
+            return
+        self._timer.start(msec)
+
+    def _frame_timeout(self):
+        self.frame_wakeups += 1
+        if self.instrumentation is not None:
+            self.instrumentation.record(FRAME_LATENESS, self.clock.now() - self._frame_deadline)
+        self._next_frame()
+
+    def _idle_timeout(self):
+        self.idle_wakeups += 1
+        if self._playing:
+            # The idle animation played for long enough
+            self._request_stop()
+        else:
+            self.play_random_idle()
+
+    def _record(self, *event):
+        self.trace.append((self.clock.now(),) + event)
+
+    def _dropped(self, request, reason):
+        """ Resolve a request dropped from the queue: call its callback, as if it had played, and notify. """
+        if self.trace is not None:
+            self._record('dropped', request.animation, reason)
+        if request.callback is not None:
+            request.callback()
+        if self.on_dropped is not None:
+            self.on_dropped(request.animation, reason)
+
+    def _request_stop(self):
+        """ Ask the current animation to stop, jumping onto its exit path in interrupt mode. """
+        if self._stopping:
+            return
+        self._stopping = True
+        if not self.interrupt:
+            return
+
+        animation = self._current_animation
+        index = animation.exit_index
+        target = index.interrupt_target(self._current_frame, self.max_stop_latency)
+        # Count the frames of the path left out to fit in the latency budget
+        frame = index.next_frames[self._current_frame]
+        while frame != target:
+            self.interrupted_frames += 1
+            frame = index.next_frames[frame]
+        if target >= animation.frame_count:
+            self._stop()
+            return
+        self._current_frame = target
+        self._queue_next_frame()
+        self._play_sound()
+        self._frame_changed()
+
+    def _frame_changed(self):
+        if self.trace is not None and self._current_animation is not None:
+            self._record('frame', self._current_animation.name, self._current_frame,
+                         self._current_animation.sprites[self._current_frame],
+                         self._current_animation.source_frames[self._current_frame])
+        if self.on_frame is not None:
+            self.on_frame()
+
+    def _next_frame(self):
+        """ Advance to the next frame in the current animation. """
+        if self._current_animation is None:
+            return
+        if self.catch_up:
+            self._catch_up_frames()
+            return
+
+        if self.clock.now() - self._frame_deadline > self.late_tolerance:
+            self.late_ticks += 1
+        if not self._step():
+            self._stop()
+            return
+
+        self._queue_next_frame()
+        self._play_sound()
+        self._frame_changed()
+
+    def _catch_up_frames(self):
+        """ Advance to the frame which should be showing now, skipping the ones whose time has passed. """
+        animation = self._current_animation
+        now = self.clock.now()
+        frame_start = self._frame_deadline
+        if now - frame_start > self.late_tolerance:
+            self.late_ticks += 1
+
+        for _ in range(self.max_catch_up_frames):
+            if not self._step():
+                self._stop()
+                return
+            frame_end = frame_start + animation.durations[self._current_frame]
+            if frame_end > now:
+                break
+            self.skipped_frames += 1
+            frame_start = frame_end
+        else:
+            frame_end = now + animation.durations[self._current_frame]
+
+        self._frame_deadline = frame_end
+        self._start_frame_timer(max(int(frame_end - now), 0))
+        if now - frame_start <= self.late_tolerance:
+            self._play_sound()
+        self._frame_changed()
+
+    def _step(self):
+        """ Move to the next frame of the current animation, return False if the animation is over. """
+        animation = self._current_animation
+        frame = self._current_frame
+        next_frame = NO_BRANCH
+        if self._stopping:
+            if self.interrupt:
+                next_frame = animation.exit_index.next_frames[frame]
+            else:
+                next_frame = animation.exit_branches[frame]
+        if next_frame == NO_BRANCH and animation.branches[frame] is not None:
+            # Pick a random branch based on the weights of each possible branch
+            next_frame = animation.branches[frame].pick(self.rng.randint(0, 99))
+        if next_frame == NO_BRANCH:
+            next_frame = frame + 1
+
+        if next_frame >= animation.frame_count:
+            if not self._looping:
+                return False
+            next_frame = 0
+        self._current_frame = next_frame
+        return True
+
+    def _stop(self):
+        """ Fully stop the animation and notify it stopped. """
+        animation = self._current_animation
+        self._playing = False
+        self._stopping = False
+        self._current_animation = None
+        self._current_frame = 0
+        self._timer.stop()
+        self._idle_timer.stop()
+        self._remaining = None
+        self._idle_remaining = None
+        if self.on_frame is not None:
+            self.on_frame()
+        if self.trace is not None and animation is not None:
+            self._record('stopped', animation.name)
+        if self.instrumentation is not None and animation is not None:
+            self.instrumentation.record(animation_series(animation.name), self.clock.now() - self._started_at)
+        if self.on_stopped is not None:
+            self.on_stopped()
+        if self._current_callback:
+            if self.trace is not None and animation is not None:
+                self._record('callback', animation.name)
+            self._current_callback()
+            self._current_callback = None
+        if self._queue:
+            self._play_next_in_queue()
+        elif not self._playing:
+            # Nothing else to play, not even from the callback
+            self._schedule_idle()
+        if self._suspend_requested:
+            self._update_suspension()
+
+    def _play(self, animation, callback=None):
+        """ Play an animation and call the callback when done. """
+        self._current_animation = self.animations[animation]
+        # The idle timer may have been scheduled by the animation stopped to make room for this one
+        self._idle_timer.stop()
+        self._idle_remaining = None
+        if self.idle_policy.max_duration is not None and animation_category(animation) == self.idle_policy.category:
+            # Idle animations can loop for ever, the idle timer asks them to stop in time, even if they were queued
+            self._start_idle_timer(self.idle_policy.max_duration)
+        self._current_callback = callback
+        self._current_frame = 0
+        self._started_at = self.clock.now()
+        self._playing = True
+        if self.trace is not None:
+            self._record('started', animation)
+        if self.on_started is not None:
+            self.on_started()
+        self._queue_next_frame()
+        self._frame_changed()
+
+    def _play_next_in_queue(self):
+        """ Play the next animation in the queue. """
+        request = self._queue.pop()
+        if self.instrumentation is not None and request.queued_at is not None:
+            self.instrumentation.record(QUEUE_WAIT, self.clock.now() - request.queued_at)
+        self._play(request.animation, callback=request.callback)
+
+    def _queue_next_frame(self):
+        """ Queue the next frame in the animation. """
+        duration = self._current_animation.durations[self._current_frame]
+        self._frame_deadline = self.clock.now() + duration
+        self._start_frame_timer(duration)
+
+    def _play_sound(self):
+        """ Notify the sound of the current frame, if it has one. """
+        sound_id = self._current_animation.sounds[self._current_frame]
+        if sound_id == NO_SOUND:
+            return
+        if self.trace is not None:
+            self._record('sound', self._current_animation.name, self._current_frame, sound_id)
+        if self.on_sound is not None:
+            self.on_sound(sound_id)
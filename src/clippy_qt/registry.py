@@ -0,0 +1,437 @@
+""" Process wide registry of agent resources, shared between Agent instances. """
+import json
+import os
+import sys
+import threading
+from functools import partial
+
+from PySide2 import QtCore, QtGui
+
+from clippy_qt.animation import compile_animations
+from clippy_qt.bundle import Bundle, BundleError, find_bundle
+from clippy_qt.sound import BundledSound, SoundFile
+from clippy_qt.sprites import SpriteSheet
+
+
+class AgentAssets(object):
+    """
+    The loaded resources of an agent, shared by every Agent using them.
+
+    Attributes
+    ----------
+    key : tuple
+        Resolved paths of the config, sprite sheet and sounds directory.
+    animations : clippy_qt.animation.AnimationTable
+        Compiled, read only animation table.
+    atlas : QtGui.QPixmap or QtGui.QImage
+        The sprite sheet, an image backed by the mapped file when loaded from a bundle.
+    sounds : tuple
+        A clippy_qt.sound.SoundFile per sound id of the animation table, None for sounds with no file. Clips are
+        only read when they first play.
+    """
+
+    def __init__(self, key, animations, atlas, sounds, convert_atlas=False):
+        self.key = key
+        self.animations = animations
+        self.atlas = atlas
+        self.sounds = tuple(sounds)
+        self._convert_atlas = convert_atlas
+        self._sprite_sheets = {}
+
+    def finish(self):
+        """
+        Finish loading on the GUI thread.
+
+        Everything up to here can run on a worker thread, but pixmaps can only be created on the GUI thread.
+        """
+        if self._convert_atlas:
+            self.atlas = QtGui.QPixmap.fromImage(self.atlas)
+            self._convert_atlas = False
+
+    def sprite_sheet(self, mode):
+        """
+        Return the shared sprite sheet for a render mode, creating it on first use.
+
+        Parameters
+        ----------
+        mode : str
+            One of the RENDER_* modes of clippy_qt.sprites
+
+        Returns
+        -------
+        clippy_qt.sprites.SpriteSheet
+        """
+        sheet = self._sprite_sheets.get(mode)
+        if sheet is None:
+            width, height = self.animations.framesize
+            sheet = self._sprite_sheets[mode] = SpriteSheet(self.atlas, width, height, mode=mode)
+        return sheet
+
+
+def _load_sounds(animations, sounds):
+    """ Create a sound clip per sound id, for the wav files of a directory. """
+    # Sounds are stored by their id in the animation table, so frames can refer to them by index
+    sound_handles = [None] * len(animations.sounds)
+    if sounds and os.path.isdir(sounds):
+        sound_ids = dict((name, i) for i, name in enumerate(animations.sounds))
+        for wav_file in os.listdir(sounds):
+            sound_name, ext = os.path.splitext(wav_file)
+            if ext != '.wav' or sound_name not in sound_ids:
+                continue
+            sound_handles[sound_ids[sound_name]] = SoundFile(os.path.join(sounds, wav_file))
+    return sound_handles
+
+
+def _load_bundle(key, path):
+    """ Load the resources of an agent from a bundle. """
+    bundle = Bundle(path)
+    animations = bundle.animations
+    sounds = key[2]
+    if sounds and os.path.isdir(sounds):
+        sound_handles = _load_sounds(animations, sounds)
+    else:
+        bundled = set(bundle.sound_names())
+        sound_handles = [BundledSound(bundle, name) if name in bundled else None for name in animations.sounds]
+    return AgentAssets(key, animations, bundle.atlas(), sound_handles)
+
+
+def read_assets(key):
+    """
+    Read the resources of an agent from disk, safe to call from any thread.
+
+    An up to date bundle (see clippy_qt.bundle) is memory mapped when there is one, the config and sprite sheet are
+    parsed and decoded otherwise. The returned assets must be finished on the GUI thread before they are used.
+
+    Parameters
+    ----------
+    key : tuple
+        Resolved paths of the config (or bundle), sprite sheet and sounds directory. Sprite and sounds may be None.
+
+    Returns
+    -------
+    AgentAssets
+    """
+    config, sprite, sounds = key
+    bundle_path = find_bundle(config, sprite, sounds)
+    if bundle_path is not None:
+        try:
+            return _load_bundle(key, bundle_path)
+        except (BundleError, IOError, OSError, ValueError):
+            if bundle_path == config:
+                raise
+            # Stale or broken bundle, fall back to the sources
+
+    with open(config, 'r') as f:
+        animations = compile_animations(json.load(f))
+    return AgentAssets(key, animations, QtGui.QImage(sprite), _load_sounds(animations, sounds), convert_atlas=True)
+
+
+def load_assets(key):
+    """
+    Load the resources of an agent from disk, on the GUI thread.
+
+    Parameters
+    ----------
+    key : tuple
+        Resolved paths of the config (or bundle), sprite sheet and sounds directory. Sprite and sounds may be None.
+
+    Returns
+    -------
+    AgentAssets
+    """
+    assets = read_assets(key)
+    assets.finish()
+    return assets
+
+
+class AssetRequest(object):
+    """
+    A pending asynchronous acquire, see AssetRegistry.acquire_async().
+
+    Attributes
+    ----------
+    assets : AgentAssets or None
+        The acquired assets, once they are loaded.
+    """
+
+    def __init__(self, registry, callback, error_callback=None):
+        self.assets = None
+        self._registry = registry
+        self._callback = callback
+        self._error_callback = error_callback
+        self._cancelled = False
+
+    def cancel(self):
+        """ Give up on the request, releasing the assets if they were already delivered. """
+        self._cancelled = True
+        self._callback = None
+        self._error_callback = None
+        if self.assets is not None:
+            self._registry.release(self.assets)
+            self.assets = None
+
+    def _deliver(self, assets):
+        if self._cancelled:
+            return
+        self.assets = assets
+        self._registry._add_reference(assets.key)
+        callback, self._callback = self._callback, None
+        self._error_callback = None
+        callback(assets)
+
+    def _fail(self, error):
+        if self._cancelled:
+            return
+        error_callback, self._error_callback = self._error_callback, None
+        self._callback = None
+        if error_callback is not None:
+            error_callback(error)
+        else:
+            # Report it like Qt would for a slot, without leaving the other requests waiting
+            sys.excepthook(type(error), error, error.__traceback__)
+
+
+class _LoaderSignals(QtCore.QObject):
+    finished = QtCore.Signal(object, object, object)
+
+
+class _AssetLoader(QtCore.QRunnable):
+    """ Read the assets of an agent on a thread pool. """
+
+    def __init__(self, key):
+        super(_AssetLoader, self).__init__()
+        self.key = key
+        # Created on the GUI thread, so queued connections to it are delivered there
+        self.signals = _LoaderSignals()
+
+    def run(self):
+        try:
+            assets = read_assets(self.key)
+        except Exception as error:
+            self.signals.finished.emit(self.key, None, error)
+        else:
+            self.signals.finished.emit(self.key, assets, None)
+
+
+class AssetRegistry(object):
+    """
+    Cache of agent resources, keyed by the resolved paths of the agent files.
+
+    Every acquire() must be balanced by a release(). Released resources stay cached so the next agent using them
+    loads instantly, until they are evicted with evict(), evict_unused() or clear(). Evicting resources which are
+    still in use only removes them from the registry, agents holding them keep working.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._ref_counts = {}
+        self._loading = {}
+        self._loaders = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(config, sprite, sounds):
+        """
+        Return the registry key for a set of agent files.
+
+        Parameters
+        ----------
+        config : str
+        sprite : str or None
+        sounds : str or None
+
+        Returns
+        -------
+        tuple
+        """
+        return (os.path.realpath(config),
+                os.path.realpath(sprite) if sprite else None,
+                os.path.realpath(sounds) if sounds else None)
+
+    def acquire(self, config, sprite, sounds):
+        """
+        Get the resources of an agent, loading them if they are not cached yet.
+
+        Parameters
+        ----------
+        config : str
+            Path to the agent's config.json, or to a bundle
+        sprite : str or None
+            Path to the agent's sprite sheet, unused when config is a bundle
+        sounds : str or None
+            Path to the directory containing the agent's sounds
+
+        Returns
+        -------
+        AgentAssets
+        """
+        key = self.key(config, sprite, sounds)
+        with self._lock:
+            assets = self._entries.get(key)
+            if assets is None:
+                self.misses += 1
+                assets = self._entries[key] = load_assets(key)
+            else:
+                self.hits += 1
+            self._add_reference(key)
+            return assets
+
+    def acquire_async(self, config, sprite, sounds, callback, pool=None, error_callback=None):
+        """
+        Get the resources of an agent without blocking the GUI thread.
+
+        Files are read and decoded on a thread pool, then the resources are finished on the GUI thread, which calls
+        callback with them. Cached resources are delivered on the next event loop iteration, the callback is never
+        called before this method returns. Concurrent requests for the same files share a single load. Must be
+        called from the GUI thread.
+
+        Parameters
+        ----------
+        config : str
+        sprite : str or None
+        sounds : str or None
+            See acquire()
+        callback : callable
+            Called with the AgentAssets once they are ready. They are acquired for the callback, release them with
+            release(), or cancel the request.
+        pool : QtCore.QThreadPool
+            Thread pool to load on, defaults to the global instance.
+        error_callback : callable
+            Called with the exception if the resources could not be loaded. Without one, the exception is reported
+            to sys.excepthook.
+
+        Returns
+        -------
+        AssetRequest
+        """
+        key = self.key(config, sprite, sounds)
+        request = AssetRequest(self, callback, error_callback)
+        with self._lock:
+            assets = self._entries.get(key)
+            if assets is None:
+                waiting = self._loading.get(key)
+                if waiting is not None:
+                    self.hits += 1
+                    waiting.append(request)
+                    return request
+                self.misses += 1
+                self._loading[key] = [request]
+            else:
+                self.hits += 1
+        if assets is not None:
+            # Give the caller a chance to connect to whatever the callback triggers
+            QtCore.QTimer.singleShot(0, partial(request._deliver, assets))
+            return request
+
+        loader = self._loaders[key] = _AssetLoader(key)
+        loader.setAutoDelete(False)
+        loader.signals.finished.connect(self._loaded, QtCore.Qt.QueuedConnection)
+        (pool or QtCore.QThreadPool.globalInstance()).start(loader)
+        return request
+
+    def _loaded(self, key, assets, error):
+        """ Finish assets read by an _AssetLoader, on the GUI thread. """
+        with self._lock:
+            requests = self._loading.pop(key, [])
+            self._loaders.pop(key, None)
+            if error is None:
+                assets.finish()
+                self._entries[key] = assets
+        for request in requests:
+            if error is None:
+                request._deliver(assets)
+            else:
+                request._fail(error)
+
+    def _add_reference(self, key):
+        with self._lock:
+            self._ref_counts[key] = self._ref_counts.get(key, 0) + 1
+
+    def release(self, assets):
+        """
+        Release resources previously returned by acquire().
+
+        Parameters
+        ----------
+        assets : AgentAssets
+        """
+        with self._lock:
+            if self._entries.get(assets.key) is not assets:
+                # Evicted while in use, nothing to track anymore
+                return
+            self._ref_counts[assets.key] = max(self._ref_counts.get(assets.key, 0) - 1, 0)
+
+    def ref_count(self, key):
+        """ Return the number of agents currently using the resources of a key. """
+        with self._lock:
+            return self._ref_counts.get(key, 0)
+
+    def evict(self, key):
+        """
+        Remove the resources of a key from the registry.
+
+        Parameters
+        ----------
+        key : tuple
+            As returned by AssetRegistry.key() or AgentAssets.key
+
+        Returns
+        -------
+        bool
+            True if the key was cached.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is None:
+                return False
+            self._ref_counts.pop(key, None)
+            self.evictions += 1
+            return True
+
+    def evict_unused(self):
+        """
+        Remove every resource which is not used by any agent.
+
+        Returns
+        -------
+        int
+            Number of evicted entries.
+        """
+        with self._lock:
+            unused = [key for key in self._entries if not self._ref_counts.get(key)]
+            for key in unused:
+                self.evict(key)
+            return len(unused)
+
+    def clear(self):
+        """ Remove every resource from the registry, and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            self._ref_counts.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Return the registry counters.
+
+        Returns
+        -------
+        dict
+            hits, misses, evictions, the number of cached entries and the number of entries in use.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'in_use': sum(1 for count in self._ref_counts.values() if count),
+            }
+
+
+# The registry used by agents unless they are given their own
+shared_registry = AssetRegistry()
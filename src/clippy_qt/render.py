@@ -0,0 +1,306 @@
+"""
+Render the animations of an agent to images, headlessly.
+
+Usage: python -m clippy_qt.render AGENT [--output DIR] [--layout strip|sequence] [--seed N] [--jobs N]
+
+AGENT is the name of an installed agent (see clippy_qt.agents), or the path of a config.json or bundle. Every
+animation is played by a Playback on a VirtualClock, with branching seeded per animation so renders are reproducible,
+and its frames are painted from the atlas into images: a horizontal strip per animation, or a numbered PNG per frame.
+Next to them, a JSON sidecar records the sprite, start time, duration and sound of every frame, and the index of the
+config frame it started with, as runs of identical frames are merged when compiling.
+
+Rendering never creates a QTimer, a QApplication or a window, animations are spread over a pool of processes.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PySide2 import QtCore, QtGui
+
+from clippy_qt.latency import load_animations
+from clippy_qt.playback import Playback, VirtualClock
+from clippy_qt.registry import AssetRegistry, read_assets
+from clippy_qt.sprites import RENDER_ATLAS
+
+# One image per animation, its frames side by side.
+LAYOUT_STRIP = 'strip'
+# One image per frame, in a directory per animation.
+LAYOUT_SEQUENCE = 'sequence'
+
+LAYOUTS = (LAYOUT_STRIP, LAYOUT_SEQUENCE)
+
+
+def walk_animation(animations, name, seed=0, max_duration=10000):
+    """
+    Play an animation on a virtual clock and return the frames it shows.
+
+    Animations which are still playing after max_duration, looping ones, are asked to stop and follow their exit
+    path, and are stopped right away if that takes another max_duration as well.
+
+    Parameters
+    ----------
+    animations : clippy_qt.animation.AnimationTable
+    name : str
+    seed : int
+        Seed of the branching, combined with the animation name.
+    max_duration : int
+        In milliseconds.
+
+    Returns
+    -------
+    dict
+        'animation', 'seed', 'duration' in milliseconds, 'truncated' if the animation had to be stopped, and 'frames':
+        a dict per frame shown with its 'frame' index in the compiled animation, the 'source_frame' index in the
+        config it started with (compiled frames may merge several, see clippy_qt.animation.collapse_frame_runs), its
+        'sprite' index, 'time' and 'duration' in milliseconds and its 'sound' name, or None.
+    """
+    clock = VirtualClock()
+    playback = Playback(animations, clock, rng=random.Random('{}:{}'.format(seed, name)), trace=True, interrupt=True)
+    playback.idle_enabled = lambda: False
+    playback.play(name)
+    clock.run(limit=max_duration)
+    truncated = playback.is_playing()
+    if truncated:
+        playback.stop()
+        clock.run(limit=clock.now() + max_duration)
+        if playback.is_playing():
+            playback.stop(right_now=True)
+
+    frames = []
+    end = clock.now()
+    for event in playback.trace:
+        if event[1] == 'frame':
+            frames.append({'frame': event[3], 'source_frame': event[5], 'sprite': event[4], 'time': event[0],
+                           'duration': 0, 'sound': None})
+        elif event[1] == 'sound':
+            frames[-1]['sound'] = animations.sounds[event[4]]
+        elif event[1] == 'stopped':
+            end = event[0]
+    for frame, following in zip(frames, frames[1:] + [None]):
+        frame['duration'] = (following['time'] if following is not None else end) - frame['time']
+    return {'animation': name, 'seed': seed, 'duration': end, 'truncated': truncated, 'frames': frames}
+
+
+def render_frame(sheet, sprite):
+    """
+    Paint a sprite into its own image.
+
+    Parameters
+    ----------
+    sheet : clippy_qt.sprites.SpriteSheet
+    sprite : int
+        Negative for a blank frame.
+
+    Returns
+    -------
+    QtGui.QImage
+    """
+    return render_strip(sheet, [sprite])
+
+
+def render_strip(sheet, sprites):
+    """
+    Paint sprites side by side into a single image.
+
+    Parameters
+    ----------
+    sheet : clippy_qt.sprites.SpriteSheet
+    sprites : sequence of int
+
+    Returns
+    -------
+    QtGui.QImage
+    """
+    image = QtGui.QImage(sheet.tile_width * max(len(sprites), 1), sheet.tile_height,
+                         QtGui.QImage.Format_ARGB32_Premultiplied)
+    image.fill(QtCore.Qt.transparent)
+    painter = QtGui.QPainter(image)
+    for i, sprite in enumerate(sprites):
+        sheet.draw(painter, i * sheet.tile_width, 0, sprite)
+    painter.end()
+    return image
+
+
+class AnimationRenderer(object):
+    """
+    Render the animations of an agent to files.
+
+    Parameters
+    ----------
+    config : str
+        Path of the agent's config.json or bundle.
+    sprite : str
+        Path of the agent's sprite sheet, may be None for a bundle.
+    output : str
+        Directory to write the images and sidecars to.
+    layout : str
+        LAYOUT_STRIP or LAYOUT_SEQUENCE.
+    seed : int
+    max_duration : int
+        See walk_animation().
+    """
+
+    def __init__(self, config, sprite, output, layout=LAYOUT_STRIP, seed=0, max_duration=10000):
+        if layout not in LAYOUTS:
+            raise ValueError('layout must be one of {}, not {!r}'.format(', '.join(LAYOUTS), layout))
+        # The atlas stays a QImage, pixmaps would need a display
+        assets = read_assets(AssetRegistry.key(config, sprite, None))
+        self.animations = assets.animations
+        self.sheet = assets.sprite_sheet(RENDER_ATLAS)
+        self.output = output
+        self.layout = layout
+        self.seed = seed
+        self.max_duration = max_duration
+
+    def render(self, name):
+        """
+        Render an animation, and write its images and sidecar.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        dict
+            The sidecar, see walk_animation(), with the 'framesize' and 'layout' of the images, and the 'image' of
+            the strip or the 'image' of every frame, relative to the output directory.
+        """
+        walk = walk_animation(self.animations, name, self.seed, self.max_duration)
+        walk['framesize'] = [self.sheet.tile_width, self.sheet.tile_height]
+        walk['layout'] = self.layout
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output, exist_ok=True)
+
+        if self.layout == LAYOUT_STRIP:
+            walk['image'] = '{}.png'.format(name)
+            self._save(render_strip(self.sheet, [frame['sprite'] for frame in walk['frames']]), walk['image'])
+        else:
+            os.makedirs(os.path.join(self.output, name), exist_ok=True)
+            # Frames showing the same sprite share their image
+            images = {}
+            for frame in walk['frames']:
+                image = images.get(frame['sprite'])
+                if image is None:
+                    image = images[frame['sprite']] = '{}/{}_{:04d}.png'.format(name, name, len(images))
+                    self._save(render_frame(self.sheet, frame['sprite']), image)
+                frame['image'] = image
+
+        with open(os.path.join(self.output, '{}.json'.format(name)), 'w') as f:
+            json.dump(walk, f, indent=1)
+        return walk
+
+    def _save(self, image, relative_path):
+        path = os.path.join(self.output, relative_path)
+        if not image.save(path, 'PNG'):
+            raise IOError('Could not write {}'.format(path))
+
+
+# Renderer of a worker process, created once per process by _init_worker
+_worker_renderer = None
+
+
+def _init_worker(*args):
+    global _worker_renderer
+    _worker_renderer = AnimationRenderer(*args)
+
+
+def _render_in_worker(name):
+    return _worker_renderer.render(name)
+
+
+def render_agent(config, sprite, output, names=None, layout=LAYOUT_STRIP, seed=0, max_duration=10000, jobs=None,
+                 report=None):
+    """
+    Render animations of an agent, spread over a pool of processes.
+
+    Parameters
+    ----------
+    config : str
+    sprite : str
+    output : str
+    names : sequence of str
+        Animations to render, defaults to all of them.
+    layout : str
+    seed : int
+    max_duration : int
+        See AnimationRenderer.
+    jobs : int
+        Number of worker processes, defaults to the number of CPUs. 1 renders in this process.
+    report : callable
+        Called with the sidecar of every animation as soon as it is rendered.
+
+    Returns
+    -------
+    dict
+        Sidecar of every animation, by name.
+    """
+    args = (config, sprite, output, layout, seed, max_duration)
+    if names is None:
+        names = load_animations(config).names()
+    sidecars = {}
+    if jobs == 1 or len(names) < 2:
+        renderer = AnimationRenderer(*args)
+        for name in names:
+            sidecars[name] = renderer.render(name)
+            if report is not None:
+                report(sidecars[name])
+        return sidecars
+
+    # Spawned, not forked: forking a process which already runs Qt is not safe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init_worker,
+                             initargs=args) as pool:
+        futures = [pool.submit(_render_in_worker, name) for name in names]
+        for future in as_completed(futures):
+            sidecar = future.result()
+            sidecars[sidecar['animation']] = sidecar
+            if report is not None:
+                report(sidecar)
+    return sidecars
+
+
+def agent_paths(agent):
+    """ Return the config and sprite sheet paths of an installed agent's name, or of a config.json or bundle path. """
+    if os.path.isfile(agent):
+        return agent, os.path.join(os.path.dirname(agent), 'map.png')
+    from clippy_qt.agents import agent_catalog
+
+    manifest = agent_catalog().manifest(agent)
+    return manifest.config, manifest.sprite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('agent', help='Name of an installed agent, or path of a config.json or bundle')
+    parser.add_argument('--output', default='renders', help='Directory to write to, defaults to ./renders')
+    parser.add_argument('--layout', choices=LAYOUTS, default=LAYOUT_STRIP)
+    parser.add_argument('--animation', action='append', dest='names', help='Only render some animations')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the branching')
+    parser.add_argument('--max-duration', type=int, default=10000, metavar='MS',
+                        help='Time after which looping animations are stopped')
+    parser.add_argument('--jobs', '-j', type=int, help='Number of processes, defaults to the CPU count')
+    args = parser.parse_args(argv)
+
+    try:
+        config, sprite = agent_paths(args.agent)
+    except KeyError as error:
+        parser.error(error.args[0])
+
+    def report(sidecar):
+        print('{:<20} {:>4} frames {:>7} ms{}'.format(sidecar['animation'], len(sidecar['frames']),
+                                                      int(sidecar['duration']),
+                                                      ', truncated' if sidecar['truncated'] else ''))
+
+    start = time.perf_counter()
+    sidecars = render_agent(config, sprite, args.output, args.names, args.layout, args.seed, args.max_duration,
+                            args.jobs, report)
+    print('Rendered {} animations to {} in {:.2f}s'.format(len(sidecars), args.output, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Clocks driving the agents' animation timers.
+
+By default every agent owns its own QTimers (LocalClock). With many agents on screen, a shared AnimationScheduler
+drives all of them from a single precise timer instead: it keeps the deadlines of every agent in a priority queue,
+wakes up once for all the deadlines that fall in the same batch and fires them together. The repaints the agents
+request while a batch fires are posted in the same event loop iteration, so Qt paints them in a single pass.
+"""
+import heapq
+import itertools
+import sys
+
+from PySide2 import QtCore
+
+
+class LocalClock(object):
+    """ Give every timer its own single shot QTimer. """
+
+    def __init__(self):
+        self._elapsed = QtCore.QElapsedTimer()
+        self._elapsed.start()
+
+    def now(self):
+        """ Return the time of the clock, in milliseconds. """
+        return self._elapsed.nsecsElapsed() / 1e6
+
+    def create_timer(self, callback, parent=None):
+        """
+        Create a single shot timer.
+
+        Parameters
+        ----------
+        callback : callable
+            Called when the timer fires.
+        parent : QtCore.QObject
+            The timer stops when its parent is destroyed.
+
+        Returns
+        -------
+        QtCore.QTimer
+        """
+        timer = QtCore.QTimer(parent)
+        timer.setSingleShot(True)
+        timer.timeout.connect(callback)
+        return timer
+
+
+LOCAL_CLOCK = LocalClock()
+
+
+class ScheduledTimer(object):
+    """
+    A single shot timer driven by an AnimationScheduler, with the same start/stop/isActive API as a QTimer.
+    """
+
+    def __init__(self, scheduler, callback):
+        self._scheduler = scheduler
+        self._callback = callback
+        self._generation = 0
+        self._active = False
+
+    def start(self, msec):
+        """ (Re)start the timer, firing in msec milliseconds. """
+        self._generation += 1
+        self._active = True
+        self._scheduler._schedule(self, msec)
+
+    def stop(self):
+        """ Stop the timer, it will not fire. """
+        # Entries of previous generations left in the scheduler's queue are skipped when they are popped
+        self._generation += 1
+        self._active = False
+
+    def isActive(self):
+        return self._active
+
+    def _fire(self, generation):
+        if generation != self._generation or not self._active:
+            return False
+        self._active = False
+        self._callback()
+        return True
+
+
+class AnimationScheduler(QtCore.QObject):
+    """
+    A single clock for many agents.
+
+    Parameters
+    ----------
+    batch_window : float
+        Deadlines falling less than this many milliseconds after the one the scheduler woke up for fire in the same
+        batch, instead of waking up again.
+    parent : QtCore.QObject
+
+    Attributes
+    ----------
+    wakeups : int
+        Number of times the scheduler woke up.
+    fired : int
+        Number of timers fired.
+    """
+
+    def __init__(self, batch_window=4.0, parent=None):
+        super(AnimationScheduler, self).__init__(parent)
+        self.batch_window = batch_window
+        self.wakeups = 0
+        self.fired = 0
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._armed_deadline = None
+        self._firing = False
+        self._elapsed = QtCore.QElapsedTimer()
+        self._elapsed.start()
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._timer.timeout.connect(self._wake_up)
+
+    def now(self):
+        """ Return the time of the scheduler's clock, in milliseconds. """
+        return self._elapsed.nsecsElapsed() / 1e6
+
+    def create_timer(self, callback, parent=None):
+        """
+        Create a single shot timer driven by this scheduler.
+
+        Parameters
+        ----------
+        callback : callable
+            Called when the timer fires.
+        parent : QtCore.QObject
+            The timer stops when its parent is destroyed.
+
+        Returns
+        -------
+        ScheduledTimer
+        """
+        timer = ScheduledTimer(self, callback)
+        if parent is not None:
+            parent.destroyed.connect(timer.stop)
+        return timer
+
+    def pending(self):
+        """ Return the number of timers waiting to fire. """
+        return sum(1 for _deadline, _order, timer, generation in self._queue
+                   if timer._active and timer._generation == generation)
+
+    def _schedule(self, timer, msec):
+        deadline = self.now() + msec
+        heapq.heappush(self._queue, (deadline, next(self._counter), timer, timer._generation))
+        if self._firing:
+            # Re-armed once the batch is done
+            return
+        if self._armed_deadline is None or deadline < self._armed_deadline:
+            self._arm(deadline)
+
+    def _arm(self, deadline):
+        self._armed_deadline = deadline
+        self._timer.start(max(int(deadline - self.now() + 0.999), 0))
+
+    def _wake_up(self):
+        """ Fire every timer whose deadline falls in this batch. """
+        self.wakeups += 1
+        self._armed_deadline = None
+        limit = self.now() + self.batch_window
+        queue = self._queue
+        # Timers started by callbacks of this batch wait for the next one, even if they are due within the window
+        due = []
+        while queue and queue[0][0] <= limit:
+            due.append(heapq.heappop(queue))
+        self._firing = True
+        try:
+            for _deadline, _order, timer, generation in due:
+                try:
+                    if timer._fire(generation):
+                        self.fired += 1
+                except Exception:
+                    # Report it like Qt would for a slot, without starving the rest of the batch
+                    sys.excepthook(*sys.exc_info())
+        finally:
+            self._firing = False
+
+        # Drop cancelled entries from the top of the queue, so they never cause a wake up on their own
+        while queue and (not queue[0][2]._active or queue[0][2]._generation != queue[0][3]):
+            heapq.heappop(queue)
+        if queue:
+            self._arm(queue[0][0])
+
+
+_global_scheduler = None
+
+
+def global_scheduler():
+    """
+    Return the process wide animation scheduler, creating it on first use.
+
+    Returns
+    -------
+    AnimationScheduler
+    """
+    global _global_scheduler
+    if _global_scheduler is None:
+        _global_scheduler = AnimationScheduler(parent=QtCore.QCoreApplication.instance())
+    return _global_scheduler
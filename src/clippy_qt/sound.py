@@ -0,0 +1,457 @@
+"""
+Sound playback for agents.
+
+Sounds are clips (a wav file, or a wav stored in a bundle) which are only read the first time they play, into a
+cache shared by every agent. A SoundMixer plays them on a small pool of voices: when every voice is busy, a new sound
+is either dropped or steals the voice which has been playing the longest, so fast animations cannot pile up
+overlapping sounds.
+
+Voices come from a backend, which loads each clip into a player (a QSoundEffect for QtBackend) once and hands the
+loaded players to the voices, so playing a clip again neither reads nor decodes it again. QtBackend is the only part
+importing QtMultimedia, when the first sound plays. SilentBackend plays nothing but keeps voices busy for the duration
+of their clip, to run the mixer headlessly.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import warnings
+import wave
+
+
+# When every voice is busy, drop the new sound.
+VOICE_DROP = 'drop'
+# When every voice is busy, stop the sound playing for the longest and play the new one instead.
+VOICE_STEAL = 'steal'
+
+VOICE_POLICIES = (VOICE_DROP, VOICE_STEAL)
+
+
+class SoundFile(object):
+    """
+    A sound clip stored in a wav file.
+
+    Attributes
+    ----------
+    key : object
+        Identifies the clip in a ClipCache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.key = os.path.realpath(path)
+
+    def file(self):
+        """ Return the path of a wav file with the clip's data. """
+        return self.path
+
+    def read(self):
+        """ Return a readable binary file object with the clip's data. """
+        return open(self.path, 'rb')
+
+
+class BundledSound(SoundFile):
+    """
+    A sound clip stored in a bundle (see clippy_qt.bundle).
+
+    Sound effects can only play files, so the wav data is written to a cache directory the first time it is needed.
+    """
+
+    def __init__(self, bundle, name):
+        super(BundledSound, self).__init__(bundle.path)
+        self.key = (self.key, name)
+        self._bundle = bundle
+        self._name = name
+
+    def file(self):
+        digest = hashlib.sha1(self.key[0].encode('utf-8')).hexdigest()[:16]
+        directory = os.path.join(tempfile.gettempdir(), 'clippy_qt', digest)
+        path = os.path.join(directory, '{}.wav'.format(self._name))
+        data = self._bundle.sound_data(self._name)
+        if not os.path.exists(path) or os.path.getsize(path) != len(data):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def read(self):
+        return io.BytesIO(self._bundle.sound_data(self._name))
+
+
+class Clip(object):
+    """
+    A loaded sound clip.
+
+    Attributes
+    ----------
+    path : str
+        Path of a wav file holding the clip.
+    duration : float
+        Length of the clip, in milliseconds.
+    """
+
+    __slots__ = ('path', 'duration')
+
+    def __init__(self, path, duration):
+        self.path = path
+        self.duration = duration
+
+
+class ClipCache(object):
+    """ Clips loaded on first use, shared between agents. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clips = {}
+        self.loads = 0
+
+    def __len__(self):
+        return len(self._clips)
+
+    def get(self, sound):
+        """
+        Return the loaded clip of a sound, loading it on first use.
+
+        Parameters
+        ----------
+        sound : SoundFile
+
+        Returns
+        -------
+        Clip
+        """
+        clip = self._clips.get(sound.key)
+        if clip is not None:
+            return clip
+        with self._lock:
+            clip = self._clips.get(sound.key)
+            if clip is None:
+                stream = sound.read()
+                try:
+                    reader = wave.open(stream, 'rb')
+                    duration = reader.getnframes() * 1000.0 / reader.getframerate()
+                    reader.close()
+                finally:
+                    stream.close()
+                clip = self._clips[sound.key] = Clip(sound.file(), duration)
+                self.loads += 1
+        return clip
+
+    def clear(self):
+        """ Forget every loaded clip. """
+        with self._lock:
+            self._clips.clear()
+
+
+class Voice(object):
+    """
+    A voice of a backend, playing one clip at a time on the players the backend keeps loaded for each clip.
+
+    Playing the clip it played last reuses the same player, another clip gives that player back to the backend.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._player = None
+        self.clip = None
+
+    def play(self, clip):
+        if clip is not self.clip:
+            if self._player is not None:
+                self._player.stop()
+                self._backend.release(self.clip, self._player)
+            self._player = self._backend.acquire(clip)
+            self.clip = clip
+        self._player.play()
+
+    def stop(self):
+        if self._player is not None:
+            self._player.stop()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+
+class Backend(object):
+    """
+    Base of the backends: creates voices, and keeps a player loaded with each clip so clips load once per player.
+
+    Attributes
+    ----------
+    loads : int
+        Players created, each of which loaded and decoded its clip.
+    """
+
+    def __init__(self):
+        # Players no voice uses, by clip, ready to play again
+        self._idle = {}
+        self.loads = 0
+
+    def create_voice(self):
+        return Voice(self)
+
+    def acquire(self, clip):
+        """
+        Return a player loaded with a clip, reusing an idle one if there is one.
+
+        Parameters
+        ----------
+        clip : Clip
+
+        Returns
+        -------
+        object
+            Has play(), stop() and is_playing() methods.
+        """
+        idle = self._idle.get(clip)
+        if idle:
+            return idle.pop()
+        self.loads += 1
+        return self._load(clip)
+
+    def release(self, clip, player):
+        """ Take back the player of a clip a voice no longer uses, for the next voice playing the clip. """
+        self._idle.setdefault(clip, []).append(player)
+
+    def _load(self, clip):
+        """ Return a new player with a clip loaded. """
+        raise NotImplementedError
+
+
+class SilentPlayer(object):
+    """ A player of the SilentBackend, busy for the duration of its clip. """
+
+    def __init__(self, backend, clip):
+        self._backend = backend
+        self._end = 0.0
+        self.clip = clip
+
+    def play(self):
+        self._end = self._backend.now() + self.clip.duration
+        self._backend.played.append(self.clip.path)
+
+    def stop(self):
+        self._end = 0.0
+
+    def is_playing(self):
+        return self._backend.now() < self._end
+
+
+class SilentBackend(Backend):
+    """
+    A backend which plays nothing, for headless use and tests.
+
+    Parameters
+    ----------
+    clock : object
+        Clock with a now() method returning milliseconds, like the clocks of clippy_qt.scheduler or a
+        clippy_qt.playback.VirtualClock. Defaults to the wall clock.
+
+    Attributes
+    ----------
+    played : list
+        Path of every clip played, in order.
+    """
+
+    def __init__(self, clock=None):
+        super(SilentBackend, self).__init__()
+        self._clock = clock
+        self.played = []
+
+    def now(self):
+        if self._clock is None:
+            return time.monotonic() * 1000
+        return self._clock.now()
+
+    def _load(self, clip):
+        return SilentPlayer(self, clip)
+
+
+class QtPlayer(object):
+    """ A player of the QtBackend, a QSoundEffect which loads and decodes its clip once, when created. """
+
+    def __init__(self, effect):
+        self._effect = effect
+
+    def play(self):
+        self._effect.play()
+
+    def stop(self):
+        self._effect.stop()
+
+    def is_playing(self):
+        # A player whose source is still loading has not started yet, it is busy as well
+        return self._effect.isPlaying() or self._effect.status() == self._effect.Loading
+
+
+class QtBackend(Backend):
+    """
+    A backend playing voices with QtMultimedia's QSoundEffect, which is imported when the backend is created.
+
+    Parameters
+    ----------
+    volume : float
+        Volume of every voice, between 0 and 1.
+    parent : QtCore.QObject
+        Parent of the sound effects.
+    """
+
+    def __init__(self, volume=1.0, parent=None):
+        from PySide2 import QtCore, QtMultimedia
+
+        super(QtBackend, self).__init__()
+        self.volume = volume
+        self._parent = parent
+        self._effect_type = QtMultimedia.QSoundEffect
+        self._url_type = QtCore.QUrl
+
+    def _load(self, clip):
+        effect = self._effect_type(self._parent)
+        effect.setVolume(self.volume)
+        effect.setSource(self._url_type.fromLocalFile(clip.path))
+        return QtPlayer(effect)
+
+
+class SoundMixer(object):
+    """
+    Play sounds on a bounded pool of voices.
+
+    Parameters
+    ----------
+    backend : object
+        Creates the voices, QtBackend or SilentBackend.
+    max_voices : int
+        Maximum number of sounds playing at once.
+    policy : str
+        VOICE_DROP or VOICE_STEAL, what happens to a sound played while every voice is busy.
+    cache : ClipCache
+        Cache to load clips into, defaults to the process wide one.
+
+    Attributes
+    ----------
+    played : int
+    dropped : int
+        Sounds not played because every voice was busy.
+    stolen : int
+        Sounds cut short to play a newer one.
+    errors : int
+        Sounds whose clip could not be loaded.
+    """
+
+    def __init__(self, backend, max_voices=4, policy=VOICE_STEAL, cache=None):
+        if policy not in VOICE_POLICIES:
+            raise ValueError('policy must be one of {}, not {!r}'.format(', '.join(VOICE_POLICIES), policy))
+        if max_voices < 1:
+            raise ValueError('max_voices must be at least 1, not {}'.format(max_voices))
+        self.backend = backend
+        self.max_voices = max_voices
+        self.policy = policy
+        self.cache = cache if cache is not None else shared_clip_cache
+        self.played = 0
+        self.dropped = 0
+        self.stolen = 0
+        self.errors = 0
+        # Voices in the order they last started playing, the oldest first
+        self._voices = []
+
+    def play(self, sound):
+        """
+        Play a sound, if a voice is available for it.
+
+        Parameters
+        ----------
+        sound : SoundFile
+
+        Returns
+        -------
+        bool
+            False if the sound was dropped, or could not be loaded.
+        """
+        try:
+            clip = self.cache.get(sound)
+        except (IOError, OSError, EOFError, wave.Error):
+            self.errors += 1
+            return False
+        voice = self._free_voice()
+        if voice is None:
+            if self.policy == VOICE_DROP:
+                self.dropped += 1
+                return False
+            voice = self._voices.pop(0)
+            voice.stop()
+            self.stolen += 1
+        else:
+            self._voices.remove(voice)
+        voice.play(clip)
+        self._voices.append(voice)
+        self.played += 1
+        return True
+
+    def stop(self):
+        """ Stop every sound playing. """
+        for voice in self._voices:
+            voice.stop()
+
+    def playing(self):
+        """ Return the number of voices playing. """
+        return sum(1 for voice in self._voices if voice.is_playing())
+
+    def stats(self):
+        """
+        Return the mixer counters.
+
+        Returns
+        -------
+        dict
+            played, dropped and stolen sounds, load errors, clip loads of the backend, voices created and voices
+            playing.
+        """
+        return {
+            'played': self.played,
+            'dropped': self.dropped,
+            'stolen': self.stolen,
+            'errors': self.errors,
+            'loads': self.backend.loads,
+            'voices': len(self._voices),
+            'playing': self.playing(),
+        }
+
+    def _free_voice(self):
+        """ Return an idle voice, creating one if the limit allows, or None. """
+        for voice in self._voices:
+            if not voice.is_playing():
+                return voice
+        if len(self._voices) < self.max_voices:
+            voice = self.backend.create_voice()
+            self._voices.append(voice)
+            return voice
+        return None
+
+
+shared_clip_cache = ClipCache()
+
+_default_mixer = None
+
+
+def default_mixer():
+    """
+    Return the process wide mixer used by agents, creating it when the first sound plays.
+
+    It plays through QtMultimedia, or silently if QtMultimedia is not available.
+
+    Returns
+    -------
+    SoundMixer
+    """
+    global _default_mixer
+    if _default_mixer is None:
+        try:
+            backend = QtBackend()
+        except ImportError as error:
+            warnings.warn('QtMultimedia is not available, sounds are disabled: {}'.format(error))
+            backend = SilentBackend()
+        _default_mixer = SoundMixer(backend)
+    return _default_mixer
@@ -0,0 +1,299 @@
+""" Sprite sheet access for agents. """
+import weakref
+from collections import OrderedDict
+
+from PySide2 import QtCore, QtGui
+
+
+# Draw tiles straight out of the atlas, no per tile pixmaps exist.
+RENDER_ATLAS = 'atlas'
+# Slice every tile into its own pixmap up front.
+RENDER_TILES = 'tiles'
+# Slice tiles on first use, and keep the most recently used ones in a bounded cache.
+RENDER_CACHED = 'cached'
+
+RENDER_MODES = (RENDER_ATLAS, RENDER_TILES, RENDER_CACHED)
+
+
+class SpriteSheet(object):
+    """
+    A grid of equally sized tiles stored in a single atlas.
+
+    Negative sprite indices are blank frames, and draw nothing.
+
+    Parameters
+    ----------
+    atlas : QtGui.QPixmap or QtGui.QImage
+        Images are drawn as they are, which avoids converting atlases backed by memory mapped bundles.
+    tile_width : int
+    tile_height : int
+    mode : str
+        One of RENDER_ATLAS, RENDER_TILES or RENDER_CACHED.
+    cache_size : int
+        Maximum number of tiles kept alive in RENDER_CACHED mode.
+    """
+
+    def __init__(self, atlas, tile_width, tile_height, mode=RENDER_ATLAS, cache_size=64):
+        if mode not in RENDER_MODES:
+            raise ValueError('mode must be one of {}, not {!r}'.format(', '.join(RENDER_MODES), mode))
+        self.atlas = atlas
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.mode = mode
+        self.cache_size = cache_size
+        self._atlas_is_image = isinstance(atlas, QtGui.QImage)
+
+        self._columns = max(atlas.width() // tile_width, 1)
+        self._tile_count = self._columns * (atlas.height() // tile_height)
+        self._tiles = OrderedDict()
+        self._masks = {}
+        # Scaled versions of the sheet, alive as long as an agent uses them
+        self._scaled = weakref.WeakValueDictionary()
+        if mode == RENDER_TILES:
+            for index in range(self._tile_count):
+                self._tiles[index] = self._slice(index)
+
+    def __len__(self):
+        return self._tile_count
+
+    def source_rect(self, index):
+        """
+        Return the rectangle of a tile inside the atlas.
+
+        Parameters
+        ----------
+        index : int
+
+        Returns
+        -------
+        QtCore.QRect
+        """
+        row, column = divmod(index, self._columns)
+        return QtCore.QRect(column * self.tile_width, row * self.tile_height, self.tile_width, self.tile_height)
+
+    def tile(self, index):
+        """
+        Return a tile as its own pixmap.
+
+        In RENDER_ATLAS mode this copies the tile out of the atlas, prefer draw() when painting.
+
+        Parameters
+        ----------
+        index : int
+
+        Returns
+        -------
+        QtGui.QPixmap
+        """
+        if index < 0 or index >= self._tile_count:
+            pixmap = QtGui.QPixmap(self.tile_width, self.tile_height)
+            pixmap.fill(QtCore.Qt.transparent)
+            return pixmap
+        if self.mode == RENDER_ATLAS:
+            return self._slice(index)
+        tiles = self._tiles
+        tile = tiles.get(index)
+        if tile is None:
+            tile = tiles[index] = self._slice(index)
+            if len(tiles) > self.cache_size:
+                tiles.popitem(last=False)
+        elif self.mode == RENDER_CACHED:
+            tiles.move_to_end(index)
+        return tile
+
+    def draw(self, painter, x, y, index):
+        """
+        Draw a tile with its top left corner at x, y.
+
+        Parameters
+        ----------
+        painter : QtGui.QPainter
+        x : int
+        y : int
+        index : int
+        """
+        if index < 0 or index >= self._tile_count:
+            return
+        if self.mode == RENDER_ATLAS:
+            row, column = divmod(index, self._columns)
+            draw = painter.drawImage if self._atlas_is_image else painter.drawPixmap
+            draw(x, y, self.atlas, column * self.tile_width, row * self.tile_height, self.tile_width, self.tile_height)
+        else:
+            painter.drawPixmap(x, y, self.tile(index))
+
+    def mask(self, index):
+        """
+        Return the opaque area of a tile, to shape windows with.
+
+        Masks are computed from the tile's alpha channel the first time they are needed, then cached.
+
+        Parameters
+        ----------
+        index : int
+
+        Returns
+        -------
+        QtGui.QRegion
+            Empty for blank frames.
+        """
+        region = self._masks.get(index)
+        if region is None:
+            if index < 0 or index >= self._tile_count:
+                region = QtGui.QRegion()
+            else:
+                if self._atlas_is_image:
+                    image = self.atlas.copy(self.source_rect(index))
+                else:
+                    image = self.atlas.copy(self.source_rect(index)).toImage()
+                # Pixels which are at least half opaque are part of the shape
+                alpha = image.createAlphaMask(QtCore.Qt.ThresholdAlphaDither)
+                region = QtGui.QRegion(QtGui.QBitmap.fromImage(alpha))
+            self._masks[index] = region
+        return region
+
+    def scaled(self, scale, device_pixel_ratio=1.0):
+        """
+        Return the sheet scaled by a factor, shared with the other agents using the same scale.
+
+        Parameters
+        ----------
+        scale : float
+            Scale of the tiles, in logical pixels.
+        device_pixel_ratio : float
+            Device pixel ratio of the screen, tiles are scaled to its physical resolution.
+
+        Returns
+        -------
+        ScaledSpriteSheet
+        """
+        key = (float(scale), float(device_pixel_ratio))
+        scaled = self._scaled.get(key)
+        if scaled is None:
+            scaled = self._scaled[key] = ScaledSpriteSheet(self, scale, device_pixel_ratio)
+        return scaled
+
+    def _slice(self, index):
+        """ Copy a single tile out of the atlas. """
+        if self._atlas_is_image:
+            return QtGui.QPixmap.fromImage(self.atlas.copy(self.source_rect(index)))
+        return self.atlas.copy(self.source_rect(index))
+
+
+class ScaledSpriteSheet(object):
+    """
+    Tiles of a SpriteSheet smooth scaled once, on first use, and kept within a memory budget.
+
+    Tiles are scaled to the physical resolution of the screen and tagged with its device pixel ratio, so painting them
+    at logical coordinates needs no scaling at all.
+
+    Parameters
+    ----------
+    sheet : SpriteSheet
+    scale : float
+        Scale of the tiles, in logical pixels.
+    device_pixel_ratio : float
+    memory_budget : int
+        Maximum size of the scaled tiles kept alive, in bytes. The least recently used are dropped first.
+
+    Attributes
+    ----------
+    tile_width : int
+    tile_height : int
+        Size of the scaled tiles, in logical pixels.
+    hits : int
+    misses : int
+    """
+
+    memory_budget = 32 * 1024 * 1024
+
+    def __init__(self, sheet, scale, device_pixel_ratio=1.0, memory_budget=None):
+        self.sheet = sheet
+        self.scale = scale
+        self.device_pixel_ratio = device_pixel_ratio
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        self.tile_width = max(int(round(sheet.tile_width * scale)), 1)
+        self.tile_height = max(int(round(sheet.tile_height * scale)), 1)
+        self._device_width = max(int(round(sheet.tile_width * scale * device_pixel_ratio)), 1)
+        self._device_height = max(int(round(sheet.tile_height * scale * device_pixel_ratio)), 1)
+        self._tile_bytes = self._device_width * self._device_height * 4
+        self._tiles = OrderedDict()
+        self._masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.sheet)
+
+    def tile(self, index):
+        """
+        Return a scaled tile.
+
+        Parameters
+        ----------
+        index : int
+
+        Returns
+        -------
+        QtGui.QPixmap
+        """
+        tiles = self._tiles
+        tile = tiles.get(index)
+        if tile is not None:
+            self.hits += 1
+            tiles.move_to_end(index)
+            return tile
+        self.misses += 1
+        tile = self.sheet.tile(index).scaled(self._device_width, self._device_height, QtCore.Qt.IgnoreAspectRatio,
+                                             QtCore.Qt.SmoothTransformation)
+        tile.setDevicePixelRatio(self.device_pixel_ratio)
+        tiles[index] = tile
+        while len(tiles) > 1 and len(tiles) * self._tile_bytes > self.memory_budget:
+            tiles.popitem(last=False)
+        return tile
+
+    def draw(self, painter, x, y, index):
+        """
+        Draw a scaled tile with its top left corner at x, y.
+
+        Parameters
+        ----------
+        painter : QtGui.QPainter
+        x : int
+        y : int
+        index : int
+        """
+        if index < 0 or index >= len(self.sheet):
+            return
+        painter.drawPixmap(x, y, self.tile(index))
+
+    def mask(self, index):
+        """
+        Return the opaque area of a scaled tile, in logical pixels, see SpriteSheet.mask().
+
+        Parameters
+        ----------
+        index : int
+
+        Returns
+        -------
+        QtGui.QRegion
+        """
+        region = self._masks.get(index)
+        if region is None:
+            transform = QtGui.QTransform.fromScale(self.tile_width / float(self.sheet.tile_width),
+                                                   self.tile_height / float(self.sheet.tile_height))
+            region = self._masks[index] = transform.map(self.sheet.mask(index))
+        return region
+
+    def stats(self):
+        """
+        Return the cache counters.
+
+        Returns
+        -------
+        dict
+            hits, misses, the number of tiles cached and their size in bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'tiles': len(self._tiles),
+                'bytes': len(self._tiles) * self._tile_bytes}
@@ -0,0 +1,261 @@
+"""
+Make an agent look towards the cursor, or towards a stream of points, continuously.
+
+Positions are sampled at a fixed rate, however often they change, and classified into the sector of the Look*
+animation facing them. The agent is only retargeted when the sector changes, and a position has to move past the
+boundary of the current sector by a margin (the hysteresis) before the sector changes, so the agent does not flicker
+between two animations when the cursor rests on a boundary. Moving the agent counts as much as moving the cursor.
+
+Retargeting interrupts the animation playing and queues the Look* animation ahead of the others. Look* requests
+coalesce in the animation queue (see clippy_qt.animation_queue), so even fast retargeting never piles up animations.
+"""
+import math
+
+from PySide2 import QtCore, QtGui
+
+# Directions of the sectors, counter clockwise from the one centered on the positive x axis. The agent faces the
+# user, its left is on the right of the screen.
+GRANULAR_DIRECTIONS = ('Left', 'DownLeft', 'Down', 'DownRight', 'Right', 'UpRight', 'Up', 'UpLeft')
+COARSE_DIRECTIONS = ('Left', 'Down', 'Right', 'Up')
+
+# Priority of the Look* animations played by the tracker, above the default priority of Agent.play()
+LOOK_PRIORITY = 1
+
+
+def sector_index(angle, count):
+    """
+    Return the sector of an angle, for sectors of equal width centered on multiples of 360 / count degrees.
+
+    Angles on a boundary belong to the sector before it.
+
+    Parameters
+    ----------
+    angle : float
+        In degrees, y pointing down like screen coordinates.
+    count : int
+
+    Returns
+    -------
+    int
+    """
+    width = 360.0 / count
+    return int(math.ceil((angle - width / 2) / width)) % count
+
+
+def direction_of(delta_x, delta_y, directions=GRANULAR_DIRECTIONS):
+    """
+    Return the direction of a vector, one of the names in directions.
+
+    Parameters
+    ----------
+    delta_x : float
+    delta_y : float
+    directions : tuple of str
+        GRANULAR_DIRECTIONS or COARSE_DIRECTIONS.
+
+    Returns
+    -------
+    str
+    """
+    return directions[sector_index(math.degrees(math.atan2(delta_y, delta_x)), len(directions))]
+
+
+class SectorClassifier(object):
+    """
+    Classify angles into sectors, with hysteresis.
+
+    Parameters
+    ----------
+    directions : tuple of str
+        Name of each sector, see GRANULAR_DIRECTIONS.
+    hysteresis : float
+        Degrees an angle must go past the boundary of the current sector to change sector.
+
+    Attributes
+    ----------
+    current : int or None
+        The current sector.
+    """
+
+    def __init__(self, directions=GRANULAR_DIRECTIONS, hysteresis=10.0):
+        self.directions = tuple(directions)
+        self.hysteresis = hysteresis
+        self.width = 360.0 / len(self.directions)
+        self.current = None
+
+    def classify(self, angle):
+        """
+        Return the sector of an angle, and make it current.
+
+        Parameters
+        ----------
+        angle : float
+            In degrees.
+
+        Returns
+        -------
+        int
+        """
+        current = self.current
+        if current is not None:
+            # Distance to the center of the current sector, between 0 and 180 degrees
+            distance = abs((angle - current * self.width + 180) % 360 - 180)
+            if distance <= self.width / 2 + self.hysteresis:
+                return current
+        self.current = sector_index(angle, len(self.directions))
+        return self.current
+
+    def reset(self):
+        """ Forget the current sector. """
+        self.current = None
+
+
+class CursorTracker(QtCore.QObject):
+    """
+    Keep an agent looking towards the cursor, or towards the points given to track().
+
+    Parameters
+    ----------
+    agent : clippy_qt.agent.Agent
+    rate : float
+        Samples per second.
+    hysteresis : float
+        See SectorClassifier.
+    dead_zone : int
+        Positions closer than this many pixels to the agent's center are ignored.
+    parent : QtCore.QObject
+
+    Attributes
+    ----------
+    samples : int
+        Positions classified.
+    retargets : int
+        Look animations played, because the sector changed.
+    """
+
+    def __init__(self, agent, rate=10.0, hysteresis=10.0, dead_zone=16, parent=None):
+        super(CursorTracker, self).__init__(parent)
+        self.agent = agent
+        self.dead_zone = dead_zone
+        self.classifier = SectorClassifier(GRANULAR_DIRECTIONS, hysteresis)
+        self.samples = 0
+        self.retargets = 0
+
+        self._following = False
+        # Latest position given to track(), waiting for the next sample
+        self._pending = None
+        # Position and agent center of the last sample, the sector only changes if either moves
+        self._last_sample = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._sample)
+        self.set_rate(rate)
+
+    def rate(self):
+        """ Return the number of samples per second. """
+        return 1000.0 / self._timer.interval()
+
+    def set_rate(self, rate):
+        """
+        Change the number of samples per second.
+
+        Parameters
+        ----------
+        rate : float
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive, not {}'.format(rate))
+        self._timer.setInterval(max(int(round(1000.0 / rate)), 1))
+
+    def is_following(self):
+        """ Return True while following the cursor. """
+        return self._following
+
+    def follow_cursor(self, enabled=True):
+        """
+        Start or stop following the cursor.
+
+        Parameters
+        ----------
+        enabled : bool
+        """
+        self._following = enabled
+        if enabled:
+            self.wake()
+        elif self._pending is None:
+            self._timer.stop()
+
+    def track(self, position):
+        """
+        Look towards a point, throttled to the sampling rate: the first point is handled right away, the points given
+        until the next sample only count for the latest one.
+
+        Parameters
+        ----------
+        position : QtCore.QPoint
+            In global coordinates.
+        """
+        self._pending = QtCore.QPoint(position)
+        if not self._timer.isActive():
+            self._sample()
+
+    def stop(self):
+        """ Stop following the cursor, and forget the points waiting and the current sector. """
+        self._following = False
+        self._pending = None
+        self._last_sample = None
+        self._timer.stop()
+        self.classifier.reset()
+
+    def stats(self):
+        """
+        Return the tracking counters.
+
+        Returns
+        -------
+        dict
+            samples, retargets and the current direction, None before the first retarget.
+        """
+        current = self.classifier.current
+        return {'samples': self.samples, 'retargets': self.retargets,
+                'direction': self.classifier.directions[current] if current is not None else None}
+
+    def wake(self):
+        """ Resume sampling, which stops while the agent cannot be seen. The agent calls it when it can again. """
+        if (self._following or self._pending is not None) and not self._timer.isActive():
+            self._sample()
+
+    def _sample(self):
+        """ Handle the latest position, and wait for the next sample if there may be more. """
+        if not self.agent.is_exposed():
+            # Keep the latest point for when the agent can be seen again, see wake()
+            return
+        position, self._pending = self._pending, None
+        if position is None and self._following:
+            position = QtGui.QCursor.pos()
+        if position is not None:
+            self._look_towards(position)
+        # Points from track() stop sampling once they dry up, the cursor is sampled until follow_cursor(False)
+        if self._following or position is not None:
+            self._timer.start()
+
+    def _look_towards(self, position):
+        center = self.agent.global_center()
+        if (position, center) == self._last_sample:
+            return
+        self._last_sample = (position, center)
+        delta = position - center
+        if delta.manhattanLength() < self.dead_zone:
+            return
+        self.samples += 1
+        previous = self.classifier.current
+        sector = self.classifier.classify(math.degrees(math.atan2(delta.y(), delta.x())))
+        if sector == previous:
+            return
+        animation = 'Look{}'.format(self.classifier.directions[sector])
+        if animation in self.agent.animations():
+            self.retargets += 1
+            # Interrupt the idle or looping animation playing, and go ahead of the queued ones, the look would wait
+            # behind them otherwise
+            self.agent.activate()
+            self.agent.play(animation, priority=LOOK_PRIORITY)